@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Times fit-clang-format on synthetic corpora, so that a change can be checked for speed (and for
+# whether the fit still finds the style that made the corpus). Runs offline; the only things it
+# needs are clang-format and git. See "Benchmarking" in the README.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+import synthetic
+import util
+
+# The corpora to time by default. The fit finds each of their styles exactly, so a change that
+# stops it from doing so shows up; the other styles are harder (eg, 'linux' needs IndentWidth 8,
+# but the width is picked before tabs are tried).
+DEFAULT_CORPORA = ['c:llvm', 'cpp:mozilla', 'objc:webkit']
+
+# Bumped whenever the results change shape.
+RESULTS_VERSION = 1
+
+FIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fit-clang-format.py')
+
+def parse_corpus(text):
+    language, _, style = text.partition(':')
+    if language not in synthetic.LANGUAGES or style not in synthetic.STYLES:
+        raise argparse.ArgumentTypeError("%r should be LANGUAGE:STYLE; the languages are %s and the styles are %s" % (
+            text, ', '.join(sorted(synthetic.LANGUAGES)), ', '.join(sorted(synthetic.STYLES))))
+    return language, style
+
+def run_fit(corpus_path, work_path, clang_format, fit_args):
+    """Run a fit of the corpus, and return (seconds, peak RSS in KB, the --profile trace)."""
+    trace_path = os.path.join(work_path, 'trace.json')
+    command = [sys.executable, FIT_SCRIPT, '--git', corpus_path, '--clang-format-path', clang_format,
+        '--no-cache', '--no-ansi', '--profile', trace_path] + fit_args
+    with open(os.path.join(work_path, 'fit.log'), 'wb') as log:
+        start = time.time()
+        p = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resources of just this child (and whatever it waited on, like clang-format).
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        seconds = time.time() - start
+    if p.returncode != 0:
+        raise ValueError("the fit failed with code %d; see %r" % (p.returncode, log.name))
+
+    # Linux counts in kilobytes, macOS in bytes.
+    peak_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    with open(trace_path, 'rb') as f:
+        trace = json.load(f)
+    return seconds, peak_rss, trace
+
+def get_stages(trace):
+    """Totals the trace's spans by name: {name: {'calls', 'wall_seconds', 'cpu_seconds'}}."""
+    stages = {}
+    for event in trace['traceEvents']:
+        stage = stages.setdefault(event['name'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+        stage['calls'] += 1
+        stage['wall_seconds'] += event['dur'] / 1e6
+        stage['cpu_seconds'] += event['args'].get('cpu_ms', 0) / 1000.0
+    return stages
+
+def check_recovery(corpus_path, clang_format, style, filename):
+    """Compare the style that the fit applied to the corpus with the one that made it.
+
+    Returns (the lines that the fitted style changes, the keys of the corpus's style that the fitted
+    one sets to something else).
+    """
+    changed_lines = 0
+    for line in util.run(['git', 'diff', '--numstat'], cwd=corpus_path).splitlines():
+        insertions, deletions, _ = line.split('\t', 2)
+        changed_lines += int(insertions) + int(deletions)
+
+    def dump_config(style_argument):
+        return yaml.safe_load(util.run([clang_format, '-dump-config', '-style=' + style_argument, '-assume-filename=' + filename], cwd=corpus_path))
+    made_with = dump_config(yaml.safe_dump(synthetic.STYLES[style], default_flow_style=True, width=float('inf')).strip())
+    fitted = dump_config('file')
+    mismatched = sorted(key for key in synthetic.STYLES[style] if key != 'BasedOnStyle' and made_with.get(key) != fitted.get(key))
+    return changed_lines, mismatched
+
+def benchmark_corpus(language, style, args, work_dir):
+    name = '%s:%s' % (language, style)
+    corpus_path = os.path.join(work_dir, '%s-%s' % (language, style))
+    os.makedirs(corpus_path)
+    contents = synthetic.generate_corpus(corpus_path, language, style, args.files, args.clang_format, random.Random(args.seed))
+    print("%s: %d files (%d bytes)" % (name, len(contents), sum(len(text) for text in contents.itervalues())))
+
+    runs = []
+    for repeat in range(args.repeat):
+        if repeat:
+            util.run(['git', 'reset', '-q', '--hard'], cwd=corpus_path)
+            os.remove(os.path.join(corpus_path, '.clang-format'))
+        seconds, peak_rss, trace = run_fit(corpus_path, work_dir, args.clang_format, args.fit_args)
+        runs.append((seconds, peak_rss, trace))
+        print("  run %d: %.2fs" % (repeat + 1, seconds))
+
+    # The fastest run is the one least disturbed by whatever else the machine was doing.
+    seconds, peak_rss, trace = min(runs, key=lambda run: run[0])
+    stages = get_stages(trace)
+    candidates = stages.get('candidate', {}).get('calls', 0)
+    file_formats = sum(event['args'].get('files', 0) for event in trace['traceEvents'] if event['name'] == 'format')
+    changed_lines, mismatched = check_recovery(corpus_path, args.clang_format, style, sorted(contents)[0])
+
+    return {
+        'name': name,
+        'language': language,
+        'style': synthetic.STYLES[style],
+        'files': len(contents),
+        'bytes': sum(len(text) for text in contents.itervalues()),
+        'corpus_hash': util.hash_file_contents(contents),
+        'seconds': seconds,
+        'all_seconds': [run[0] for run in runs],
+        'candidates': candidates,
+        'candidates_per_second': candidates / seconds,
+        'file_formats': file_formats,
+        'file_formats_per_second': file_formats / seconds,
+        'peak_rss_kb': max(run[1] for run in runs),
+        'subprocesses': trace.get('otherData', {}).get('counters', {}).get('subprocesses', 0),
+        'stages': stages,
+        'recovered': changed_lines == 0,
+        'changed_lines': changed_lines,
+        'mismatched_keys': mismatched,
+    }
+
+def get_commit():
+    """The commit of this checkout, with a '+' if it has changes; or None if it isn't in git."""
+    path = os.path.dirname(FIT_SCRIPT)
+    try:
+        commit = util.run(['git', 'rev-parse', 'HEAD'], cwd=path, include_stderr=True)[0].strip()
+        dirty = not util.check(['git', 'diff-index', '--quiet', 'HEAD'], cwd=path)
+    except (ValueError, OSError):
+        return None
+    return commit + ('+' if dirty else '')
+
+def print_comparison(results, baseline):
+    old_runs = dict((run['name'], run) for run in baseline['runs'])
+    print("")
+    print("Compared with %s:" % (baseline.get('commit') or 'the baseline'))
+    for run in results['runs']:
+        old = old_runs.get(run['name'])
+        if old is None:
+            print("  %-20s (not in the baseline)" % run['name'])
+            continue
+        note = '' if old['corpus_hash'] == run['corpus_hash'] else ' (different corpus; use the same --files and --seed)'
+        print("  %-20s %.2fs -> %.2fs (%+.1f%%), %.1f -> %.1f candidates/s%s" % (
+            run['name'], old['seconds'], run['seconds'], 100.0 * (run['seconds'] / old['seconds'] - 1),
+            old['candidates_per_second'], run['candidates_per_second'], note))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time fit-clang-format on synthetic corpora made with known styles.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--corpus', type=parse_corpus, metavar='LANGUAGE:STYLE', action='append',
+        help="a corpus to time; can be specified multiple times (default: %s). The languages are %s, and the styles are %s" % (
+            ' '.join(DEFAULT_CORPORA), ', '.join(sorted(synthetic.LANGUAGES)), ', '.join(sorted(synthetic.STYLES))))
+    parser.add_argument('--files', type=int, metavar='NUM', default=12, help='about how many files each corpus has')
+    parser.add_argument('--seed', type=int, metavar='NUM', default=0, help='the seed for the made-up code; the same seed always makes the same corpus')
+    parser.add_argument('--repeat', type=int, metavar='NUM', default=1, help='time each fit NUM times, and keep the fastest')
+    parser.add_argument('--fit-args', type=str, metavar='ARGS', default='', help="more arguments for fit-clang-format, eg '--eval-mode worktree -j 2'")
+    parser.add_argument('--clang-format-path', type=str, metavar='PATH', help='the path to the clang-format tool')
+    parser.add_argument('--output', type=str, metavar='PATH', default='benchmark.json', help='where to write the results')
+    parser.add_argument('--baseline', type=str, metavar='PATH', help='the results of an earlier run (eg, of another commit) to compare with')
+    parser.add_argument('--keep', action='store_true', help="keep the corpora and the fits' logs and traces")
+    args = parser.parse_args()
+
+    args.fit_args = shlex.split(args.fit_args)
+    corpora = args.corpus or [parse_corpus(text) for text in DEFAULT_CORPORA]
+    if args.files <= 0 or args.repeat <= 0:
+        parser.error('--files and --repeat should be positive numbers')
+    try:
+        args.clang_format = args.clang_format_path or util.run(['which', 'clang-format']).strip()
+        clang_format_version = util.run([args.clang_format, '-version']).strip()
+    except (ValueError, OSError):
+        parser.error("can't run clang-format; maybe specify --clang-format-path?")
+    args.clang_format = os.path.abspath(args.clang_format)
+
+    work_dir = tempfile.mkdtemp(prefix='fit-clang-format-benchmark-')
+    try:
+        runs = [benchmark_corpus(language, style, args, work_dir) for language, style in corpora]
+    finally:
+        if args.keep:
+            print("Kept the corpora in %r." % work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'commit': get_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'clang_format': clang_format_version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'settings': {'files': args.files, 'seed': args.seed, 'repeat': args.repeat, 'fit_args': args.fit_args},
+        'runs': runs,
+    }
+    with open(args.output, 'wb') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print("")
+    print("%-20s %9s %12s %14s %10s  %s" % ('corpus', 'seconds', 'candidates/s', 'file formats/s', 'peak RSS', 'recovered the style'))
+    for run in runs:
+        if run['recovered']:
+            recovered = 'yes'
+        else:
+            recovered = 'no: %d lines differ; %s' % (run['changed_lines'], ', '.join(run['mismatched_keys']) or 'every key matches')
+        print("%-20s %9.2f %12.1f %14.1f %8dMB  %s" % (
+            run['name'], run['seconds'], run['candidates_per_second'], run['file_formats_per_second'], run['peak_rss_kb'] // 1024, recovered))
+    print("Wrote the results to %r." % args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            print_comparison(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
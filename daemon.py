@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+# A JSON-RPC 2.0 server on a Unix socket, for 'fit-clang-format --serve'. Each request and each
+# response is one line of JSON. Clients can keep a connection open for as many requests as they
+# like, and several can be connected at once, but the requests run one at a time.
+#
+# Run this file to send a request from the shell:
+#     $ python daemon.py SOCKET METHOD ['{"param": value, ...}']
+
+from __future__ import print_function
+
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+
+# The error codes from the JSON-RPC 2.0 spec.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+# Raised by a method (or by 'call') for a request that can't be answered.
+class RequestError(Exception):
+    def __init__(self, code, message):
+        super(RequestError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+def error_response(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+# Answers the requests in a line of JSON, with the methods in a {name: function(params)} dict.
+# Returns the response to send back, or None if there's nothing to send (ie, only notifications).
+class Dispatcher(object):
+    def __init__(self, methods):
+        self.methods = methods
+        self.lock = threading.Lock()
+
+    def handle_line(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return error_response(None, PARSE_ERROR, "Parse error")
+
+        if isinstance(message, list):
+            if not message:
+                return error_response(None, INVALID_REQUEST, "Invalid Request: the batch is empty")
+            responses = [response for response in map(self.handle_request, message) if response is not None]
+            return responses or None
+        return self.handle_request(message)
+
+    def handle_request(self, request):
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or not isinstance(request.get('method'), basestring):
+            return error_response(request.get('id') if isinstance(request, dict) else None, INVALID_REQUEST, "Invalid Request")
+        request_id = request.get('id')
+        params = request.get('params', {})
+
+        try:
+            method = self.methods.get(request['method'])
+            if method is None:
+                raise RequestError(METHOD_NOT_FOUND, "Method not found: %s" % request["method"])
+            if not isinstance(params, dict):
+                raise RequestError(INVALID_PARAMS, "The params should be an object")
+            # The methods share the project and the caches, so they take turns.
+            with self.lock:
+                result = method(params)
+        except RequestError as e:
+            response = error_response(request_id, e.code, e.message)
+        except Exception as e:
+            response = error_response(request_id, SERVER_ERROR, '%s: %s' % (e.__class__.__name__, e))
+        else:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+        # Notifications (requests without an id) don't get a response.
+        if 'id' not in request:
+            return None
+        return response
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            response = self.server.dispatcher.handle_line(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response) + '\n')
+                self.wfile.flush()
+            # Only stop once the response to the 'shutdown' request is out. This runs on the
+            # handler's own thread, not the server's loop; 'serve' waits for it to finish.
+            if self.server.stopping:
+                self.server.stopper = threading.current_thread()
+                self.server.shutdown()
+                return
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, methods):
+        self.dispatcher = Dispatcher(methods)
+        self.stopping = False
+        self.stopper = None
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+def is_listening(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+def serve(path, methods, ready=None):
+    """Answer requests on the socket at 'path' until a 'shutdown' request comes in.
+
+    'methods' is a {name: function(params)} dict, where 'params' is the dict from the request; a
+    function returns the result (anything that JSON can hold) or raises RequestError.
+    """
+    if os.path.exists(path):
+        if is_listening(path):
+            raise ValueError("another server is already listening on %r" % path)
+        # Left over from a server that didn't shut down cleanly.
+        os.remove(path)
+
+    methods = dict(methods)
+    server = Server(path, methods)
+
+    def shutdown(params):
+        # The handler stops the server after it sends this response.
+        server.stopping = True
+        return True
+    methods.setdefault('shutdown', shutdown)
+
+    try:
+        # Only this user can talk to it.
+        os.chmod(path, 0600)
+        if ready:
+            ready()
+        server.serve_forever()
+        if server.stopper:
+            server.stopper.join()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+def call(path, method, params=None, request_id=1):
+    """Send a request to the server at 'path' and return its result; raises RequestError if it fails."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        request = {'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params or {}}
+        client.sendall(json.dumps(request) + '\n')
+        response = json.loads(client.makefile('rb').readline())
+    finally:
+        client.close()
+    if 'error' in response:
+        raise RequestError(response['error']['code'], response['error']['message'])
+    return response['result']
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print("usage: %s SOCKET METHOD ['{\"param\": value, ...}']" % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+    try:
+        result = call(sys.argv[1], sys.argv[2], json.loads(sys.argv[3]) if len(sys.argv) == 4 else None)
+    except (RequestError, socket.error, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result, indent=2, sort_keys=True))
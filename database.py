@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import tracing
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'fit-clang-format')
+
+# A persistent store of scores, so that a run can pick up where an earlier (or interrupted) one
+# left off. A score is only valid for the exact clang-format, set of files, style and scorer that
+# produced it, so all of those are part of the key.
+# Scores for single files are kept too, keyed by the file's git blob hash instead of the whole set
+# of files, so that they stay valid for every file that hasn't changed since they were found.
+# The least-recently-used scores are dropped once there are more than 'max_entries' (or
+# 'max_file_entries' for single files).
+class ScoreDatabase(object):
+    def __init__(self, path, max_entries, max_file_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_file_entries = max_file_entries
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Workers look up file stats from their own threads.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Filenames are kept as the bytes that they are on disk, which aren't always UTF-8.
+        self.connection.text_factory = str
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS scores (
+                clang_format TEXT NOT NULL,
+                files TEXT NOT NULL,
+                style TEXT NOT NULL,
+                scorer TEXT NOT NULL,
+                score TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (clang_format, files, style, scorer)
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS file_stats (
+                clang_format TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                blob TEXT NOT NULL,
+                style TEXT NOT NULL,
+                scorer TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (clang_format, style, scorer, filename, blob)
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS file_stats_last_used ON file_stats (last_used)')
+        # How much each key has improved the score in the rounds of earlier searches, for --time-budget.
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS key_stats (
+                project TEXT NOT NULL,
+                scorer TEXT NOT NULL,
+                key TEXT NOT NULL,
+                rounds INTEGER NOT NULL,
+                gain REAL NOT NULL,
+                PRIMARY KEY (project, scorer, key)
+            )''')
+        self.connection.commit()
+        # How many rows each table may have, at most; see evict().
+        self.row_counts = dict(
+            (table, self.connection.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0])
+            for table in ('scores', 'file_stats')
+        )
+
+    def get_score(self, clang_format, files, style, scorer):
+        key = (clang_format, files, style, scorer)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT score FROM scores WHERE clang_format=? AND files=? AND style=? AND scorer=?', key
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute(
+                'UPDATE scores SET last_used=? WHERE clang_format=? AND files=? AND style=? AND scorer=?', (time.time(),) + key
+            )
+            self.connection.commit()
+        return decode_score(json.loads(row[0]))
+
+    def register_score(self, clang_format, files, style, scorer, score):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO scores (clang_format, files, style, scorer, score, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                (clang_format, files, style, scorer, json.dumps(score), time.time())
+            )
+            self.evict('scores', self.max_entries, 1)
+            self.connection.commit()
+
+    def get_file_stats(self, clang_format, style, scorer, blobs):
+        """Returns {filename: stats} for each file in the {filename: blob} dict that has stats."""
+        with self.lock:
+            rows = [
+                (filename, blob, stats) for filename, blob, stats in self.connection.execute(
+                    'SELECT filename, blob, stats FROM file_stats WHERE clang_format=? AND style=? AND scorer=?',
+                    (clang_format, style, scorer)
+                )
+                if blobs.get(filename) == blob
+            ]
+            # Only the rows of the files as they are now were used; the other blobs can age out.
+            now = time.time()
+            self.connection.executemany(
+                'UPDATE file_stats SET last_used=? WHERE clang_format=? AND style=? AND scorer=? AND filename=? AND blob=?',
+                [(now, clang_format, style, scorer, filename, blob) for filename, blob, _ in rows]
+            )
+            self.connection.commit()
+        return dict((filename, decode_score(json.loads(stats))) for filename, _, stats in rows)
+
+    def register_file_stats(self, clang_format, style, scorer, blobs, stats):
+        """Remember the stats in the {filename: stats} dict; 'blobs' has the blob for each file."""
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO file_stats (clang_format, filename, blob, style, scorer, stats, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(clang_format, filename, blobs[filename], style, scorer, json.dumps(value), now) for filename, value in stats.iteritems()]
+            )
+            self.evict('file_stats', self.max_file_entries, len(stats))
+            self.connection.commit()
+
+    def get_key_stats(self, project, scorer):
+        """Returns {key: (rounds, total gain)} for the project, and for the keys that it has no rounds
+        of, the totals over every other project."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT key, SUM(rounds), SUM(gain) FROM key_stats WHERE scorer=? GROUP BY key', (scorer,)
+            ).fetchall()
+            own_rows = self.connection.execute(
+                'SELECT key, rounds, gain FROM key_stats WHERE project=? AND scorer=?', (project, scorer)
+            ).fetchall()
+        stats = dict((key, (rounds, gain)) for key, rounds, gain in rows)
+        stats.update((key, (rounds, gain)) for key, rounds, gain in own_rows)
+        return stats
+
+    def register_key_round(self, project, scorer, key, gain):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO key_stats (project, scorer, key, rounds, gain) VALUES (?, ?, ?, 0, 0)', (project, scorer, key)
+            )
+            self.connection.execute(
+                'UPDATE key_stats SET rounds=rounds+1, gain=gain+? WHERE project=? AND scorer=? AND key=?', (gain, project, scorer, key)
+            )
+            self.connection.commit()
+
+    def evict(self, table, max_entries, inserted):
+        # The count goes up by every row that was inserted, even the ones that only replaced a row, so
+        # the table is only counted once it might be too big. Then it's cut down to a tenth below the
+        # limit, so that it isn't counted again for a while.
+        self.row_counts[table] += inserted
+        if self.row_counts[table] <= max_entries:
+            return
+        count = self.connection.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+        if count > max_entries:
+            keep = max_entries - max_entries // 10
+            self.connection.execute(
+                'DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY last_used LIMIT ?)' % (table, table),
+                (count - keep,)
+            )
+            count = keep
+        self.row_counts[table] = count
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# The stats for each file under each style that has been tried, where 'blobs' has the blob hash of
+# every file in the project. The database (if there is one) is only asked about each style once.
+class FileStatsCache(object):
+    def __init__(self, blobs, database=None, database_key=None):
+        self.blobs = blobs
+        self.cache = {}
+        self.lock = threading.Lock()
+
+        self.database = database
+        self.database_key = database_key
+
+    def get_file_stats(self, style, filenames):
+        """Returns {filename: stats} for each of the files that has stats for the style."""
+        with self.lock:
+            known = self.cache.get(style)
+            if known is None:
+                known = {}
+                if self.database:
+                    known = self.database.get_file_stats(style=style, blobs=self.blobs, **self.database_key)
+                self.cache[style] = known
+            stats = dict((filename, known[filename]) for filename in filenames if filename in known)
+        tracing.count('file stats cache hits', len(stats))
+        tracing.count('file stats cache misses', len(filenames) - len(stats))
+        return stats
+
+    def register_file_stats(self, style, stats):
+        with self.lock:
+            self.cache.setdefault(style, {}).update(stats)
+        if self.database:
+            self.database.register_file_stats(style=style, blobs=self.blobs, stats=stats, **self.database_key)
+
+# The files that a repo has with some extensions, kept in one file per repo so that a big repo
+# doesn't have to be listed again until the key (eg, its HEAD and index) changes.
+class FileListCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, repo_path):
+        return os.path.join(self.directory, 'files-%s.list' % hashlib.sha1(os.path.realpath(repo_path)).hexdigest())
+
+    def get_files(self, repo_path, key):
+        """Returns the list of files that was stored with this key, or None."""
+        # The key goes on the first line, and the names follow, each ending with a NUL like the output
+        # of 'git ls-files -z'; so they're kept as the bytes that they are on disk, whatever they are.
+        try:
+            with open(self.get_path(repo_path), 'rb') as f:
+                stored_key, _, names = f.read().partition('\n')
+        except IOError:
+            stored_key = None
+        if stored_key != key:
+            tracing.count('file list cache misses')
+            return None
+        tracing.count('file list cache hits')
+        return names.split('\0')[:-1]
+
+    def register_files(self, repo_path, key, files):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Written to the side and renamed into place, so that a reader never sees half of it.
+        path = self.get_path(repo_path)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(key + '\n' + ''.join(filename + '\0' for filename in files))
+        os.rename(path + '.tmp', path)
+
+# Scores are tuples, but JSON only knows about lists.
+def decode_score(value):
+    if isinstance(value, list):
+        return tuple(decode_score(x) for x in value)
+    return value
@@ -0,0 +1,117 @@
+import matrix
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def available():
+    return numpy is not None
+
+# A round of the search, split into the styles that won it with all of the files (more than one if
+# they tied) and the rest. A subset of the files picks the same winner if one of the best styles
+# scores strictly better with it than all of the rest do.
+class Round(object):
+    def __init__(self, best, rest):
+        self.best = best
+        self.rest = rest
+
+def get_rounds(score_matrix, scorer):
+    scores = matrix.get_scores(score_matrix.counts, scorer)
+    rounds = []
+    for members in score_matrix.rounds:
+        best_score = min(scores[index] for index in members)
+        best = [index for index in members if scores[index] == best_score]
+        rest = [index for index in members if scores[index] != best_score]
+        if rest:
+            rounds.append(Round(best, rest))
+    return rounds
+
+def lex_less(a, b):
+    """Whether each score in 'a' is less than the one in 'b', where the last axis has the elements of the scores."""
+    less = numpy.zeros(a.shape[:-1], dtype=bool)
+    equal = numpy.ones(a.shape[:-1], dtype=bool)
+    for index in range(a.shape[-1]):
+        less |= equal & (a[..., index] < b[..., index])
+        equal &= a[..., index] == b[..., index]
+    return less
+
+def lex_min(scores):
+    """The smallest of each row of scores; 'scores' is a rows x styles x elements array."""
+    best = scores[:, 0]
+    for index in range(1, scores.shape[1]):
+        best = numpy.where(lex_less(scores[:, index], best)[:, None], scores[:, index], best)
+    return best
+
+def check_rounds(scores, rounds):
+    """For each row of a rows x candidates x elements array of scores, returns how many of the rounds
+    pick the same winner, and how far the others are from it (the sum of how much the first element
+    of the best style's score would have to drop, which is never positive)."""
+    agreed = numpy.zeros(scores.shape[0], dtype=int)
+    shortfall = numpy.zeros(scores.shape[0])
+    for r in rounds:
+        best = lex_min(scores[:, r.best])
+        rest = lex_min(scores[:, r.rest])
+        agreed += lex_less(best, rest)
+        shortfall += numpy.minimum(rest[:, 0] - best[:, 0], 0)
+    return agreed, shortfall
+
+def distill(score_matrix, scorer, progress=None):
+    """Returns (files, agreed, rounds): a small subset of the files that picks the same winner as all
+    of them in as many rounds as it can, how many rounds it agrees on, and how many there are.
+
+    The files are picked greedily: each time, the one that makes the most rounds agree, or if none
+    does, the one that gets the rest closest to agreeing. It stops once every round agrees. Then the
+    files that the later ones made unnecessary are dropped, last picked first.
+    """
+    rounds = get_rounds(score_matrix, scorer)
+    if not rounds:
+        raise ValueError("it has no rounds to keep the same; save it again with a newer --save-matrix")
+    get_terms, finish = matrix.TERMS[scorer]
+    terms = get_terms(score_matrix.counts)
+
+    chosen = []
+    remaining = range(len(score_matrix.files))
+    sums = numpy.zeros(terms.shape[1:])
+    agreed = 0
+    while remaining and agreed < len(rounds):
+        agreements, shortfalls = check_rounds(finish(sums[None] + terms[remaining]), rounds)
+        # Ties go to the first file, so the result doesn't depend on anything but the matrix.
+        pick = max(range(len(remaining)), key=lambda index: (agreements[index], shortfalls[index], -index))
+        chosen.append(remaining.pop(pick))
+        sums += terms[chosen[-1]]
+        agreed = int(agreements[pick])
+        if progress:
+            progress(score_matrix.files[chosen[-1]], agreed, len(rounds))
+
+    # The sums above can be a little off, and taking a file back out would make them more so, so
+    # this part uses the exact scores.
+    agreed = count_agreed(score_matrix, scorer, chosen, rounds)
+    for index in reversed(chosen[:-1]):
+        without = [i for i in chosen if i != index]
+        if count_agreed(score_matrix, scorer, without, rounds) >= agreed:
+            chosen = without
+
+    files = sorted(score_matrix.files[index] for index in chosen)
+    return files, agreed, len(rounds)
+
+def count_agreed(score_matrix, scorer, rows, rounds):
+    scores = numpy.array(matrix.get_scores(score_matrix.counts[sorted(rows)], scorer))
+    agreed, _ = check_rounds(scores[None], rounds)
+    return int(agreed[0])
+
+
+# A manifest is a list of files, one per line, that a run can use instead of finding the files by
+# extension. Blank lines and lines that start with '#' are skipped.
+
+def write_manifest(path, files, comments=()):
+    with open(path, 'wb') as f:
+        for comment in comments:
+            f.write('# %s\n' % comment)
+        for filename in files:
+            f.write(filename + '\n')
+
+def read_manifest(path):
+    with open(path, 'rb') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
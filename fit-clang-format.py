@@ -5,10 +5,18 @@ from __future__ import print_function
 
 # System stuff.
 import argparse
+import atexit
+import hashlib
+import json
 import math
+import multiprocessing
+import multiprocessing.pool
 import os
 import random
+import socket
 import sys
+import threading
+import time
 
 # Third-party stuff.
 try:
@@ -27,8 +35,18 @@ except ImportError:
 
 # Project-local stuff.
 import ansi
+import daemon
+import database
+import distill
 import git
+import infer
+import matrix
+import memory
+import sample
+import scan
+import scratch
 import styles
+import tracing
 import util
 
 RC_FAIL = -1
@@ -152,11 +170,15 @@ class StyleCanonicalizer(object):
     def get_base_style(self, base):
         style = self.cache.get(base)
         if not style:
-            full_dict = yaml.load(
-                util.run([context['clang-format'], '-dump-config', '-style', yaml.dump({'BasedOnStyle':base})])
-            )
+            tracing.count('base style cache misses')
+            with tracing.span('dump-config', base=base):
+                full_dict = yaml.load(
+                    util.run([context['clang-format'], '-dump-config', '-style', yaml.dump({'BasedOnStyle':base})])
+                )
             style = styles.Style(base=base, style=full_dict)
             self.cache[base] = style
+        else:
+            tracing.count('base style cache hits')
         return style
 
     def get_canonical_string(self, style):
@@ -174,34 +196,310 @@ class StyleCanonicalizer(object):
 
 
 class ScoreCache(object):
-    def __init__(self):
+    def __init__(self, database=None, database_key=None):
         self.hasher = StyleCanonicalizer()
         self.cache = {}
 
+        # Optionally, also remember scores across runs. The key has everything other than the style
+        # that the score depends on (eg, the clang-format version and the files).
+        self.database = database
+        self.database_key = database_key
+
     def get_hash_for_style(self, style):
         return self.hasher.get_canonical_string(style=style)
 
     def get_score(self, style):
         h = self.get_hash_for_style(style)
-        return self.cache.get(h)
+        score = self.cache.get(h)
+        if score is None and self.database:
+            score = self.database.get_score(style=h, **self.database_key)
+            if score is not None:
+                self.cache[h] = score
+        tracing.count('score cache hits' if score is not None else 'score cache misses')
+        return score
 
     def register_score(self, style, score):
         h = self.get_hash_for_style(style)
         self.cache[h] = score
+        if self.database:
+            self.database.register_score(style=h, score=score, **self.database_key)
+
+
+def evaluate(project, style, style_hash, **kwargs):
+    # Each candidate shows up in the --profile trace under a short hash of its canonical string.
+    with tracing.span('candidate', 'candidate', style=hashlib.sha1(style_hash).hexdigest()[:12], files=len(kwargs.get('filenames') or context['files_to_format'])):
+        return project.score_style(style, style_hash, differ, ignore_spaces=True, **kwargs)
+
+# For each style key, the files whose stats changed between the values of that key.
+relevant_files_by_key = {}
+
+# Keys that change so much at once that no file can be assumed to stay the same.
+NEVER_PRUNE_KEYS = ['BasedOnStyle']
+
+def evaluate_with_pruning(tracker, project, key, pending, cache):
+    """Score the pending (style_hash, style) pairs, formatting as little as possible.
+
+    Values of the key are scored in full until one of them changes the stats of some file. After
+    that, only the files that changed (in this round or an earlier one) are formatted for the
+    other values, and every other file is assumed to keep the stats it had.
+    Returns a (score, exact) pair for each of the pending styles, in order.
+    """
+    known_stats = []
+    if tracker.accepted_style is not None:
+        accepted_stats = project.get_known_file_stats(cache.get_hash_for_style(tracker.accepted_style))
+        if accepted_stats is not None:
+            known_stats.append(accepted_stats)
+
+    results = []
+    relevant = set()
+    while not relevant and len(results) < len(pending):
+        style_hash, style = pending[len(results)]
+        results.append((evaluate(project, style, style_hash), True))
+        known_stats.append(project.get_known_file_stats(style_hash))
+
+        relevant = set(
+            f for f in context['files_to_format']
+            if any(stats[f] != known_stats[0][f] for stats in known_stats[1:])
+        )
+
+    relevant_files_by_key[key] = relevant_files_by_key.get(key, set()).union(relevant)
+    if len(results) == len(pending):
+        return results
+
+    relevant = [f for f in context['files_to_format'] if f in relevant_files_by_key[key]]
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "  [V] Only formatting the %d of %d files that %r changes." % (len(relevant), len(context['files_to_format']), key)))
+
+    results.extend(util.map_on_pool(pool,
+        lambda (style_hash, style): (evaluate(project, style, style_hash, filenames=relevant, fixed_stats=known_stats[0]), False),
+        pending[len(results):]
+    ))
+    return results
+
+# The best score seen so far in a round, shared by the workers that score its candidates.
+class RoundBound(object):
+    def __init__(self, scores):
+        self.lock = threading.Lock()
+        self.best = min(scores) if scores else None
+
+    def get(self):
+        with self.lock:
+            return self.best
+
+    def add(self, score):
+        with self.lock:
+            if self.best is None or score < self.best:
+                self.best = score
+
+def evaluate_with_bound(tracker, project, pending, known_scores):
+    """Score the pending (style_hash, style) pairs, giving up on any that are sure to lose.
+
+    A style that scores worse than the accepted style, or worse than another style in the round,
+    can't be the one that the tracker picks (ties go to the last option, so only a strictly
+    worse score is sure to lose). Each style is scored a few files at a time, and it's given up on
+    as soon as the first element of its score passes the first element of the best one so far.
+    Returns a (score, exact) pair for each of the pending styles, in order, and a dict of
+    {style_hash: note} for the ones that were given up on; their scores only cover some files.
+    """
+    bound = RoundBound([s for s in known_scores + [tracker.accepted_score] if s is not None])
+    dropped = {}
+
+    def evaluate_one((style_hash, style)):
+        try:
+            score = evaluate(project, style, style_hash, bound=bound.get)
+        except memory.Abandoned as e:
+            dropped[style_hash] = 'abandoned after %d of %d files' % (e.file_count, len(context['files_to_format']))
+            return e.score, False
+        bound.add(score)
+        return score, True
+
+    return util.map_on_pool(pool, evaluate_one, pending), dropped
+
+# The smallest sample of files that racing starts with.
+RACE_MIN_FILES = 8
+
+def evaluate_with_racing(project, pending):
+    """Score the pending (style_hash, style) pairs by successive halving.
+
+    All of them are scored on a small sample of the files, the worse half is dropped, and the rest
+    are scored again on a sample twice as big, until one is left or the sample has every file.
+    The ones that are left get a full score.
+    Returns a (score, exact) pair for each of the pending styles, in order, and a dict of
+    {style_hash: note} for the ones that were dropped; their scores only cover a sample.
+    """
+    files = context['race_order']
+    size = max(RACE_MIN_FILES, int(math.ceil(len(files) / 16.0)))
+
+    survivors = list(pending)
+    dropped = {}
+    scores = {}
+    while len(survivors) > 1 and size < len(files):
+        sample = files[:size]
+        sample_scores = util.map_on_pool(pool,
+            lambda (style_hash, style): evaluate(project, style, style_hash, filenames=sample),
+            survivors
+        )
+        for (style_hash, _), score in zip(survivors, sample_scores):
+            scores[style_hash] = score
+
+        # Keep the better half; a tie with the last one kept is kept too.
+        cutoff = sorted(sample_scores)[(len(survivors) + 1) // 2 - 1]
+        for style_hash, _ in survivors:
+            if scores[style_hash] > cutoff:
+                dropped[style_hash] = 'dropped after %d of %d files' % (size, len(files))
+        survivors = [(h, s) for h, s in survivors if h not in dropped]
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "  [V] Raced on %d of %d files; %d candidates left." % (size, len(files), len(survivors))))
+        size *= 2
+
+    for (style_hash, style), score in zip(survivors, util.map_on_pool(pool, lambda (style_hash, style): evaluate(project, style, style_hash), survivors)):
+        scores[style_hash] = score
+
+    return [(scores[style_hash], style_hash not in dropped) for style_hash, _ in pending], dropped
+
+# The golden ratio, less one: each step of a golden-section search keeps this much of the bracket.
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+def narrow_range(tracker, project, key_range, cache=None):
+    """Find the values of a StyleRange key that are worth ranking in its round, and score them.
+
+    The seeds are scored first. If they all tie, the key doesn't matter and the seeds are all that
+    get ranked. Otherwise the best value lies between the seeds next to the best one (or the end of
+    the range), and a golden-section search narrows that bracket down, 'resolution' apart, scoring
+    one or two new values at each step. Every value it scores goes in the cache, so the round
+    itself only has to rank them.
+    Returns the options for the round: the seeds outside of the range, then every value that was
+    scored, from the highest down, so that a tie goes to the lowest value.
+    """
+    if cache is None:
+        cache = score_cache
+    key = key_range.name
+    scores = {}
+
+    def score_values(values):
+        pending = []
+        for value in values:
+            if value in scores:
+                continue
+            style = tracker.get_candidate_style({key: value})
+            if cache.get_score(style) is None:
+                style_hash = cache.get_hash_for_style(style)
+                if style_hash not in (h for h, _ in pending):
+                    pending.append((style_hash, style))
+        results = util.map_on_pool(pool, lambda (style_hash, style): evaluate(project, style, style_hash), pending)
+        for (_, style), score in zip(pending, results):
+            cache.register_score(style=style, score=score)
+        for value in values:
+            scores[value] = cache.get_score(tracker.get_candidate_style({key: value}))
+
+    def snap(value):
+        return key_range.low + int(round(float(value - key_range.low) / key_range.resolution)) * key_range.resolution
+
+    seeds = [option[key] for option in key_range.options]
+    specials = [seed for seed in seeds if not key_range.low <= seed <= key_range.high]
+    in_range = sorted(seed for seed in seeds if key_range.low <= seed <= key_range.high)
+    score_values(seeds)
+
+    if len(set(scores[seed] for seed in in_range)) > 1:
+        best = min(range(len(in_range)), key=lambda i: scores[in_range[i]])
+        low = in_range[best - 1] if best > 0 else key_range.low
+        high = in_range[best + 1] if best + 1 < len(in_range) else key_range.high
+        while high - low > 2 * key_range.resolution:
+            left = snap(high - GOLDEN * (high - low))
+            right = snap(low + GOLDEN * (high - low))
+            if left >= right:
+                break
+            score_values([left, right])
+            if scores[left] <= scores[right]:
+                high = right
+            else:
+                low = left
+        score_values(range(low, high + 1, key_range.resolution))
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "  [V] Narrowed %s down to %d..%d with %d values." % (key, low, high, len(scores))))
 
+    values = sorted((value for value in scores if value not in specials), reverse=True)
+    return [{key: value} for value in specials + values]
 
-def search(tracker, project, options, strictly_better=True, cache=ScoreCache()):
-    tracker.start()
-    for option in options:
-        style = tracker.get_candidate_style(option)
+def search(tracker, project, options, strictly_better=True, cache=None, key=None):
+    with tracing.span('round', 'round', key=key or ', '.join(sorted(set(k for option in options for k in option)))):
+        return search_round(tracker, project, options, strictly_better, cache, key)
 
-        rank = RANK_SAME
+def search_round(tracker, project, options, strictly_better, cache, key):
+    if cache is None:
+        cache = score_cache
 
-        score = cache.get_score(style)
-        if score is None:
-            with project.apply_temporary_style(style):
-                score = differ.calculate_diff(project, ignore_spaces=True)
+    tracker.start()
+    candidate_styles = [tracker.get_candidate_style(option) for option in options]
+
+    # Score everything the cache doesn't know about. Several options can be the same style (eg, the
+    # value that the base style already uses), so each style only needs to be scored once.
+    pending = []
+    for style in candidate_styles:
+        if cache.get_score(style) is None:
+            style_hash = cache.get_hash_for_style(style)
+            if style_hash not in (h for h, _ in pending):
+                pending.append((style_hash, style))
+    dropped = {}
+    if context['race'] and len(pending) > 1:
+        results, dropped = evaluate_with_racing(project, pending)
+    elif key is not None and key not in NEVER_PRUNE_KEYS and context['prune_files'] and hasattr(project, 'get_known_file_stats'):
+        results = evaluate_with_pruning(tracker, project, key, pending, cache)
+    elif hasattr(project, 'get_known_file_stats') and not context['full_scores']:
+        known_scores = [cache.get_score(style) for style in candidate_styles]
+        results, dropped = evaluate_with_bound(tracker, project, pending, [s for s in known_scores if s is not None])
+    else:
+        results = [(score, True) for score in util.map_on_pool(pool, lambda (style_hash, style): evaluate(project, style, style_hash), pending)]
+    # Scores that skipped some files are good enough to rank this round, but shouldn't be mistaken
+    # for a full score later, so only the exact ones go in the cache.
+    round_scores = {}
+    approximate = set()
+    for (style_hash, style), (score, exact) in zip(pending, results):
+        round_scores[style_hash] = score
+        if exact:
             cache.register_score(style=style, score=score)
+        elif style_hash not in dropped:
+            approximate.add(style_hash)
+    for style in candidate_styles:
+        style_hash = cache.get_hash_for_style(style)
+        if style_hash not in round_scores:
+            round_scores[style_hash] = cache.get_score(style)
+        if matrix_candidates is not None and style_hash not in matrix_candidates:
+            matrix_candidates[style_hash] = style
+            matrix_candidates_order.append(style_hash)
+    if matrix_candidates is not None:
+        # The styles that this round compared, along with the one that they have to beat.
+        members = [cache.get_hash_for_style(style) for style in candidate_styles]
+        if tracker.accepted_style is not None:
+            members.append(cache.get_hash_for_style(tracker.accepted_style))
+        matrix_rounds.append(members)
+
+    # An approximate score must not be the one that gets accepted, so score it in full if it would
+    # win the round (ties go to the last option, like in the tracker).
+    while approximate:
+        winner, winner_hash = None, None
+        for style in candidate_styles:
+            style_hash = cache.get_hash_for_style(style)
+            if style_hash in dropped:
+                continue
+            if winner is None or round_scores[style_hash] <= round_scores[winner_hash]:
+                winner, winner_hash = style, style_hash
+        if winner_hash not in approximate or (tracker.accepted_score and round_scores[winner_hash] > tracker.accepted_score):
+            break
+        round_scores[winner_hash] = evaluate(project, winner, winner_hash)
+        cache.register_score(style=winner, score=round_scores[winner_hash])
+        approximate.remove(winner_hash)
+
+    # Then rank them in order, so that the winner is the same no matter how many jobs ran.
+    for option, style in zip(options, candidate_styles):
+        style_hash = cache.get_hash_for_style(style)
+        score = round_scores[style_hash]
+
+        # Styles that were dropped only have a score for some of the files, so they can't be
+        # ranked against the others.
+        if style_hash in dropped:
+            print('  %s ~%s: %s (%s)' % (RANK_WORSE(), print_score(score), ansi.wrap(ANSI['STYLE_VALUE'], option), dropped[style_hash]))
+            continue
 
         better = tracker.push_candidate(label=option, score=score, style=style)
 
@@ -212,14 +510,266 @@ def search(tracker, project, options, strictly_better=True, cache=ScoreCache()):
         else:
             better_label = RANK_BETTER()
 
+        # Approximate scores get a '~'.
+        score_label = print_score(score)
+        if style_hash in approximate:
+            score_label = '~' + score_label
+
         if verbosity > VERBOSITY_MEDIUM:
-            print('  %s %s: %s %r' % (better_label, print_score(score), ansi.wrap(ANSI['STYLE_VALUE'], option), style))
+            print('  %s %s: %s %r' % (better_label, score_label, ansi.wrap(ANSI['STYLE_VALUE'], option), style))
         else:
-            print('  %s %s: %s' % (better_label, print_score(score), ansi.wrap(ANSI['STYLE_VALUE'], option)))
+            print('  %s %s: %s' % (better_label, score_label, ansi.wrap(ANSI['STYLE_VALUE'], option)))
 
     return tracker.finish(strictly_better=strictly_better)
 
 
+# A --time-budget. It's only checked between rounds, and only once there's a style to keep, so a
+# run always ends with the best style that it found.
+class TimeBudget(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.ran_out = False
+
+    def is_over(self, tracker):
+        if self.deadline is None or tracker.accepted_score is None or time.time() < self.deadline:
+            return False
+        if not self.ran_out:
+            self.ran_out = True
+            print(ansi.wrap(ANSI['W'], "WARNING: The --time-budget ran out; keeping the best style so far."))
+        return True
+
+def write_checkpoint(path, tracker):
+    """Write the best style so far to 'path', so that it's there even if the run is stopped. It's
+    written to the side and renamed into place, so the file is never only partly written."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write('# The best style that fit-clang-format has found so far; its score is %s.\n' % print_score(tracker.accepted_score))
+        tracker.get_best_style().dump(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+def get_round_gain(before, after):
+    """How much a round lowered the first element of the score, as a fraction of what it was."""
+    if before is None or after is None or before[0] <= 0:
+        return 0.0
+    return max(0.0, float(before[0] - after[0]) / before[0])
+
+def order_keys_by_impact(tracker, keys, budget):
+    """Returns the keys, the ones that are expected to improve the score the most first.
+
+    A key's expected gain is its average gain in the rounds of earlier runs (of this project if it
+    has any, or else of every project in the cache). With --eval-mode memory, the keys without any
+    history are probed: the current style and each of the key's options are scored on a small
+    sample of the files, and the gain of the best one on the sample is the guess. Probing stops
+    after a quarter of the time that's left, so most of it goes to the rounds themselves. Ties,
+    and the keys that can't be guessed, keep the usual order.
+    """
+    expected = {}
+    if score_database:
+        history = score_database.get_key_stats(base_path, args.diff_score)
+        for key in keys:
+            if key in history:
+                rounds, gain = history[key]
+                expected[key] = gain / rounds
+
+    unknown = [key for key in keys if key not in expected]
+    if unknown and hasattr(project, 'get_known_file_stats'):
+        sample = context['race_order'][:RACE_MIN_FILES]
+        # When the sample has every file, its scores are the full scores, so the rounds can reuse them.
+        full = len(sample) == len(context['files_to_format'])
+        now = time.time()
+        probe_deadline = now + (budget.deadline - now) / 4 if budget.deadline is not None else None
+        probed = 0
+        for key in unknown:
+            if probe_deadline is not None and time.time() >= probe_deadline:
+                break
+            pending = []
+            for style in [tracker.accepted_style] + [tracker.get_candidate_style(option) for option in styles.STYLE_OPTIONS[key].options]:
+                style_hash = score_cache.get_hash_for_style(style)
+                if style_hash not in (h for h, _ in pending):
+                    pending.append((style_hash, style))
+            scores = util.map_on_pool(pool, lambda (style_hash, style): evaluate(project, style, style_hash, filenames=sample), pending)
+            if full:
+                for (_, style), score in zip(pending, scores):
+                    score_cache.register_score(style, score)
+            expected[key] = get_round_gain(scores[0], min(scores))
+            probed += 1
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Probed %d keys with no history on %d files." % (probed, len(sample))))
+
+    ordered = sorted(keys, key=lambda key: -expected.get(key, 0.0))
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Trying the keys in order of their expected gain: %s" % ', '.join(
+            '%s (%.2f%%)' % (key, 100 * expected[key]) for key in ordered if expected.get(key))))
+    return ordered
+
+def get_changed_files(before_style, after_styles):
+    """The files whose stats under any of 'after_styles' are known to differ from their stats under
+    'before_style', or None if the stats under 'before_style' aren't known (eg, outside of memory
+    mode). Files that an 'after_style' never got to (eg, because it was abandoned) don't count."""
+    if before_style is None or not hasattr(project, 'get_known_file_stats'):
+        return None
+    before = project.get_known_file_stats(score_cache.get_hash_for_style(before_style))
+    if before is None:
+        return None
+    changed = set()
+    for style in after_styles:
+        after = project.get_known_file_stats(score_cache.get_hash_for_style(style), partial=True)
+        changed.update(f for f, stats in after.iteritems() if stats != before[f])
+    return changed
+
+class DirtyKeys(object):
+    """Tracks which keys of the final stage could pick a different value if their round ran again.
+
+    Each round notes the files that the key's values changed (its relevant files). Once another key
+    changes the style, a key is dirty if any of its relevant files came out differently. A key whose
+    relevant files aren't known is dirty after any change.
+    """
+    def __init__(self):
+        self.relevant = {}
+        self.dirty = set()
+
+    def visit(self, key, before_style, candidate_styles):
+        relevant = get_changed_files(before_style, candidate_styles)
+        if relevant is None or self.relevant.get(key, set()) is None:
+            self.relevant[key] = None
+        else:
+            self.relevant[key] = self.relevant.get(key, set()) | relevant
+        self.dirty.discard(key)
+
+    def accept(self, key, before_style, after_style):
+        changed = get_changed_files(before_style, [after_style])
+        for other, relevant in self.relevant.iteritems():
+            if other != key and (changed is None or relevant is None or relevant & changed):
+                self.dirty.add(other)
+
+def fit(tracker, skip_keys, inapplicable_keys, budget=None, checkpoint=None, converge=False):
+    """Run the whole search, from the base styles to each key, and return the best style.
+
+    With a TimeBudget, the keys of the final stage are tried in order of their expected gain, and
+    the search stops once it runs out. With a checkpoint path, the best style so far is written
+    there every time it gets better. With 'converge', the keys whose best value may have changed
+    since their round are tried again, pass after pass, until none are left.
+    """
+    if budget is None:
+        budget = TimeBudget(None)
+
+    def accepted(changed):
+        if changed and checkpoint:
+            write_checkpoint(checkpoint, tracker)
+        return changed
+
+    if 'BasedOnStyle' in skip_keys:
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Skipping tests for BasedOnStyle."))
+    elif not budget.is_over(tracker):
+        print("")
+        print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing base styles to see which seems to fit best."))
+        accepted(search(tracker, project, [
+            {'BasedOnStyle': base} for base in styles.BASE_STYLE_TYPES
+        ], strictly_better=False))
+        print(" :: best option so far: %r" % (tracker,))
+
+    if 'IndentWidth' in skip_keys:
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Skipping tests for IndentWidth."))
+    elif not budget.is_over(tracker):
+        print("")
+        print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing for indent width"))
+        accepted(search(tracker, project, styles.STYLE_OPTIONS['IndentWidth'].options, strictly_better=False))
+        print(" :: best option so far: %r" % (tracker,))
+
+
+    if 'UseTab' in skip_keys:
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Skipping tests for UseTab."))
+    elif not budget.is_over(tracker):
+        print("")
+        print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing for tabs vs spaces"))
+        accepted(search(tracker, project, styles.STYLE_OPTIONS['UseTab'].options, strictly_better=False))
+        print(" :: best option so far: %r" % (tracker,))
+
+
+    if 'BasedOnStyle' in skip_keys:
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Skipping re-test of base style."))
+    elif not budget.is_over(tracker):
+        print("")
+        print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Retesting the bases using indent and tabs"))
+        accepted(search(tracker, project, [
+            {'BasedOnStyle': base} for base in styles.BASE_STYLE_TYPES
+        ]))
+        print(" :: best option so far: %r" % (tracker,))
+
+
+    print("")
+    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Final stage: tweak each key"))
+
+    dirty_keys = DirtyKeys()
+
+    def tweak_key(key):
+        before_style = tracker.accepted_style
+        options = styles.STYLE_OPTIONS[key].options
+        if isinstance(styles.STYLE_OPTIONS[key], styles.StyleRange):
+            with tracing.span('narrow', key=key):
+                options = narrow_range(tracker, project, styles.STYLE_OPTIONS[key])
+        candidate_styles = [tracker.get_candidate_style(option) for option in options]
+        changed = accepted(search(tracker, project, options=options, key=key))
+        if converge:
+            dirty_keys.visit(key, before_style, candidate_styles)
+            if changed:
+                dirty_keys.accept(key, before_style, tracker.accepted_style)
+        if changed:
+            print(" :: UPDATED! Added a new option that improved the score.")
+        else:
+            print(ansi.wrap(ANSI['SKIP'], " :: Skipped. No option improved the fit."))
+        return changed
+
+    keys = styles.STYLE_OPTIONS.keys()
+    if budget.deadline is not None and not budget.is_over(tracker):
+        keys = order_keys_by_impact(tracker, [key for key in keys if key not in inapplicable_keys and key not in skip_keys], budget) + \
+            [key for key in keys if key in inapplicable_keys or key in skip_keys]
+
+    for index, key in enumerate(keys):
+        if budget.is_over(tracker):
+            left = [k for k in keys[index:] if k not in inapplicable_keys and k not in skip_keys]
+            print(ansi.wrap(ANSI['SKIP'], " :: Didn't get to %d keys: %s" % (len(left), ', '.join(left))))
+            break
+        print(ansi.wrap(ANSI['HEADER'], " == Round %d of %d: %r" % (index, len(styles.STYLE_OPTIONS), key)))
+        if key in inapplicable_keys:
+            print(ansi.wrap(ANSI['SKIP'], "   (skipped; the files have no %s)" % inapplicable_keys[key]))
+            continue
+        if key in skip_keys:
+            print(ansi.wrap(ANSI['SKIP'], "   (skipped)"))
+            continue
+
+        score_before = tracker.accepted_score
+        tweak_key(key)
+        if score_database:
+            score_database.register_key_round(base_path, args.diff_score, key, get_round_gain(score_before, tracker.accepted_score))
+
+    # The later passes only cover the keys that are dirty, in the same order as the first pass.
+    pass_number = 1
+    while converge and dirty_keys.dirty and not budget.is_over(tracker):
+        pass_number += 1
+        pass_keys = [key for key in keys if key in dirty_keys.dirty]
+        print("")
+        print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Pass %d: retrying the %d keys whose files changed since their round" % (pass_number, len(pass_keys))))
+        for index, key in enumerate(pass_keys):
+            if budget.is_over(tracker):
+                break
+            print(ansi.wrap(ANSI['HEADER'], " == Round %d of %d: %r" % (index, len(pass_keys), key)))
+            tweak_key(key)
+    if converge and not dirty_keys.dirty:
+        print(" :: Converged after %d passes." % pass_number)
+
+
+    print("")
+    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " DONE!"))
+    return tracker.get_best_style()
+
+
 ######## START #########
 
 context = {
@@ -227,12 +777,20 @@ context = {
     'ansi': ANSI,
     'verbosity': 0,
     'files_to_format': [],
+    'format_jobs': 1,
+    'format_pool': None,
+    'prune_files': False,
+    'race': False,
+    'diff_engine': 'git',
+    'race_order': [],
 }
 
 verbosity = 0
 
 # Sentinels to help with argparse arguments.
 CWD = util.SentinelWithHelpText('CWD')
+SCRATCH_DIR = util.SentinelWithHelpText('/dev/shm, or the temp directory if there is none')
+CHECKPOINT = util.SentinelWithHelpText("a file in the --cache-dir with --time-budget (and removed once the style is applied), otherwise none")
 
 ## Set up context from args
 parser = argparse.ArgumentParser(
@@ -246,24 +804,57 @@ basic_args.add_argument('--git', type=str, metavar='PATH', default=CWD, help='th
 basic_args.add_argument('--include-extensions', type=str, metavar='EXTENSIONS', default='h,hpp,c,cc,cpp,m,mm', help='add all files with these extensions, comma-delimited')
 basic_args.add_argument('-I', '--include-path', type=str, metavar='PATH', action='append', help='path/file to search for files; can be specified multiple times')
 basic_args.add_argument('-E', '--exclude-path', type=str, metavar='PATH', action='append', help='path/file to exclude from the analysis; can be specified multiple times. Exclusions apply after include filters.')
+basic_args.add_argument('--manifest', type=str, metavar='PATH', help="use the files listed in PATH (eg, from --distill) instead of finding them by --include-extensions")
 basic_args.add_argument('--randomly-limit', type=int, metavar='NUM', help='randomly select NUM files; files will be selected according to relative frequence by extension (min 1)')
+sample_args = basic_args.add_mutually_exclusive_group()
+sample_args.add_argument('--sample-size', type=sample.parse_size, metavar='SIZE', help="randomly select files that add up to about SIZE bytes (eg, 500K or 2M), from every top-level directory and extension in proportion to their size")
+sample_args.add_argument('--sample-seconds', type=float, metavar='SECONDS', help="randomly select files that clang-format takes about SECONDS of CPU time to format, like --sample-size")
+basic_args.add_argument('--seed', type=int, metavar='NUM', default=0, help='the seed for --randomly-limit, --sample-size and --sample-seconds, and for the samples that --race and the --time-budget probe score first, so that the same files are picked every time')
 basic_args.add_argument('--diff-score', choices=sorted(git.diff_options.keys()), default=git.diff_default, help='the scoring algorithm to use')
+basic_args.add_argument('--eval-mode', choices=['memory', 'scratch', 'worktree'], default='memory', help="how to evaluate each candidate style: 'memory' pipes the files through clang-format and never touches the repo; 'scratch' formats copies of the files in place, in a scratch directory outside of the repo; 'worktree' formats the files in place and puts back the ones that changed after each one")
+basic_args.add_argument('--scratch-dir', type=str, metavar='PATH', default=SCRATCH_DIR, help="where to put the copies of the files for --eval-mode scratch")
+basic_args.add_argument('--diff-engine', choices=['git', 'native'], default='git', help="how to diff the formatted files: 'git' runs 'git diff'; 'native' finds the same stats in-process, without running git (needs --eval-mode memory)")
+basic_args.add_argument('--prune-files', action='store_true', help="when tweaking each key, only format the files that the first values of the key changed (faster, but may miss files that only other values change; needs --eval-mode memory)")
+
+basic_args.add_argument('--save-matrix', type=str, metavar='PATH', help="save the counts of every file under every candidate style to PATH (a numpy .npz file), so that '--rerank' can rank them with another --diff-score later (needs numpy and --eval-mode memory)")
+basic_args.add_argument('--time-budget', type=float, metavar='SECONDS', help="stop searching after about SECONDS (checked between rounds) and apply the best style so far; the keys that are expected to help the most are tried first")
+basic_args.add_argument('--checkpoint', type=str, metavar='PATH', default=CHECKPOINT, help="write the best style so far to PATH every time it gets better, so that it's there even if the run is stopped")
+basic_args.add_argument('--converge', action='store_true', help="after the final stage, try the keys again whose files came out differently since their round, until no key changes")
+basic_args.add_argument('--race', action='store_true', help="score the options of each round on a small sample of the files first, and only keep the better half for a sample twice as big, until one is left (faster, but may drop an option that only wins on the full set; needs --eval-mode memory)")
 
 basic_args = parser.add_argument_group('Style Options')
 basic_args.add_argument('--style-base', choices=sorted(styles.BASE_STYLE_TYPES), help='force a specific base style')
 basic_args.add_argument('--force-style', type=str, metavar='YAML', help='force a starting style (removes these keys from further consideration)')
 basic_args.add_argument('--skip-option', type=str, action='append', metavar='PATH', help='skip a style option key with this name; can be specified multiple times')
+basic_args.add_argument('--infer', action='store_true', help="read the indent width, tabs and pointer alignment right out of the files, and only search for the ones that aren't clear-cut (needs numpy)")
+basic_args.add_argument('--no-scan', action='store_true', help="don't skip the style option keys for constructs (eg, 'switch' or '@property') that never show up in the files")
+
+basic_args = parser.add_argument_group('Re-ranking and distilling options')
+basic_args.add_argument('--rerank', type=str, metavar='PATH', help="rank the candidate styles in a '--save-matrix' file by --diff-score, without formatting anything, and stop")
+basic_args.add_argument('--rerank-weights', type=str, metavar='UNIT=WEIGHT,...', help="with '--rerank', rank by a weighted sum of the counts instead of --diff-score; the units are: %s" % ', '.join(git.COUNT_UNITS))
+basic_args.add_argument('--distill', type=str, metavar='PATH', help="find a small set of the files in a '--save-matrix' file that picks the same winner in every round of the search as all of them do (by --diff-score), write it to --manifest, and stop")
+
+basic_args = parser.add_argument_group('Daemon options')
+basic_args.add_argument('--serve', type=str, metavar='SOCKET', help="instead of searching once, keep the files and scores in memory and answer JSON-RPC requests (score_style, run_round, full_fit, status, shutdown) on the Unix socket SOCKET; the repo is never changed")
 
 basic_args = parser.add_argument_group('Environment options')
 basic_args.add_argument('--clang-format-path', type=str, metavar='PATH', help='the path to the clang-format tool')
+basic_args.add_argument('-j', '--jobs', type=int, metavar='N', default=1, help='evaluate up to N candidate styles at the same time (0 means one per CPU)')
+basic_args.add_argument('--format-jobs', type=int, metavar='N', help='run up to N clang-format processes for each candidate style (default: the CPUs left over after --jobs)')
+basic_args.add_argument('--cache-dir', type=str, metavar='PATH', default=database.default_cache_dir(), help='where to keep scores between runs')
+basic_args.add_argument('--cache-size', type=int, metavar='NUM', default=100000, help='the most scores to keep between runs; the least recently used ones are dropped first')
+basic_args.add_argument('--file-cache-size', type=int, metavar='NUM', default=10000000, help='the most single-file scores to keep between runs (used by --eval-mode memory)')
+basic_args.add_argument('--no-cache', action='store_true', help='do not read or write scores from earlier runs')
 
 output_args = parser.add_argument_group('Output options')
 output_args.add_argument('--verbose', '-v', action='count')
 output_args_ansi_group = output_args.add_mutually_exclusive_group()
 output_args_ansi_group.add_argument('--no-ansi', action='store_true', help='force disable ANSI colors')
 output_args_ansi_group.add_argument('--ansi',    action='store_true', help='force enable ANSI colors')
+output_args.add_argument('--profile', type=str, metavar='PATH', help="time each stage of every candidate style (clang-format, git diff, restoring the files, and so on), write a Chrome trace of it to PATH, and print a summary at the end")
 
 args = parser.parse_args()
+start_time = time.time()
 
 
 # Set up things that affect our logging.
@@ -281,6 +872,106 @@ if not use_ansi:
     for k in ANSI:
         ANSI[k] = ''
 
+# The profile is written out however the run ends, so an interrupted run can still be looked at.
+if args.profile:
+    tracing.enable()
+
+    def write_profile():
+        try:
+            tracing.profiler.write_trace(args.profile)
+        except IOError as e:
+            print(ansi.wrap(ANSI['W'], "WARNING: Couldn't write the profile to %r: %s" % (args.profile, e)))
+            return
+        print("")
+        print("Profile (the trace is in %r):" % args.profile)
+        for line in tracing.profiler.get_summary():
+            print("  " + line)
+    atexit.register(write_profile)
+
+# The candidates of a saved search can be re-ranked without the repo or clang-format.
+RERANK_TOP = 10
+
+if args.rerank:
+    if not matrix.available():
+        print(ansi.wrap(ANSI['E'], "ERROR: --rerank needs the 'numpy' module."))
+        sys.exit(RC_FAIL)
+    try:
+        score_matrix = matrix.load(args.rerank)
+        if args.rerank_weights:
+            weights = matrix.parse_weights(args.rerank_weights)
+            ranked = score_matrix.rank(lambda counts: matrix.score_weighted(counts, weights))
+            ranked_by = 'the weights %s' % ', '.join('%s=%g' % (unit, weights[unit]) for unit in sorted(weights))
+        else:
+            ranked = score_matrix.rank(matrix.SCORERS[args.diff_score])
+            ranked_by = repr(args.diff_score)
+    except (IOError, KeyError, ValueError) as e:
+        print(ansi.wrap(ANSI['E'], "ERROR: Couldn't re-rank %r: %s" % (args.rerank, e)))
+        sys.exit(RC_FAIL)
+
+    # A canonical string has a null for each key that the style leaves at the base style's value;
+    # styles that only differ by those are the same style, so only the first of them is shown.
+    def settings(canonical_string):
+        return dict((key, value) for key, value in yaml.load(canonical_string).iteritems() if value is not None)
+
+    print("Ranking the %d candidate styles over %d files in %r by %s:" % (len(score_matrix.styles), len(score_matrix.files), args.rerank, ranked_by))
+    best = settings(ranked[0][1])
+    shown = []
+    for score, style in ranked:
+        overrides = settings(style)
+        if overrides in shown:
+            continue
+        shown.append(overrides)
+
+        note = ''
+        if style == score_matrix.chosen:
+            note = ansi.wrap(ANSI['SKIP'], " (picked by the search with %r)" % score_matrix.scorer)
+        # Only show how each style differs from the best one.
+        changes = ', '.join(
+            '%s=%s' % (key, overrides[key] if key in overrides else '(default)')
+            for key in sorted(set(best).union(overrides)) if overrides.get(key) != best.get(key)
+        )
+        print("  %2d. %s: %s%s" % (len(shown), print_score(score), ansi.wrap(ANSI['STYLE_VALUE'], changes or 'best'), note))
+        if len(shown) == RERANK_TOP:
+            break
+
+    print("")
+    print("Best style:")
+    print("============")
+    print(yaml.safe_dump(best, default_flow_style=False).strip())
+    print("============")
+    sys.exit(RC_SUCCESS)
+
+# A saved search can be distilled to a manifest of the files that matter, also without the repo.
+if args.distill:
+    if not distill.available():
+        print(ansi.wrap(ANSI['E'], "ERROR: --distill needs the 'numpy' module."))
+        sys.exit(RC_FAIL)
+    if not args.manifest:
+        print(ansi.wrap(ANSI['E'], "ERROR: --distill needs a --manifest to write the files to."))
+        sys.exit(RC_FAIL)
+
+    def print_progress(filename, agreed, rounds):
+        if verbosity:
+            print(ansi.wrap(ANSI['V'], "[V] Added %r; %d of %d rounds pick the same winner." % (filename, agreed, rounds)))
+
+    try:
+        score_matrix = matrix.load(args.distill)
+        files, agreed, rounds = distill.distill(score_matrix, args.diff_score, progress=print_progress)
+    except (IOError, KeyError, ValueError) as e:
+        print(ansi.wrap(ANSI['E'], "ERROR: Couldn't distill %r: %s" % (args.distill, e)))
+        sys.exit(RC_FAIL)
+
+    summary = "%d of %d files pick the same winner as all of them in %d of %d rounds by %r" % (len(files), len(score_matrix.files), agreed, rounds, args.diff_score)
+    distill.write_manifest(args.manifest, files, comments=[
+        "Written by fit-clang-format --distill %s" % args.distill,
+        summary,
+    ])
+    print("Distilled %r: %s." % (args.distill, summary))
+    print("Wrote them to %r; use '--manifest %s' to search with just those files." % (args.manifest, args.manifest))
+    if agreed < rounds:
+        print(ansi.wrap(ANSI['W'], "WARNING: Some rounds pick a different winner with only these files, so the search may find a different style."))
+    sys.exit(RC_SUCCESS)
+
 
 # Find clang-format binary.
 if args.clang_format_path is None:
@@ -292,10 +983,13 @@ if args.clang_format_path is None:
         sys.exit(RC_FAIL)
 else:
     # They may pass in either the executable itself, or the path that contains the executable.
+    # Commands run from inside the repo, so make sure a relative path still points at the right place.
     if util.check([args.clang_format_path, '-version']):
         context['clang-format'] = args.clang_format_path
+        if os.sep in context['clang-format']:
+            context['clang-format'] = os.path.abspath(context['clang-format'])
     elif util.check([os.path.join(args.clang_format_path, 'clang-format'), '-version']):
-        context['clang-format'] = os.path.join(args.clang_format_path, 'clang-format')
+        context['clang-format'] = os.path.abspath(os.path.join(args.clang_format_path, 'clang-format'))
     else:
         print(ansi.wrap(ANSI['E'], "ERROR: Unable to find clang-format binary at path %r" % args.clang_format_path))
         sys.exit(RC_FAIL)
@@ -318,9 +1012,24 @@ project = git.GitProject(path=base_path, context=context)
 
 
 # Build the list of files to test.
-context['files_to_format'] = project.get_files(extensions=args.include_extensions.split(','))
-if verbosity:
-    print(ansi.wrap(ANSI['V'], "[V] Matched %d files from --include-extensions matches." % len(context['files_to_format'])))
+if args.manifest:
+    try:
+        context['files_to_format'] = distill.read_manifest(args.manifest)
+    except IOError as e:
+        print(ansi.wrap(ANSI['E'], "ERROR: Couldn't read the manifest %r: %s" % (args.manifest, e)))
+        sys.exit(RC_FAIL)
+    missing = [f for f in context['files_to_format'] if not os.path.isfile(os.path.join(base_path, f))]
+    if missing:
+        print(ansi.wrap(ANSI['W'], "WARNING: %d of the files in the manifest don't exist any more; skipping them." % len(missing)))
+        context['files_to_format'] = [f for f in context['files_to_format'] if f not in missing]
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Read %d files from the manifest %r." % (len(context['files_to_format']), args.manifest)))
+else:
+    file_list_cache = None if args.no_cache else database.FileListCache(args.cache_dir)
+    with tracing.span('find files'):
+        context['files_to_format'] = project.get_files(extensions=args.include_extensions.split(','), cache=file_list_cache)
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Matched %d files from --include-extensions matches." % len(context['files_to_format'])))
 
 if args.include_path is None:
     pass
@@ -373,8 +1082,10 @@ else:
         files_by_extension.setdefault(ext, []).append(f)
 
     context['files_to_format'] = []
-    for files in files_by_extension.itervalues():
-        random.shuffle(files)
+    rng = random.Random(args.seed)
+    for ext in sorted(files_by_extension):
+        files = files_by_extension[ext]
+        rng.shuffle(files)
 
         # Always keep one of each file for sure.
         context['files_to_format'].append(files.pop())
@@ -391,6 +1102,29 @@ else:
 
     context['files_to_format'].sort()
 
+# Sample by size (or time), so that a few big files don't crowd out the rest of the project.
+if args.sample_size or args.sample_seconds:
+    files = context['files_to_format']
+    sizes = dict((f, os.path.getsize(os.path.join(base_path, f))) for f in files)
+    with tracing.span('measure costs'):
+        cost_model = sample.measure_costs(context['clang-format'], base_path, files, sizes, random.Random(args.seed))
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Measured the cost of clang-format: %r" % cost_model))
+
+    if args.sample_size:
+        costs, budget = sizes, args.sample_size
+    else:
+        costs = dict((f, cost_model.get_cost(sizes[f])) for f in files)
+        budget = args.sample_seconds
+    context['files_to_format'] = sample.stratified_sample(files, costs, budget, random.Random(args.seed))
+
+    kept = context['files_to_format']
+    print("Sampled %d of %d files (%s of %s) from %d groups of top-level directory and extension." % (
+        len(kept), len(files), sample.format_size(sum(sizes[f] for f in kept)), sample.format_size(sum(sizes.itervalues())),
+        len(set(sample.get_stratum(f) for f in kept))))
+    print("Each candidate style will take about %.1f seconds of clang-format CPU time (the whole project would take %.1f)." % (
+        sum(cost_model.get_cost(sizes[f]) for f in kept), sum(cost_model.get_cost(sizes[f]) for f in files)))
+
 
 if not context['files_to_format']:
     print(ansi.wrap(ANSI['E'], "ERROR: No files found to format."))
@@ -404,6 +1138,83 @@ differ = git.diff_options[args.diff_score]()
 if verbosity:
     print(ansi.wrap(ANSI['V'], "[V] Using diff strategy %r." % args.diff_score))
 
+# To save the matrix, each file's diff is measured in every unit, and the differ scores from those.
+# The candidates go in it in the order that they were first seen.
+matrix_candidates = None
+matrix_candidates_order = []
+matrix_rounds = []
+if args.save_matrix:
+    if args.serve:
+        print(ansi.wrap(ANSI['W'], "WARNING: --save-matrix doesn't work with --serve; not saving it."))
+    elif not matrix.available():
+        print(ansi.wrap(ANSI['W'], "WARNING: --save-matrix needs the 'numpy' module; not saving it."))
+    elif args.eval_mode != 'memory':
+        print(ansi.wrap(ANSI['W'], "WARNING: --save-matrix only works with --eval-mode memory; not saving it."))
+    else:
+        differ = git.GitRepoDifferCounts(differ)
+        matrix_candidates = {}
+
+# Pick how each candidate gets evaluated.
+if args.eval_mode == 'memory':
+    project = memory.InMemoryProject(git_project=project, context=context)
+elif args.eval_mode == 'scratch':
+    scratch_dir = scratch.default_scratch_dir() if args.scratch_dir is SCRATCH_DIR else os.path.abspath(args.scratch_dir)
+    if not os.path.isdir(scratch_dir):
+        print(ansi.wrap(ANSI['E'], "ERROR: The scratch directory %r does not exist." % scratch_dir))
+        sys.exit(RC_FAIL)
+    project = scratch.ScratchProject(git_project=project, context=context, scratch_dir=scratch_dir)
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Formatting copies of the files under %r." % scratch_dir))
+context['prune_files'] = args.prune_files
+if args.prune_files and args.eval_mode != 'memory':
+    print(ansi.wrap(ANSI['W'], "WARNING: --prune-files only works with --eval-mode memory; ignoring it."))
+context['diff_engine'] = args.diff_engine if args.eval_mode == 'memory' else 'git'
+if args.diff_engine == 'native' and args.eval_mode != 'memory':
+    print(ansi.wrap(ANSI['W'], "WARNING: --diff-engine native only works with --eval-mode memory; using git."))
+context['race'] = args.race and args.eval_mode == 'memory'
+if args.race and args.eval_mode != 'memory':
+    print(ansi.wrap(ANSI['W'], "WARNING: --race only works with --eval-mode memory; ignoring it."))
+# The samples are the start of one shuffle of the files (by --seed), so each bigger sample re-uses
+# the stats of the smaller ones.
+context['race_order'] = list(context['files_to_format'])
+random.Random(args.seed).shuffle(context['race_order'])
+# Every candidate in the matrix needs the stats of every file, so none of them can be abandoned,
+# dropped by a race, or scored on only some of the files.
+context['full_scores'] = matrix_candidates is not None
+if context['full_scores'] and (context['race'] or context['prune_files']):
+    print(ansi.wrap(ANSI['W'], "WARNING: --save-matrix scores every candidate on every file; ignoring --race and --prune-files."))
+    context['race'] = context['prune_files'] = False
+if verbosity:
+    print(ansi.wrap(ANSI['V'], "[V] Using evaluation mode %r." % args.eval_mode))
+
+# Set up the workers.
+jobs = args.jobs
+if jobs == 0:
+    jobs = multiprocessing.cpu_count()
+if jobs < 0:
+    print(ansi.wrap(ANSI['E'], "ERROR: --jobs should not be a negative number."))
+    sys.exit(RC_FAIL)
+if jobs > 1:
+    # The work happens in clang-format and git subprocesses, so threads are enough.
+    pool = multiprocessing.pool.ThreadPool(jobs)
+else:
+    pool = None
+if verbosity:
+    print(ansi.wrap(ANSI['V'], "[V] Evaluating up to %d candidate styles at a time." % jobs))
+
+if args.format_jobs is None:
+    context['format_jobs'] = max(1, multiprocessing.cpu_count() // jobs)
+elif args.format_jobs <= 0:
+    print(ansi.wrap(ANSI['E'], "ERROR: --format-jobs should be a positive number."))
+    sys.exit(RC_FAIL)
+else:
+    context['format_jobs'] = args.format_jobs
+if context['format_jobs'] > 1:
+    # Shared by all the candidate workers; it's a separate pool so that they can wait on it.
+    context['format_pool'] = multiprocessing.pool.ThreadPool(context['format_jobs'] * jobs)
+if verbosity:
+    print(ansi.wrap(ANSI['V'], "[V] Running up to %d clang-format processes for each candidate style." % context['format_jobs']))
+
 
 # Check for starting styles
 init_style = {}
@@ -420,6 +1231,46 @@ if args.style_base:
 skip_keys = set(init_style.keys())
 if args.skip_option:
     skip_keys.update(args.skip_option)
+
+# Skip the keys for constructs that the files never use.
+inapplicable_keys = {}
+if not args.no_scan:
+    with tracing.span('scan'):
+        construct_counts = scan.count_constructs(base_path, context['files_to_format'])
+    if verbosity > VERBOSITY_MEDIUM:
+        for construct, count in construct_counts:
+            print(ansi.wrap(ANSI['V'], "[VV] Found %d matches for %s." % (count, construct.description)))
+
+    inapplicable_keys = dict(
+        (key, description) for key, description in scan.find_inapplicable_keys(construct_counts).iteritems()
+        if key not in skip_keys
+    )
+    if inapplicable_keys:
+        print("Skipping %d style option keys for constructs that the files don't use:" % len(inapplicable_keys))
+        for key in sorted(inapplicable_keys):
+            print("   %s (no %s)" % (ansi.wrap(ANSI['STYLE_KEY'], key), inapplicable_keys[key]))
+    skip_keys.update(inapplicable_keys)
+
+# Read the basics right out of the files, and only search for the ones that aren't clear-cut.
+if args.infer:
+    if not infer.available():
+        print(ansi.wrap(ANSI['W'], "WARNING: --infer needs the 'numpy' module; searching for every key instead."))
+    else:
+        with tracing.span('infer'):
+            guesses = infer.infer_basics(base_path, context['files_to_format'], styles.STYLE_OPTIONS)
+        print("Inferring style option keys from the files:")
+        for guess in guesses:
+            if guess.key in skip_keys:
+                continue
+            if guess.is_confident():
+                print("   %s: %s (%s)" % (ansi.wrap(ANSI['STYLE_KEY'], guess.key),
+                    ', '.join(ansi.wrap(ANSI['STYLE_VALUE'], '%s=%s' % (k, v)) for k, v in sorted(guess.overrides.iteritems())),
+                    guess.description))
+                init_style.update(guess.overrides)
+                skip_keys.add(guess.key)
+            else:
+                print(ansi.wrap(ANSI['SKIP'], "   %s: not clear-cut; will search (%s)" % (guess.key, guess.description)))
+
 if verbosity and skip_keys:
     print(ansi.wrap(ANSI['V'], "[V] Will skip consideration of a total of %d style option keys." % len(skip_keys)))
 
@@ -427,7 +1278,32 @@ if verbosity and skip_keys:
 ## Go!
 
 # Sanity-check that we can proceed.
-project.check()
+with tracing.span('prepare'):
+    project.check()
+    project.prepare_workers(jobs)
+atexit.register(project.remove_workers)
+
+# Set up the score cache.
+if args.no_cache:
+    score_database = None
+    score_cache = ScoreCache()
+else:
+    score_database = database.ScoreDatabase(path=os.path.join(args.cache_dir, 'scores.sqlite'),
+        max_entries=args.cache_size, max_file_entries=args.file_cache_size)
+    atexit.register(score_database.close)
+    clang_format_version = util.run([context['clang-format'], '-version']).strip()
+    score_cache = ScoreCache(database=score_database, database_key={
+        'clang_format': clang_format_version,
+        'files': project.get_content_hash(),
+        'scorer': args.diff_score,
+    })
+    if args.eval_mode == 'memory':
+        project.file_stats_cache = database.FileStatsCache(blobs=project.get_blobs(), database=score_database, database_key={
+            'clang_format': clang_format_version,
+            'scorer': 'counts' if matrix_candidates is not None else args.diff_score,
+        })
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Keeping scores between runs in %r." % score_database.path))
 
 if init_style:
     base_style = styles.Style(style=init_style)
@@ -436,69 +1312,164 @@ else:
     tracker = CandidateTracker()
 
 
-if 'BasedOnStyle' in skip_keys:
-    if verbosity:
-        print(ansi.wrap(ANSI['V'], "[V] Skipping tests for BasedOnStyle."))
-else:
-    print("")
-    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing base styles to see which seems to fit best."))
-    search(tracker, project, [
-        {'BasedOnStyle': base} for base in styles.BASE_STYLE_TYPES
-    ], strictly_better=False)
-    print(" :: best option so far: %r" % (tracker,))
-
-if 'IndentWidth' in skip_keys:
-    if verbosity:
-        print(ansi.wrap(ANSI['V'], "[V] Skipping tests for IndentWidth."))
-else:
-    print("")
-    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing for indent width"))
-    search(tracker, project, styles.STYLE_OPTIONS['IndentWidth'].options, strictly_better=False)
-    print(" :: best option so far: %r" % (tracker,))
+# Answer requests until a client asks to shut down. The files, the base styles and the scores are
+# only found once, so a score that's already known comes back right away.
+if args.serve:
+    # The values that each key can have in a request: {key: (StyleRange or None, [values])}. A key
+    # is known if it's in any of the options (eg, 'TabWidth' is only in the options of 'UseTab').
+    request_values = {}
+    for option_set in styles.STYLE_OPTIONS.itervalues():
+        for option in option_set.options:
+            for option_key, option_value in option.iteritems():
+                key_range = option_set if isinstance(option_set, styles.StyleRange) and option_set.name == option_key else None
+                entry = request_values.setdefault(option_key, [None, []])
+                entry[0] = entry[0] or key_range
+                if option_value not in entry[1]:
+                    entry[1].append(option_value)
+
+    def is_integer(value):
+        return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+    def check_style_options(style, name):
+        """Raise a RequestError that names the first key or value that the search doesn't know."""
+        if not isinstance(style, dict):
+            raise daemon.RequestError(daemon.INVALID_PARAMS, "%r should be an object of style options" % name)
+        for key, value in sorted(style.iteritems()):
+            if key == 'BasedOnStyle':
+                if value not in styles.BASE_STYLE_TYPES:
+                    raise daemon.RequestError(daemon.INVALID_PARAMS, "BasedOnStyle should be one of %s" % ', '.join(styles.BASE_STYLE_TYPES))
+                continue
+            if key not in request_values:
+                raise daemon.RequestError(daemon.INVALID_PARAMS, "Unknown style option %s in '%s'" % (json.dumps(key), name))
+            key_range, values = request_values[key]
+            if key_range is not None:
+                if is_integer(value) and (key_range.low <= value <= key_range.high or value in values):
+                    continue
+                raise daemon.RequestError(daemon.INVALID_PARAMS, "%s should be a whole number from %d to %d%s, not %s" % (
+                    key, key_range.low, key_range.high, ''.join(' or %d' % v for v in values if not key_range.low <= v <= key_range.high), json.dumps(value)))
+            if all(is_integer(v) for v in values):
+                if is_integer(value) and value >= 0:
+                    continue
+                raise daemon.RequestError(daemon.INVALID_PARAMS, "%s should be a whole number that isn't negative, not %s" % (key, json.dumps(value)))
+            if value not in values:
+                raise daemon.RequestError(daemon.INVALID_PARAMS, "%s should be one of %s, not %s" % (
+                    key, ', '.join(json.dumps(v) for v in values), json.dumps(value)))
+
+    # A style without a base is based on LLVM, like clang-format's own default.
+    def request_style(params, name='style'):
+        value = params.get(name, {})
+        check_style_options(value, name)
+        value = dict(value)
+        value.setdefault('BasedOnStyle', 'LLVM')
+        return styles.Style(style=value)
+
+    def get_full_score(style):
+        score = score_cache.get_score(style)
+        if score is None:
+            score = evaluate(project, style, score_cache.get_hash_for_style(style))
+            score_cache.register_score(style=style, score=score)
+        return score
+
+    def score_style_request(params):
+        """{style} -> {score, cached}"""
+        style = request_style(params)
+        cached = score_cache.get_score(style) is not None
+        return {'score': get_full_score(style), 'cached': cached}
+
+    def run_round_request(params):
+        """{style, key, options (optional)} -> {changed, style, score, candidates: [{option, score}]}
+        Like a round of the final stage: tries each option of the key on top of the style, and
+        returns the better style if one of them beats it. Scores that weren't found in full are null."""
+        style = request_style(params)
+        key = params.get('key')
+        options = params.get('options')
+        if options is None:
+            if key not in styles.STYLE_OPTIONS:
+                raise daemon.RequestError(daemon.INVALID_PARAMS, "'key' should be a style option (or give the 'options' to try)")
+            options = styles.STYLE_OPTIONS[key].options
+        elif not isinstance(options, list) or not all(isinstance(option, dict) for option in options):
+            raise daemon.RequestError(daemon.INVALID_PARAMS, "'options' should be a list of objects of style options")
+        else:
+            for option in options:
+                check_style_options(option, 'options')
+
+        round_tracker = CandidateTracker(style)
+        round_tracker.accepted_score = get_full_score(style)
+        if 'options' not in params and isinstance(styles.STYLE_OPTIONS[key], styles.StyleRange):
+            options = narrow_range(round_tracker, project, styles.STYLE_OPTIONS[key])
+        changed = search(round_tracker, project, options, key=key if key in styles.STYLE_OPTIONS else None)
+        return {
+            'changed': changed,
+            'style': round_tracker.get_best_style().style_dict,
+            'score': round_tracker.accepted_score,
+            'candidates': [{'option': option, 'score': score_cache.get_score(style.style_with_overrides(option))} for option in options],
+        }
+
+    def full_fit_request(params):
+        """{style (optional), skip_keys (optional)} -> {style, score}
+        The whole search, without applying the result; the style defaults to the one from the command line."""
+        fit_style = init_style
+        fit_skip_keys = set(skip_keys)
+        if 'style' in params:
+            fit_style = request_style(params).style_dict
+            fit_skip_keys = set(params['style']) | set(args.skip_option or [])
+        request_skip_keys = params.get('skip_keys', [])
+        if not isinstance(request_skip_keys, list) or not all(isinstance(key, basestring) and key in styles.STYLE_OPTIONS for key in request_skip_keys):
+            raise daemon.RequestError(daemon.INVALID_PARAMS, "'skip_keys' should be a list of style options")
+        fit_skip_keys.update(request_skip_keys)
+        fit_tracker = CandidateTracker(styles.Style(style=dict(fit_style)) if fit_style else None)
+        best = fit(fit_tracker, fit_skip_keys, inapplicable_keys, converge=args.converge)
+        return {'style': best.style_dict, 'score': fit_tracker.accepted_score}
+
+    def status_request(params):
+        return {
+            'path': base_path,
+            'files': len(context['files_to_format']),
+            'scorer': args.diff_score,
+            'eval_mode': args.eval_mode,
+            'known_scores': len(score_cache.cache),
+        }
+
+    def print_ready():
+        print("Serving %d files on %r; send a 'shutdown' request to stop." % (len(context['files_to_format']), args.serve))
+        sys.stdout.flush()
 
+    try:
+        daemon.serve(args.serve, {
+            'score_style': score_style_request,
+            'run_round': run_round_request,
+            'full_fit': full_fit_request,
+            'status': status_request,
+        }, ready=print_ready)
+    except (ValueError, socket.error) as e:
+        print(ansi.wrap(ANSI['E'], "ERROR: Couldn't serve on %r: %s" % (args.serve, e)))
+        sys.exit(RC_FAIL)
+    sys.exit(RC_SUCCESS)
 
-if 'UseTab' in skip_keys:
-    if verbosity:
-        print(ansi.wrap(ANSI['V'], "[V] Skipping tests for UseTab."))
+# Set up the --time-budget. It counts from the start, so finding and reading the files counts too.
+if args.time_budget is not None:
+    if args.time_budget <= 0:
+        print(ansi.wrap(ANSI['E'], "ERROR: The --time-budget should be a positive number of seconds."))
+        sys.exit(RC_FAIL)
+    budget = TimeBudget(start_time + args.time_budget)
 else:
-    print("")
-    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Testing for tabs vs spaces"))
-    search(tracker, project, styles.STYLE_OPTIONS['UseTab'].options, strictly_better=False)
-    print(" :: best option so far: %r" % (tracker,))
-
-
-if 'BasedOnStyle' in skip_keys:
-    if verbosity:
-        print(ansi.wrap(ANSI['V'], "[V] Skipping re-test of base style."))
+    budget = TimeBudget(None)
+
+# The default checkpoint goes in the cache directory, one for each repo, so that the repo isn't
+# touched until the style is applied.
+if args.checkpoint is CHECKPOINT:
+    checkpoint = None
+    if args.time_budget is not None and not args.no_cache:
+        checkpoint = os.path.join(args.cache_dir, 'best-%s.clang-format' % hashlib.sha1(os.path.realpath(base_path)).hexdigest())
+        if not os.path.isdir(args.cache_dir):
+            os.makedirs(args.cache_dir)
+        print("Writing the best style so far to %r, in case the run is stopped." % checkpoint)
 else:
-    print("")
-    print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Retesting the bases using indent and tabs"))
-    search(tracker, project, [
-        {'BasedOnStyle': base} for base in styles.BASE_STYLE_TYPES
-    ])
-    print(" :: best option so far: %r" % (tracker,))
-
-
-print("")
-print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " Final stage: tweak each key"))
-
-for index, key in enumerate(styles.STYLE_OPTIONS.keys()):
-    print(ansi.wrap(ANSI['HEADER'], " == Round %d of %d: %r" % (index, len(styles.STYLE_OPTIONS), key)))
-    if key in skip_keys:
-        print(ansi.wrap(ANSI['SKIP'], "   (skipped)"))
-        continue
-
-    changed = search(tracker, project, options=styles.STYLE_OPTIONS[key].options)
-    if changed:
-        print(" :: UPDATED! Added a new option that improved the score.")
-    else:
-        print(ansi.wrap(ANSI['SKIP'], " :: Skipped. No option improved the fit."))
-
-
-print("")
-print(ansi.wrap(ANSI['ARROW'], "=>") + ansi.wrap(ANSI['HEADER'], " DONE!"))
+    checkpoint = args.checkpoint
+    if verbosity:
+        print(ansi.wrap(ANSI['V'], "[V] Writing the best style so far to %r." % checkpoint))
 
-style = tracker.get_best_style()
+style = fit(tracker, skip_keys, inapplicable_keys, budget=budget, checkpoint=checkpoint, converge=args.converge)
 
 print("")
 print("Final style:")
@@ -507,14 +1478,44 @@ style.dump(sys.stdout)
 print("============")
 print("")
 
+if matrix_candidates is not None:
+    # Every candidate of every round goes in. Styles that were scored by an earlier run may not have
+    # their counts yet.
+    stats_by_style = []
+    for style_hash in matrix_candidates_order:
+        candidate = matrix_candidates[style_hash]
+        stats = project.get_known_file_stats(style_hash)
+        if stats is None:
+            evaluate(project, candidate, style_hash)
+            stats = project.get_known_file_stats(style_hash)
+        stats_by_style.append((style_hash, stats))
+
+    score_matrix = matrix.build(context['files_to_format'], stats_by_style)
+    score_matrix.scorer = args.diff_score
+    indexes = dict((style_hash, index) for index, (style_hash, _) in enumerate(stats_by_style))
+    for members in matrix_rounds:
+        members = sorted(set(indexes[h] for h in members if h in indexes))
+        if len(members) > 1:
+            score_matrix.rounds.append(members)
+    score_matrix.chosen = score_cache.get_hash_for_style(style)
+    score_matrix.save(args.save_matrix)
+    print("Saved the counts of %d candidate styles over %d files to %r." % (len(stats_by_style), len(context['files_to_format']), args.save_matrix))
+    print("")
+
 print("Applying style to the project..")
 
 
-full_style_dict = yaml.load(
-    util.run([context['clang-format'], '-dump-config', '-style', yaml.dump({'BasedOnStyle':base})])
-)
-full_style = styles.Style(base=style.base, style=full_style_dict)
-project.apply_style(style.style_with_defaults_hidden(full_style))
+with tracing.span('apply'):
+    # The defaults of the style's own base are listed (commented out) under the options it sets.
+    full_style_dict = yaml.load(
+        util.run([context['clang-format'], '-dump-config', '-style', yaml.dump({'BasedOnStyle': style.base or 'LLVM'})])
+    )
+    full_style = styles.Style(base=style.base, style=full_style_dict)
+    project.apply_style(style.style_with_defaults_hidden(full_style))
+
+# The default checkpoint is only there in case the run is stopped; the applied style replaces it.
+if args.checkpoint is CHECKPOINT and checkpoint and os.path.exists(checkpoint):
+    os.remove(checkpoint)
 
 print("""
 The .clang-format file is now in your project and the style has been applied but not committed.
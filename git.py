@@ -1,32 +1,112 @@
 import math
 import os
+import Queue
+import shutil
 import subprocess
+import tempfile
+import time
+import tracing
 import util
 
 linear_scalar = lambda x: int(x)
 log_scalar = lambda x: math.log(1+int(x))
 
+# Adds up the terms for each file. The sum is exact, so it doesn't depend on the order of the files.
+total = math.fsum
+
+# The settings that every diff runs with, whatever the user's git config says. The native diff engine
+# (xdiff.py) only does what git does by default, and the differs need the 'a/' and 'b/' prefixes.
+# Paths are only quoted if they have to be (see quote_path), not for every byte over 0x7f.
+DIFF_CONFIG = [
+    '-c', 'diff.algorithm=myers', '-c', 'diff.indentHeuristic=true', '-c', 'core.quotePath=false',
+    '-c', 'diff.noprefix=false', '-c', 'diff.mnemonicPrefix=false',
+]
+
+# The raw counts that GitRepoDifferCounts finds for each file, in order. Every differ's stats can be
+# read off of them, so a file only has to be diffed once to score it every way.
+COUNT_UNITS = (
+    'line_insertions', 'line_deletions', 'line_files',  # from --numstat; 'files' is 1 if the file is in the diff
+    'word_insertions', 'word_deletions',                # runs of changed characters, from --word-diff
+    'char_insertions', 'char_deletions',                # the length of each run (with its +/-)
+    'log_char_insertions', 'log_char_deletions',        # the sum of log(1+length) of each run
+    'word_files',
+)
+
 class GitRepoDifferBase(object):
-    def run_git_diff(self, project, options):
-        raise NotImplemented
+    # The git-diff options for the output that 'get_file_stats' reads.
+    diff_format = []
 
-    # Returns a "score" of the diff, which is an arbitrary object such that, given two of them,
-    # the "smaller" diff is the one that is less-than the other.
-    def calculate_diff(self, project, ignore_spaces=False):
-        options = []
+    # The COUNT_UNITS that the stats are made of: (insertions, deletions, files).
+    count_units = None
+
+    def get_diff_options(self, ignore_spaces=False):
+        options = list(self.diff_format)
 
         if ignore_spaces:
             options.extend(['--ignore-blank-lines', '--ignore-space-at-eol'])
 
-        return self.run_git_diff(project, options)
+        return options
+
+    # Reads the lines of git-diff's output and returns a dict of {filename: (insertions, deletions)}
+    # for each file in the diff, counted in whatever units this differ uses.
+    # The lines can come from any iterable (eg, util.run_lines), and each one is only looked at once,
+    # so the whole diff never has to be in memory.
+    def get_file_stats(self, lines):
+        raise NotImplementedError
 
-class GitRepoDifferRankLines(GitRepoDifferBase):
-    def run_git_diff(self, project, options):
-        options = options or []
-        diff = project.git_repo.run(['diff', '--shortstat'] + options)
+    # Diffs with 'diff(options)', which returns the lines of git-diff's output, and returns the stats
+    # of each file.
+    def diff_file_stats(self, diff, ignore_spaces=False):
+        return self.get_file_stats(diff(self.get_diff_options(ignore_spaces)))
 
-        # Get the numbers from something like "3 files changed, 148 insertions(+), 15 deletions(-)"
-        files, insertions, deletions = [int(x.split()[0]) for x in diff.split(',')]
+    # Returns the stats of a file from its counts (see GitRepoDifferCounts), or None if the file
+    # isn't in this differ's diff.
+    def stats_from_counts(self, counts):
+        insertions, deletions, files = [counts[COUNT_UNITS.index(unit)] for unit in self.count_units]
+        if not files:
+            return None
+        return (insertions, deletions)
+
+    # Returns a "score" of the diff, which is an arbitrary object such that, given two of them,
+    # the "smaller" diff is the one that is less-than the other.
+    # The score only depends on the stats of each file, so a project's score can be put together
+    # from stats that were found one file at a time.
+    def score(self, stats):
+        raise NotImplementedError
+
+    # Returns a lower bound on the first element of the score, from the stats of only some of the
+    # files. The first element of every score is a sum of terms that are never negative, so it can
+    # only grow as more files are added. Once it's bigger than the first element of another score,
+    # the full score is sure to be bigger than that score.
+    def score_lower_bound(self, stats):
+        return self.score(stats)[0]
+
+    # The project is anything with a 'diff(options)' method that returns the lines of git-diff's output.
+    def calculate_diff(self, project, ignore_spaces=False):
+        with tracing.span('diff'):
+            stats = self.diff_file_stats(project.diff, ignore_spaces)
+        return self.score(stats.values())
+
+class GitRepoDifferNumstat(GitRepoDifferBase):
+    diff_format = ['--numstat']
+    count_units = ('line_insertions', 'line_deletions', 'line_files')
+
+    def get_file_stats(self, lines):
+        # Each line is "insertions<TAB>deletions<TAB>filename"
+        stats = {}
+        for line in lines:
+            if not line:
+                continue
+            insertions, deletions, filename = line.split('\t', 2)
+            stats[unquote_path(filename)] = (int(insertions), int(deletions))
+        return stats
+
+class GitRepoDifferRankLines(GitRepoDifferNumstat):
+    def score(self, stats):
+        stats = list(stats)
+        files = len(stats)
+        insertions = sum(s[0] for s in stats)
+        deletions = sum(s[1] for s in stats)
 
         # To rank a "better" git-diff, we order by:
         #  1. the fewest lines changed (either added or deleted)
@@ -36,26 +116,20 @@ class GitRepoDifferRankLines(GitRepoDifferBase):
         return (max(insertions, deletions), files, abs(insertions-deletions))
 
 class GitRepoDifferRankFiles(GitRepoDifferRankLines):
-    def run_git_diff(self, project, options):
-        result = GitRepoDifferRankLines.run_git_diff(self, project, options)
+    def score(self, stats):
+        result = GitRepoDifferRankLines.score(self, stats)
         return result[1], result[0], result[2]
 
-class GitRepoDifferByFile(GitRepoDifferBase):
+class GitRepoDifferByFile(GitRepoDifferNumstat):
     def __init__(self):
         super(GitRepoDifferByFile, self).__init__()
         self.scalar = linear_scalar
 
-    def run_git_diff(self, project, options):
-        options = options or []
-
-        diff = project.git_repo.run(['diff', '--numstat'] + options)
-
-        # turn into list of (insertions, deletions, filename)
-        stats = [line.split('\t') for line in diff.split('\n') if line]
-
+    def score(self, stats):
+        stats = list(stats)
         files = len(stats)
-        maxid = sum(max(self.scalar(s[0]),self.scalar(s[1])) for s in stats)
-        delta = sum(abs(self.scalar(s[0])-self.scalar(s[1])) for s in stats)
+        maxid = total(max(self.scalar(s[0]),self.scalar(s[1])) for s in stats)
+        delta = total(abs(self.scalar(s[0])-self.scalar(s[1])) for s in stats)
 
         # To rank a "better" git-diff, we order by:
         #  1. the fewest lines changed (either added or deleted)
@@ -71,38 +145,116 @@ class GitRepoDifferByFileLog(GitRepoDifferByFile):
 
 
 class GitRepoDifferWords(GitRepoDifferBase):
+    diff_format = ['--word-diff=porcelain', '-U0', '--word-diff-regex=.']
+    count_units = ('char_insertions', 'char_deletions', 'word_files')
+
     def __init__(self):
         super(GitRepoDifferWords, self).__init__()
         self.scalar = linear_scalar
 
-    def run_git_diff(self, project, options):
-        options = options or []
-        diff = project.git_repo.run(['diff', '--word-diff=porcelain', '-U0', '--word-diff-regex=.'] + options)
-
+    def get_file_stats(self, lines):
         delta = {}
         cur_file = None
-        for line in diff.splitlines():
-            if line[0]=='+':
+        for line in lines:
+            if line[:1]=='+':
                 delta[cur_file]['+'] += self.scalar(len(line))
-            elif line[0]=='-':
+            elif line[:1]=='-':
                 delta[cur_file]['-'] += self.scalar(len(line))
             elif line.startswith('diff'):
-                cur_file = line
+                cur_file = diff_header_filename(line)
                 delta[cur_file] = {'+': 0, '-': 0}
 
-        head = list(delta.itervalues())[0]
+        return dict((f, (s['+'], s['-'])) for f, s in delta.iteritems())
 
-        files = len(delta)
-        maxid = sum(max(self.scalar(s['+']),self.scalar(s['-'])) for s in delta.itervalues())
-        delta = sum(abs(self.scalar(s['+'])-self.scalar(s['-'])) for s in delta.itervalues())
+    def score(self, stats):
+        stats = list(stats)
+        files = len(stats)
+        maxid = total(max(self.scalar(s[0]),self.scalar(s[1])) for s in stats)
+        delta = total(abs(self.scalar(s[0])-self.scalar(s[1])) for s in stats)
 
         return (maxid, files, delta)
 
 class GitRepoDifferWordsLog(GitRepoDifferWords):
+    count_units = ('log_char_insertions', 'log_char_deletions', 'word_files')
+
     def __init__(self):
         super(GitRepoDifferWordsLog, self).__init__()
         self.scalar = log_scalar
 
+# Finds the raw counts of each file in every one of the COUNT_UNITS, and scores them with another
+# differ. The scores are the same as that differ's, but the stats can be kept to score the same
+# files with any other differ later on (see matrix.py).
+class GitRepoDifferCounts(GitRepoDifferBase):
+    def __init__(self, differ):
+        super(GitRepoDifferCounts, self).__init__()
+        self.differ = differ
+
+    def diff_file_stats(self, diff, ignore_spaces=False):
+        lines = GitRepoDifferNumstat()
+        words = GitRepoDifferWords()
+        line_stats = lines.get_file_stats(diff(lines.get_diff_options(ignore_spaces)))
+        word_stats = self.get_word_counts(diff(words.get_diff_options(ignore_spaces)))
+
+        stats = {}
+        for filename in set(line_stats).union(word_stats):
+            insertions, deletions = line_stats.get(filename, (0, 0))
+            counts = word_stats.get(filename, (0, 0, 0, 0, 0, 0, 0))
+            stats[filename] = (insertions, deletions, int(filename in line_stats)) + counts
+        return stats
+
+    def get_word_counts(self, lines):
+        # Counted just like GitRepoDifferWords and GitRepoDifferWordsLog do, so that the sums match.
+        counts = {}
+        cur_file = None
+        for line in lines:
+            if line[:1]=='+':
+                counts[cur_file][0] += 1
+                counts[cur_file][2] += linear_scalar(len(line))
+                counts[cur_file][4] += log_scalar(len(line))
+            elif line[:1]=='-':
+                counts[cur_file][1] += 1
+                counts[cur_file][3] += linear_scalar(len(line))
+                counts[cur_file][5] += log_scalar(len(line))
+            elif line.startswith('diff'):
+                cur_file = diff_header_filename(line)
+                counts[cur_file] = [0, 0, 0, 0, 0, 0, 1]
+        return dict((f, tuple(c)) for f, c in counts.iteritems())
+
+    def differ_stats(self, stats):
+        for counts in stats:
+            s = self.differ.stats_from_counts(counts)
+            if s is not None:
+                yield s
+
+    def score(self, stats):
+        return self.differ.score(self.differ_stats(stats))
+
+    def score_lower_bound(self, stats):
+        return self.differ.score_lower_bound(self.differ_stats(stats))
+
+# Get the filename out of a line like "diff --git a/foo.cc b/foo.cc" (or "diff --git "a/a\tb.cc" "b/a\tb.cc"").
+# The diff never renames, so both names are the same and the line can be split in half.
+def diff_header_filename(line):
+    names = line[len('diff --git '):]
+    return unquote_path(names[:(len(names) - 1) // 2])[len('a/'):]
+
+# git quotes a path with a double quote, a backslash or a control character in it like a C string,
+# eg "a\tb.cc", with the control characters that have no escape of their own in octal.
+C_ESCAPES = {'\a': 'a', '\b': 'b', '\t': 't', '\n': 'n', '\v': 'v', '\f': 'f', '\r': 'r', '"': '"', '\\': '\\'}
+
+def quote_path(path):
+    if not any(c in C_ESCAPES or c < ' ' or c == '\x7f' for c in path):
+        return path
+    return '"%s"' % ''.join(
+        '\\' + C_ESCAPES[c] if c in C_ESCAPES else '\\%03o' % ord(c) if c < ' ' or c == '\x7f' else c
+        for c in path
+    )
+
+def unquote_path(path):
+    if not path.startswith('"'):
+        return path
+    return path[1:-1].decode('string_escape')
+
 diff_options = {
     'words': GitRepoDifferWords,
     'words-log': GitRepoDifferWordsLog,
@@ -113,11 +265,82 @@ diff_options = {
 }
 diff_default = 'words-log'
 
+# The name of the file that apply_style writes the style to.
+STYLE_FILE = '.clang-format'
+
+# The modes of the index entries that are plain files; the others are symlinks and submodules.
+REGULAR_FILE_MODES = ('100644', '100755')
+
+# The files of a repo as they were before any temporary style was applied, so that the style can
+# be undone by rewriting just the files that it changed, without asking git.
+# A file is only read again if its size, mtime or inode changed since the snapshot; but a file that
+# was written in the last couple of seconds could be written again without its mtime changing (on
+# file systems with coarse timestamps), so its contents are always checked, like git's "racy" files.
+class FileSnapshot(object):
+    RACY_SECONDS = 2
+
+    def __init__(self, path, originals):
+        self.path = path
+        self.originals = originals
+        self.stats = dict((filename, self.stat(filename)) for filename in originals)
+
+        # Whether a temporary style may have changed the files since they were last restored.
+        self.dirty = False
+
+        style_path = os.path.join(self.path, STYLE_FILE)
+        self.style_file = None
+        if os.path.exists(style_path):
+            with open(style_path, 'rb') as f:
+                self.style_file = f.read()
+
+    def stat(self, filename):
+        st = os.stat(os.path.join(self.path, filename))
+        if time.time() - st.st_mtime < self.RACY_SECONDS:
+            return None
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    def restore(self):
+        """Rewrite the files that changed since the snapshot, and return how many there were."""
+        with tracing.span('restore'):
+            return self.restore_files()
+
+    def restore_files(self):
+        changed = 0
+        for filename, text in self.originals.iteritems():
+            known = self.stats[filename]
+            if known is not None and self.stat(filename) == known:
+                continue
+
+            path = os.path.join(self.path, filename)
+            with open(path, 'rb') as f:
+                current = f.read()
+            tracing.count('bytes read', len(current))
+            if current != text:
+                with open(path, 'wb') as f:
+                    f.write(text)
+                tracing.count('bytes written', len(text))
+                changed += 1
+            self.stats[filename] = self.stat(filename)
+
+        style_path = os.path.join(self.path, STYLE_FILE)
+        if self.style_file is None:
+            if os.path.exists(style_path):
+                os.remove(style_path)
+        else:
+            with open(style_path, 'wb') as f:
+                f.write(self.style_file)
+
+        self.dirty = False
+        return changed
+
 class GitRepo(object):
     def __init__(self, path, context):
         self.path = path
         self.context = context
 
+        # Set by GitProject, to undo temporary styles.
+        self.snapshot = None
+
     # Helpers to run git commands.
 
     def check(self, subcommand):
@@ -125,7 +348,7 @@ class GitRepo(object):
         if isinstance(subcommand, basestring):
             subcommand = [subcommand]
         try:
-            util.run(['git'] + subcommand, check=True)
+            util.run(['git'] + subcommand, check=True, cwd=self.path)
             return True
         except:
             return False
@@ -134,28 +357,66 @@ class GitRepo(object):
         """Run a git command and return stdio. Throws if exit code is nonzero."""
         if isinstance(subcommand, basestring):
             subcommand = [subcommand]
-        return util.run(['git'] + subcommand)
+        return util.run(['git'] + subcommand, cwd=self.path)
+
+    def run_lines(self, subcommand):
+        """Run a git command and yield the lines of stdio as they come. Throws if exit code is nonzero."""
+        if isinstance(subcommand, basestring):
+            subcommand = [subcommand]
+        return util.run_lines(['git'] + subcommand, cwd=self.path)
 
     # Canned helpers.
 
     def is_dirty(self):
-        return (
-            not self.check('diff-index --quiet --cached HEAD'.split())  # staged changes
-         or not self.check('diff-files --quiet'.split())                # unstaged changes
-        )
+        with tracing.span('is-dirty'):
+            # Files that were rewritten with the same contents only look changed until the index is refreshed.
+            self.check('update-index -q --refresh'.split())
+            return (
+                not self.check('diff-index --quiet --cached HEAD'.split())  # staged changes
+             or not self.check('diff-files --quiet'.split())                # unstaged changes
+            )
 
     def reset(self):
-        return self.check('reset --hard'.split())
+        with tracing.span('reset'):
+            return self.check('reset --hard'.split())
+
+    def get_files(self, extensions):
+        """The plain files in the index (below this path) with one of the extensions."""
+        pathspecs = ['*.%s' % extension for extension in extensions]
+        files = set()
+        output, _ = util.run(['git', 'ls-files', '-z', '--stage', '--'] + pathspecs, include_stderr=True, cwd=self.path)
+        for entry in output.split('\0'):
+            if not entry:
+                continue
+            # Each entry is "mode object stage<TAB>filename"; a file with conflicts has an entry for each stage.
+            info, filename = entry.split('\t', 1)
+            if info.split(' ', 1)[0] in REGULAR_FILE_MODES:
+                files.add(filename)
+        return sorted(files)
+
+    def get_index_key(self):
+        """Something that changes whenever the files in the index might: HEAD, and the index's size and mtime."""
+        # Quietly, since a repo without any commits has no HEAD.
+        output, _ = util.run(['git', 'rev-parse', 'HEAD', '--git-path', 'index'], include_stderr=True, cwd=self.path)
+        head, index_path = output.splitlines()
+        st = os.stat(os.path.join(self.path, index_path))
+        return '%s %d %r' % (head, st.st_size, st.st_mtime)
 
     # API
 
     def apply_style(self, style):
         # Write out the style file.
-        with open(os.path.join(self.path, '.clang-format'), 'wb') as clang_format_style_file:
+        with open(os.path.join(self.path, STYLE_FILE), 'wb') as clang_format_style_file:
             style.dump(clang_format_style_file)
 
-        # Restyle all the files.
-        util.run([self.context['clang-format'], '-style=file', '-i'] + self.context['files_to_format'])
+        # Restyle all the files, a few shards at a time. The shards are balanced by size since the
+        # time clang-format takes depends on how much code there is, not on how many files.
+        command = [self.context['clang-format'], '-style=file', '-i']
+        files = self.context['files_to_format']
+        sizes = dict((f, os.path.getsize(os.path.join(self.path, f))) for f in files)
+        shards = util.split_into_shards(files, sizes, count=self.context['format_jobs'], base_command=command)
+        with tracing.span('format', files=len(files)):
+            util.map_on_pool(self.context['format_pool'], lambda shard: util.run(command + shard, cwd=self.path), shards)
 
 # A model of a project managed by a git repo.
 class GitProject(object):
@@ -164,6 +425,15 @@ class GitProject(object):
         self.context = context
         self.git_repo = GitRepo(path=path, context=context)
 
+        # The repos that are free to have a temporary style applied. With more than one worker,
+        # the extra ones are scratch worktrees so that each worker formats its own copy of the files.
+        self.idle_repos = Queue.Queue()
+        self.idle_repos.put(self.git_repo)
+        self.worktree_dir = None
+
+        # The contents of the files to format, as they were when the search started.
+        self.originals = None
+
     # API
 
     def apply_style(self, style):
@@ -172,13 +442,72 @@ class GitProject(object):
         self.git_repo.apply_style(style)
 
     def apply_temporary_style(self, style):
-        if self.git_repo.is_dirty():
-            raise ValueError("git repo is not clean")
-
+        if self.originals is None:
+            self.load()
         return self.create_styled_repo_context(style)
 
-    def get_files(self, extensions):
-        return util.get_files_with_extensions(self.path, extensions)
+    def score_style(self, style, style_hash, differ, ignore_spaces=False):
+        with self.apply_temporary_style(style) as styled_project:
+            return differ.calculate_diff(styled_project, ignore_spaces=ignore_spaces)
+
+    def prepare_workers(self, count):
+        """Set up enough worktrees so that 'count' temporary styles can be applied at the same time."""
+        if self.originals is None:
+            self.load()
+        if count <= 1 or self.worktree_dir:
+            return
+
+        self.worktree_dir = tempfile.mkdtemp(prefix='fit-clang-format-worktrees-')
+        for index in range(1, count):
+            path = os.path.join(self.worktree_dir, str(index))
+            self.git_repo.run(['worktree', 'add', '--detach', path, 'HEAD'])
+
+            # The search may include files that git doesn't track.
+            for filename in self.context['files_to_format']:
+                if not os.path.exists(os.path.join(path, filename)):
+                    if not os.path.isdir(os.path.dirname(os.path.join(path, filename))):
+                        os.makedirs(os.path.dirname(os.path.join(path, filename)))
+                    shutil.copy2(os.path.join(self.path, filename), os.path.join(path, filename))
+
+            git_repo = GitRepo(path=path, context=self.context)
+            git_repo.snapshot = FileSnapshot(path, self.originals)
+            self.idle_repos.put(git_repo)
+
+    def remove_workers(self):
+        if not self.worktree_dir:
+            return
+
+        shutil.rmtree(self.worktree_dir, ignore_errors=True)
+        self.git_repo.check(['worktree', 'prune'])
+        self.worktree_dir = None
+
+    def get_files(self, extensions, cache=None):
+        """The files that git tracks with one of the extensions; so ignored files and the files in
+        submodules are never included. 'cache' is a database.FileListCache for the list."""
+        try:
+            key = self.git_repo.get_index_key() + ' ' + ','.join(sorted(extensions))
+        except (ValueError, OSError):
+            # Not a git repo, or a repo without any commits yet.
+            key = None
+
+        files = cache.get_files(self.path, key) if cache and key else None
+        if files is None:
+            try:
+                files = self.git_repo.get_files(extensions)
+            except ValueError:
+                return util.get_files_with_extensions(self.path, extensions)
+            if cache and key:
+                cache.register_files(self.path, key, files)
+
+        # The index still lists the files that were deleted from the working tree (which check() then
+        # reports as changes), and there's nothing to read for them.
+        return [f for f in files if os.path.isfile(os.path.join(self.path, f))]
+
+    def get_content_hash(self):
+        """A hash of the names and contents of all of the files to format."""
+        if self.originals is None:
+            self.load()
+        return util.hash_file_contents(self.originals)
 
     def check(self):
         if not os.path.exists(os.path.join(self.path, '.git')):
@@ -188,20 +517,50 @@ class GitProject(object):
 
     # Helpers
 
+    def load(self):
+        """Read the files to format, and take a snapshot of the repo to restore after each temporary style."""
+        self.originals = {}
+        for filename in self.context['files_to_format']:
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                self.originals[filename] = f.read()
+            tracing.count('bytes read', len(self.originals[filename]))
+        self.git_repo.snapshot = FileSnapshot(self.path, self.originals)
+
     def create_styled_repo_context(self, style):
         class StyledRepo(object):
-            def __init__(self, git_repo, style):
-                self.path = git_repo.path
-                self.context = git_repo.context
+            def __init__(self, idle_repos, style):
                 self.style = style
 
-                self.git_repo = git_repo
+                self.idle_repos = idle_repos
+                self.git_repo = None
 
             def __enter__(self):
-                self.git_repo.apply_style(self.style)
+                # Borrow a repo that no other worker is using. The repos were clean when the search
+                # started, and they're restored after each style, so git doesn't need to check.
+                git_repo = self.idle_repos.get()
+                if git_repo.snapshot.dirty:
+                    self.idle_repos.put(git_repo)
+                    raise ValueError("git repo is not clean")
+
+                self.git_repo = git_repo
+                self.path = git_repo.path
+                self.context = git_repo.context
+                try:
+                    self.git_repo.snapshot.dirty = True
+                    self.git_repo.apply_style(self.style)
+                except:
+                    self.__exit__(None, None, None)
+                    raise
                 return self
 
             def __exit__(self, exc_type, exc_val, exc_tb):
-                self.git_repo.reset()
+                try:
+                    self.git_repo.snapshot.restore()
+                finally:
+                    self.idle_repos.put(self.git_repo)
+                    self.git_repo = None
+
+            def diff(self, options):
+                return self.git_repo.run_lines(DIFF_CONFIG + ['diff'] + options)
 
-        return StyledRepo(self.git_repo, style)
+        return StyledRepo(self.idle_repos, style)
@@ -0,0 +1,127 @@
+import os
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How sure a guess has to be before the search for that key is skipped.
+MIN_SAMPLES = 20
+MIN_SHARE = 0.8
+
+# Declarations like "T* x", "T *x" and "T * x". They have to start a statement or a parameter, so
+# that multiplications mostly don't look like declarations, and the type can't be a keyword (eg,
+# "return *this;" or "delete *p;").
+POINTER_TYPE = r'\s*(?:const\s+)?(?!(?:return|delete|throw|case|else|sizeof|new|goto)\b)[A-Za-z_][\w:<>]*'
+# "a * b" is just as often a multiplication, so "T * x" only counts where a new statement starts
+# (not in a parameter list or after a line that continues an expression), and only if it declares
+# something.
+POINTER_PATTERNS = {
+    'Left':   re.compile(r'(?:^|[;{(,])' + POINTER_TYPE + r'\*+[ \t]+[A-Za-z_]\w*(?=\s*[;,=)\[])', re.MULTILINE),
+    'Right':  re.compile(r'(?:^|[;{(,])' + POINTER_TYPE + r'[ \t]+\*+[A-Za-z_]\w*(?=\s*[;,=)\[])', re.MULTILINE),
+    'Middle': re.compile(r'(?:\A|[;{}])' + POINTER_TYPE + r'[ \t]+\*+[ \t]+[A-Za-z_]\w*(?=\s*[;=\[])'),
+}
+
+def available():
+    return numpy is not None
+
+# A guess at the value of a style key, along with how much evidence there was for it.
+class Guess(object):
+    def __init__(self, key, overrides, samples, share, description):
+        self.key = key
+        self.overrides = overrides
+        self.samples = samples
+        self.share = share
+        self.description = description
+
+    def is_confident(self):
+        return self.overrides is not None and self.samples >= MIN_SAMPLES and self.share >= MIN_SHARE
+
+    def __repr__(self):
+        return 'Guess(key=%r, overrides=%r, samples=%d, share=%.02f)' % (self.key, self.overrides, self.samples, self.share)
+
+def measure(path, files):
+    """Collect the raw measurements from the files, as numpy arrays."""
+    block_indents = []   # (indent of a line that opens a block, indent of the line after it)
+    leading_tabs = []    # for each indented line, whether the indentation has a tab
+    pointers = dict((alignment, 0) for alignment in POINTER_PATTERNS)
+
+    for filename in files:
+        with open(os.path.join(path, filename), 'rb') as f:
+            text = f.read()
+
+        for alignment, pattern in POINTER_PATTERNS.iteritems():
+            pointers[alignment] += sum(1 for _ in pattern.finditer(text))
+
+        previous = None
+        for line in text.splitlines():
+            stripped = line.strip()
+            if not stripped:
+                continue
+
+            indent = line[:len(line) - len(line.lstrip())]
+            if indent:
+                leading_tabs.append('\t' in indent)
+
+            # Only space-indented code lines right after a '{' say anything about the indent width.
+            if stripped.startswith('#') or stripped.startswith('//') or stripped.startswith('*'):
+                continue
+            if previous is not None and previous.rstrip().endswith('{'):
+                previous_indent = previous[:len(previous) - len(previous.lstrip())]
+                if '\t' not in previous_indent and '\t' not in indent:
+                    block_indents.append((len(previous_indent), len(indent)))
+            previous = line
+
+    return {
+        'block_indents': numpy.array(block_indents, dtype=int).reshape(-1, 2),
+        'leading_tabs': numpy.array(leading_tabs, dtype=bool),
+        'pointers': pointers,
+    }
+
+def guess_indent_width(measurements, choices):
+    deltas = measurements['block_indents'][:, 1] - measurements['block_indents'][:, 0]
+    # Blocks that don't indent (eg, namespaces) don't say anything about the width.
+    deltas = deltas[deltas > 0]
+    if not len(deltas):
+        return Guess('IndentWidth', None, 0, 0.0, 'no indented blocks')
+
+    histogram = numpy.bincount(deltas)
+    width = int(numpy.argmax(histogram))
+    share = float(histogram[width]) / len(deltas)
+    overrides = {'IndentWidth': width} if {'IndentWidth': width} in choices else None
+    return Guess('IndentWidth', overrides, len(deltas), share, '%d of %d blocks indent by %d' % (histogram[width], len(deltas), width))
+
+def guess_use_tab(measurements, choices):
+    tabs = measurements['leading_tabs']
+    if not len(tabs):
+        return Guess('UseTab', None, 0, 0.0, 'no indented lines')
+
+    # Files indented with tabs could use any of several tab settings, so only spaces can be settled here.
+    spaces = int(len(tabs) - numpy.count_nonzero(tabs))
+    share = float(spaces) / len(tabs)
+    overrides = [option for option in choices if option.get('UseTab') == 'Never'][0]
+    return Guess('UseTab', overrides, len(tabs), share, '%d of %d indented lines use only spaces' % (spaces, len(tabs)))
+
+def guess_pointer_alignment(measurements, choices):
+    pointers = measurements['pointers']
+    samples = sum(pointers.values())
+    if not samples:
+        return Guess('PointerAlignment', None, 0, 0.0, 'no pointer declarations')
+
+    alignment = max(sorted(pointers), key=lambda a: pointers[a])
+    share = float(pointers[alignment]) / samples
+    overrides = {'PointerAlignment': alignment} if {'PointerAlignment': alignment} in choices else None
+    return Guess('PointerAlignment', overrides, samples, share, '%d of %d pointer declarations are %s-aligned' % (pointers[alignment], samples, alignment.lower()))
+
+# The keys that can be read right out of the source, and how to guess each one.
+GUESSERS = [
+    ('IndentWidth', guess_indent_width),
+    ('UseTab', guess_use_tab),
+    ('PointerAlignment', guess_pointer_alignment),
+]
+
+def infer_basics(path, files, style_options):
+    """Returns a Guess for each key in GUESSERS."""
+    measurements = measure(path, files)
+    return [guesser(measurements, style_options[key].options) for key, guesser in GUESSERS]
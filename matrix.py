@@ -0,0 +1,151 @@
+import git
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def available():
+    return numpy is not None
+
+# The counts of every file under every candidate style that a search scored: 'counts' is a
+# files x candidates x git.COUNT_UNITS array. Any differ's score of any of the candidates can be
+# found from it without formatting anything, so a search can be re-ranked another way.
+class ScoreMatrix(object):
+    def __init__(self, files, styles, counts, scorer=None, chosen=None, rounds=()):
+        self.files = list(files)
+        self.styles = list(styles)      # the canonical string of each candidate style
+        self.counts = counts
+        self.scorer = scorer            # the differ that the search used
+        self.chosen = chosen            # the canonical string of the style that it picked
+        self.rounds = list(rounds)      # for each round of the search, the indexes of the styles it compared
+
+    def save(self, path):
+        # numpy adds '.npz' to names that don't have it, so the file is written out by hand.
+        with open(path, 'wb') as f:
+            numpy.savez_compressed(f,
+                files=numpy.array(self.files),
+                styles=numpy.array(self.styles),
+                units=numpy.array(git.COUNT_UNITS),
+                counts=self.counts,
+                scorer=numpy.array(self.scorer or ''),
+                chosen=numpy.array(self.chosen or ''),
+                # The rounds have different sizes, so they're kept end to end, with where each one starts.
+                round_members=numpy.array([index for members in self.rounds for index in members], dtype=int),
+                round_starts=numpy.cumsum([0] + [len(members) for members in self.rounds]),
+            )
+
+    def rank(self, score_function):
+        """Returns [(score, style)] for every candidate, best first. Ties keep the order the search scored them in."""
+        scores = score_function(self.counts)
+        order = sorted(range(len(self.styles)), key=lambda index: scores[index])
+        return [(scores[index], self.styles[index]) for index in order]
+
+def load(path):
+    with open(path, 'rb') as f:
+        data = numpy.load(f)
+        units = tuple(str(u) for u in data['units'])
+        if units != git.COUNT_UNITS:
+            raise ValueError("%r was saved with different units (%s)" % (path, ', '.join(units)))
+        return ScoreMatrix(
+            files=[str(f) for f in data['files']],
+            styles=[str(s) for s in data['styles']],
+            counts=data['counts'],
+            scorer=str(data['scorer']) or None,
+            chosen=str(data['chosen']) or None,
+            rounds=load_rounds(data),
+        )
+
+def load_rounds(data):
+    if 'round_members' not in data.files:
+        return []
+    members, starts = data['round_members'].tolist(), data['round_starts'].tolist()
+    return [members[start:end] for start, end in zip(starts, starts[1:])]
+
+def build(files, stats_by_style):
+    """Put the matrix together from [(style, {filename: counts})], where the counts are None for a file
+    that isn't in the diff (see git.GitRepoDifferCounts)."""
+    counts = numpy.zeros((len(files), len(stats_by_style), len(git.COUNT_UNITS)))
+    for column, (_, stats) in enumerate(stats_by_style):
+        for row, filename in enumerate(files):
+            if stats[filename] is not None:
+                counts[row, column] = stats[filename]
+    return ScoreMatrix(files, [style for style, _ in stats_by_style], counts)
+
+# Scoring. Each differ's score is put together from terms that each file adds to some sums: there's a
+# files x candidates x 3 array of the terms, and a function that turns the sums into the score. So a
+# score can be found for any subset of the files, too (see distill.py).
+
+def unit_columns(counts, units):
+    """Returns a files x candidates array for each of the units."""
+    return [counts[:, :, git.COUNT_UNITS.index(unit)] for unit in units]
+
+def column_totals(terms):
+    """Sums each candidate's terms down the files, exactly (like git.total), so the totals are the same
+    values that the search's differ gave, whatever order the files are in."""
+    return numpy.apply_along_axis(git.total, 0, terms)
+
+def totals_terms(counts, differ):
+    # See git.GitRepoDifferRankLines; the sums are of the insertions, the deletions and the files.
+    return numpy.stack(unit_columns(counts, differ.count_units), axis=-1)
+
+def finish_lines(sums):
+    insertions, deletions, files = sums[..., 0], sums[..., 1], sums[..., 2]
+    return numpy.stack([numpy.maximum(insertions, deletions), files, numpy.abs(insertions - deletions)], axis=-1)
+
+def finish_files(sums):
+    return finish_lines(sums)[..., [1, 0, 2]]
+
+def linear_scalar(x):
+    return numpy.trunc(x)
+
+def log_scalar(x):
+    return numpy.log(1 + numpy.trunc(x))
+
+def by_file_terms(counts, differ, scalar):
+    # See git.GitRepoDifferByFile and git.GitRepoDifferWords. Files that aren't in the diff have no
+    # counts, so they add nothing but a zero to the sums.
+    insertions, deletions, files = unit_columns(counts, differ.count_units)
+    insertions, deletions = scalar(insertions), scalar(deletions)
+    return numpy.stack([numpy.maximum(insertions, deletions), files, numpy.abs(insertions - deletions)], axis=-1)
+
+def finish_by_file(sums):
+    return sums
+
+# For each differ: how to find the terms from the counts, and how to turn their sums into the score.
+TERMS = {
+    'lines':      (lambda counts: totals_terms(counts, git.GitRepoDifferRankLines()), finish_lines),
+    'files':      (lambda counts: totals_terms(counts, git.GitRepoDifferRankFiles()), finish_files),
+    'hybrid':     (lambda counts: by_file_terms(counts, git.GitRepoDifferByFile(), linear_scalar), finish_by_file),
+    'hybrid-log': (lambda counts: by_file_terms(counts, git.GitRepoDifferByFileLog(), log_scalar), finish_by_file),
+    'words':      (lambda counts: by_file_terms(counts, git.GitRepoDifferWords(), linear_scalar), finish_by_file),
+    'words-log':  (lambda counts: by_file_terms(counts, git.GitRepoDifferWordsLog(), log_scalar), finish_by_file),
+}
+
+def get_scores(counts, name):
+    """Returns the score of each candidate, with the same value that the differ would give it."""
+    get_terms, finish = TERMS[name]
+    return [tuple(score) for score in finish(column_totals(get_terms(counts))).tolist()]
+
+SCORERS = dict((name, lambda counts, name=name: get_scores(counts, name)) for name in TERMS)
+
+def parse_weights(text):
+    """Parses 'unit=weight,...' into {unit: weight}."""
+    weights = {}
+    for item in text.split(','):
+        unit, _, weight = item.partition('=')
+        unit = unit.strip()
+        if unit not in git.COUNT_UNITS:
+            raise ValueError("unknown unit %r; the units are: %s" % (unit, ', '.join(git.COUNT_UNITS)))
+        try:
+            weights[unit] = float(weight)
+        except ValueError:
+            raise ValueError("the weight of %r should be a number, not %r" % (unit, weight))
+    return weights
+
+def score_weighted(counts, weights):
+    """A score of (the weighted sum of the units, the files where any of them is non-zero)."""
+    units = sorted(weights)
+    terms = sum(weights[unit] * column for unit, column in zip(units, unit_columns(counts, units)))
+    files = (terms != 0).sum(axis=0)
+    return zip(column_totals(terms[:, :, None])[:, 0].tolist(), files.tolist())
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import database
+import git
+import tracing
+import util
+import xdiff
+import yaml
+
+# The scratch directories that hold the two sides of a 'git diff --no-index'.
+ORIGINAL_DIR = 'a'
+FORMATTED_DIR = 'b'
+
+def inline_style(style):
+    """Return the style as a string that can be passed to 'clang-format -style=...'"""
+    return yaml.safe_dump(style.style_dict, default_flow_style=True, width=float('inf')).strip()
+
+# 'git diff --no-index' names files by their path on disk, so the scratch directories show up in
+# the output. Rewrite the headers so that the lines of output look just like a 'git diff' of the repo.
+# A path that git quotes (see git.quote_path) has the quote before the 'a/'.
+def strip_scratch_dirs(lines):
+    in_header = False
+    for line in lines:
+        if line.startswith('diff --git '):
+            in_header = True
+            for quote in ('', '"'):
+                line = line.replace(' %sa/%s/' % (quote, ORIGINAL_DIR), ' %sa/' % quote, 1)
+                line = line.replace(' %sb/%s/' % (quote, FORMATTED_DIR), ' %sb/' % quote, 1)
+        elif line.startswith('@@'):
+            in_header = False
+        elif in_header and line.startswith(('--- a/%s/' % ORIGINAL_DIR, '--- "a/%s/' % ORIGINAL_DIR)):
+            line = line.replace('a/%s/' % ORIGINAL_DIR, 'a/', 1)
+        elif in_header and line.startswith(('+++ b/%s/' % FORMATTED_DIR, '+++ "b/%s/' % FORMATTED_DIR)):
+            line = line.replace('b/%s/' % FORMATTED_DIR, 'b/', 1)
+        elif line[:1].isdigit():
+            # From --numstat, which shows the two paths like a rename: "a/x.cc" and "b/x.cc" are
+            # "{a => b}/x.cc", and quoted ones are '"a/x\ty.cc" => "b/x\ty.cc"'.
+            insertions, deletions, paths = line.split('\t', 2)
+            if paths.startswith('{%s => %s}/' % (ORIGINAL_DIR, FORMATTED_DIR)):
+                paths = paths[len('{%s => %s}/' % (ORIGINAL_DIR, FORMATTED_DIR)):]
+            elif paths.startswith('"%s/' % ORIGINAL_DIR):
+                paths = '"' + paths[len('"%s/' % ORIGINAL_DIR):(len(paths) - len(' => ')) // 2]
+            line = '%s\t%s\t%s' % (insertions, deletions, paths)
+        yield line
+
+def no_index_diff(path, options, env=None):
+    """The lines of 'git diff --no-index' of the ORIGINAL_DIR and FORMATTED_DIR under 'path', as if
+    they were a diff of the repo."""
+    lines = util.run_lines(['git'] + git.DIFF_CONFIG + ['diff', '--no-index'] + options + [ORIGINAL_DIR, FORMATTED_DIR],
+        cwd=path, allowed_returncodes=(0, 1), env=env)
+    return strip_scratch_dirs(lines)
+
+# Raised by 'score_style' when a style is sure to score worse than its bound. The score only
+# covers the files that were scored before it gave up.
+class Abandoned(Exception):
+    def __init__(self, score, file_count):
+        super(Abandoned, self).__init__(score, file_count)
+        self.score = score
+        self.file_count = file_count
+
+# A model of a project whose files are read once and then formatted by piping them through
+# clang-format, so that evaluating a style never touches the working tree.
+# Only the final apply_style writes to the repo.
+# Each file is scored on its own, and the stats are kept by the file's blob hash, so a style only
+# formats the files that it hasn't seen before.
+class InMemoryProject(object):
+    def __init__(self, git_project, context):
+        self.path = git_project.path
+        self.context = context
+        self.git_project = git_project
+        self.originals = None
+        self.blobs = None
+        self.file_stats_cache = None
+
+        # The stats for each formatted output that has been diffed.
+        self.output_stats = {}
+
+    # API
+
+    def apply_style(self, style):
+        self.git_project.apply_style(style)
+
+    def apply_temporary_style(self, style, filenames=None):
+        if self.originals is None:
+            self.load()
+
+        return self.create_formatted_files_context(style, filenames or self.context['files_to_format'])
+
+    def score_style(self, style, style_hash, differ, ignore_spaces=False, filenames=None, fixed_stats=None, bound=None):
+        """Score the style. If 'filenames' is given, only those files are formatted and every other
+        file is assumed to have the stats in 'fixed_stats'.
+
+        If 'bound' is given, it's called for the score to beat (or None). The files are scored a few
+        at a time, and Abandoned is raised as soon as the score is sure to be bigger than that.
+        """
+        if self.originals is None:
+            self.load()
+
+        if filenames is None:
+            filenames = self.context['files_to_format']
+        stats = self.file_stats_cache.get_file_stats(style_hash, filenames)
+        missing = [f for f in filenames if f not in stats]
+        chunks = [missing] if missing else []
+        if bound:
+            chunks = self.split_into_chunks(missing)
+        for chunk in chunks:
+            if bound:
+                limit = bound()
+                if limit is not None and differ.score_lower_bound(s for s in stats.itervalues() if s is not None) > limit[0]:
+                    raise Abandoned(differ.score(s for s in stats.itervalues() if s is not None), len(stats))
+
+            new_stats = self.get_file_stats(style, differ, chunk, ignore_spaces=ignore_spaces)
+            self.file_stats_cache.register_file_stats(style_hash, new_stats)
+            stats.update(new_stats)
+
+        if fixed_stats:
+            stats, new_stats = dict(fixed_stats), stats
+            stats.update(new_stats)
+        return differ.score(s for s in stats.itervalues() if s is not None)
+
+    def split_into_chunks(self, filenames):
+        """Split the files into chunks that double in size, biggest files first.
+
+        The big files tend to have the biggest diffs, so a losing style shows it early; and the
+        chunks start small, so it doesn't format much before it does.
+        """
+        filenames = sorted(filenames, key=lambda f: (-len(self.originals[f]), f))
+        size = max(self.context['format_jobs'], len(filenames) // 16, 1)
+        chunks = []
+        while filenames:
+            chunks.append(filenames[:size])
+            filenames = filenames[size:]
+            size *= 2
+        return chunks
+
+    def get_known_file_stats(self, style_hash, partial=False):
+        """Returns the stats of every file for a style that has been scored, or None if it hasn't been.
+        With 'partial', returns the stats of whichever files are known (eg, of an abandoned style)."""
+        if self.originals is None:
+            self.load()
+
+        filenames = self.context['files_to_format']
+        stats = self.file_stats_cache.get_file_stats(style_hash, filenames)
+        if len(stats) < len(filenames) and not partial:
+            return None
+        return stats
+
+    def get_file_stats(self, style, differ, filenames, ignore_spaces=False):
+        """Format the files and return {filename: stats}; the stats are None for files that the diff doesn't include."""
+        stats = {}
+        with self.apply_temporary_style(style, filenames) as formatted_files:
+            # Most options don't change most files, so lots of styles end up with the same output
+            # for a file. Only diff the outputs that haven't been seen before.
+            memo_keys = {}
+            for filename in formatted_files.changed_files():
+                memo_keys[filename] = (differ.__class__.__name__, ignore_spaces, filename, hashlib.sha1(formatted_files.formatted[filename]).hexdigest())
+            to_diff = [f for f in memo_keys if memo_keys[f] not in self.output_stats]
+            tracing.count('diff memo hits', len(memo_keys) - len(to_diff))
+            tracing.count('diff memo misses', len(to_diff))
+
+            with tracing.span('diff', files=len(to_diff)):
+                found = differ.diff_file_stats(lambda options: formatted_files.diff(options, to_diff), ignore_spaces)
+            # Every file that was diffed has changed, so it's only left out if the diff ignores the
+            # change (eg, with ignore_spaces). A name that isn't one of them was misread.
+            unknown = set(found).difference(to_diff)
+            missing = set(to_diff).difference(found) if not ignore_spaces else ()
+            if unknown or missing:
+                raise ValueError("The diff doesn't match the files that were diffed (misread %s; missing %s)" % (
+                    ', '.join(repr(f) for f in sorted(unknown)) or 'none', ', '.join(repr(f) for f in sorted(missing)) or 'none'))
+            for filename in to_diff:
+                self.output_stats[memo_keys[filename]] = found.get(filename)
+
+            for filename in filenames:
+                if filename in memo_keys:
+                    stats[filename] = self.output_stats[memo_keys[filename]]
+                else:
+                    stats[filename] = None
+        return stats
+
+    def get_files(self, extensions, cache=None):
+        return self.git_project.get_files(extensions, cache=cache)
+
+    def get_content_hash(self):
+        if self.originals is None:
+            self.load()
+        return util.hash_file_contents(self.originals)
+
+    def get_blobs(self):
+        if self.originals is None:
+            self.load()
+        return self.blobs
+
+    def check(self):
+        self.git_project.check()
+
+    def prepare_workers(self, count):
+        # Each candidate formats into its own buffers, so workers only need to share the originals.
+        if self.originals is None:
+            self.load()
+
+    def remove_workers(self):
+        pass
+
+    def load(self):
+        self.originals = {}
+        for filename in self.context['files_to_format']:
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                self.originals[filename] = f.read()
+            tracing.count('bytes read', len(self.originals[filename]))
+        self.blobs = dict((f, util.git_blob_hash(text)) for f, text in self.originals.iteritems())
+        if self.file_stats_cache is None:
+            self.file_stats_cache = database.FileStatsCache(blobs=self.blobs)
+
+    def format_file(self, filename, style_string):
+        return util.run([
+            self.context['clang-format'], '-style=' + style_string, '-assume-filename=' + filename
+        ], input=self.originals[filename], cwd=self.path)
+
+    # Helpers
+
+    def create_formatted_files_context(self, style, filenames):
+        class FormattedFiles(object):
+            def __init__(self, project, style, filenames):
+                self.project = project
+                self.style = style
+                self.filenames = filenames
+                self.formatted = {}
+
+            def __enter__(self):
+                style_string = inline_style(self.style)
+                files = self.filenames
+                with tracing.span('format', files=len(files)):
+                    texts = util.map_on_pool(self.project.context['format_pool'], lambda f: self.project.format_file(f, style_string), files)
+                self.formatted = dict(zip(files, texts))
+                return self
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                self.formatted = {}
+
+            def changed_files(self):
+                return sorted(f for f, text in self.formatted.iteritems() if text != self.project.originals[f])
+
+            def diff(self, options, filenames=None):
+                """Yield the lines of the diff of the files that changed."""
+                changed = self.changed_files()
+                if filenames is not None:
+                    filenames = set(filenames)
+                    changed = [f for f in changed if f in filenames]
+                if not changed:
+                    return
+
+                if self.project.context['diff_engine'] == 'native':
+                    files = ((f, self.project.originals[f], self.formatted[f]) for f in changed)
+                    for line in xdiff.diff_lines(files, options):
+                        yield line
+                    return
+
+                # Only the files that changed need to be written out for git to compare them.
+                scratch = tempfile.mkdtemp(prefix='fit-clang-format-')
+                try:
+                    for filename in changed:
+                        for subdir, text in ((ORIGINAL_DIR, self.project.originals[filename]), (FORMATTED_DIR, self.formatted[filename])):
+                            path = os.path.join(scratch, subdir, filename)
+                            if not os.path.isdir(os.path.dirname(path)):
+                                os.makedirs(os.path.dirname(path))
+                            with open(path, 'wb') as f:
+                                f.write(text)
+                            tracing.count('bytes written', len(text))
+
+                    for line in no_index_diff(scratch, options):
+                        yield line
+                finally:
+                    shutil.rmtree(scratch, ignore_errors=True)
+
+        return FormattedFiles(self, style, filenames)
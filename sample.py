@@ -0,0 +1,118 @@
+import os
+import time
+
+import util
+
+# The suffixes that a --sample-size can have.
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+def parse_size(text):
+    """Parses a number of bytes like '500K' or '2M'."""
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    suffix = text[-1:] if text[-1:] in SIZE_SUFFIXES else ''
+    size = int(float(text[:len(text) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+    if size <= 0:
+        raise ValueError(text)
+    return size
+
+def format_size(size):
+    for suffix in ('G', 'M', 'K'):
+        if size >= SIZE_SUFFIXES[suffix]:
+            return '%.1f%sB' % (float(size) / SIZE_SUFFIXES[suffix], suffix)
+    return '%dB' % size
+
+def get_stratum(filename):
+    """Files are grouped by their top-level directory and their extension."""
+    parts = filename.split('/', 1)
+    return (parts[0] if len(parts) > 1 else '', os.path.splitext(filename)[1])
+
+def stratified_sample(files, costs, budget, rng):
+    """Pick files whose costs add up to about 'budget'.
+
+    Each group of files (see get_stratum) gets a share of the budget in proportion to its total cost,
+    and every group gets at least its cheapest file (as long as it fits in an even split of the
+    budget), so that no part of the project is left out. A file only counts for as much as an even
+    split when the shares are worked out, so one huge generated header doesn't take its group's
+    share from the rest of the project; such files are only picked if there's budget left over.
+    """
+    if sum(costs[f] for f in files) <= budget:
+        return sorted(files)
+
+    strata = {}
+    for f in files:
+        strata.setdefault(get_stratum(f), []).append(f)
+
+    even_split = float(budget) / len(strata)
+    weights = dict((f, min(costs[f], even_split)) for f in files)
+    total = sum(weights.itervalues())
+
+    chosen = []
+    leftovers = []
+    spent = 0
+    for key in sorted(strata):
+        group = sorted(strata[key])
+        rng.shuffle(group)
+        share = budget * sum(weights[f] for f in group) / total
+
+        used = 0
+        for f in group:
+            if used + costs[f] <= share:
+                chosen.append(f)
+                used += costs[f]
+            else:
+                leftovers.append(f)
+        cheapest = min(group, key=lambda f: (costs[f], f))
+        if not used and costs[cheapest] <= even_split:
+            chosen.append(cheapest)
+            leftovers.remove(cheapest)
+            used = costs[cheapest]
+        spent += used
+
+    # Use up what's left of the budget on any of the files.
+    rng.shuffle(leftovers)
+    for f in leftovers:
+        if spent + costs[f] <= budget:
+            chosen.append(f)
+            spent += costs[f]
+    return sorted(chosen)
+
+# How long clang-format takes to format a file: a fixed cost for each run, plus a cost for each byte.
+class CostModel(object):
+    def __init__(self, seconds_per_file, seconds_per_byte):
+        self.seconds_per_file = seconds_per_file
+        self.seconds_per_byte = seconds_per_byte
+
+    def get_cost(self, size):
+        return self.seconds_per_file + size * self.seconds_per_byte
+
+    def __repr__(self):
+        return 'CostModel(seconds_per_file=%.4f, seconds_per_byte=%.2e)' % (self.seconds_per_file, self.seconds_per_byte)
+
+def measure_costs(clang_format, path, files, sizes, rng, max_files=8, max_bytes=256*1024):
+    """Time clang-format on an empty file and on a few of the files, and return a CostModel."""
+    def time_format(text, filename):
+        start = time.time()
+        util.run([clang_format, '-style=LLVM', '-assume-filename=' + filename], input=text, cwd=path)
+        return time.time() - start
+
+    # The fastest of a few runs, since the first one may have to load clang-format from disk.
+    seconds_per_file = min(time_format('', 'empty.cc') for _ in range(3))
+
+    candidates = sorted(files)
+    rng.shuffle(candidates)
+    picked, picked_bytes = [], 0
+    for f in candidates:
+        if len(picked) == max_files:
+            break
+        if picked_bytes + sizes[f] <= max_bytes:
+            picked.append(f)
+            picked_bytes += sizes[f]
+
+    elapsed = 0.0
+    for f in picked:
+        with open(os.path.join(path, f), 'rb') as handle:
+            elapsed += time_format(handle.read(), f)
+    seconds_per_byte = max(0.0, elapsed - len(picked) * seconds_per_file) / max(1, picked_bytes)
+    return CostModel(seconds_per_file, seconds_per_byte)
@@ -0,0 +1,116 @@
+import os
+import re
+
+# The constructs that some style keys depend on. If a construct never shows up in the files, then
+# no value of those keys can change them, so there's no point in trying the keys.
+# The patterns err on the side of matching too much (eg, '<' in comparisons counts as a template
+# bracket), since a false match only costs a round of the search but a missed one loses a key.
+class Construct(object):
+    def __init__(self, description, pattern, keys, flags=0):
+        self.description = description
+        self.regex = re.compile(pattern, flags)
+        self.keys = keys
+
+CONSTRUCTS = [
+    Construct('access specifiers', r'\b(public|protected|private|signals|slots)\s*:', [
+        'AccessModifierOffset',
+    ]),
+    Construct('case labels', r'\b(case\b|default\s*:)', [
+        'AllowShortCaseLabelsOnASingleLine',
+        'IndentCaseLabels',
+    ]),
+    Construct('templates', r'\btemplate\b', [
+        'AlwaysBreakTemplateDeclarations',
+        'SpaceAfterTemplateKeyword',
+    ]),
+    Construct('angle brackets', r'[\w>]\s*<', [
+        'SpacesInAngles',
+    ]),
+    Construct('nested closing angle brackets', r'>\s*>', [
+        'Standard',
+    ]),
+    Construct('@property declarations', r'@property\b', [
+        'ObjCSpaceAfterProperty',
+    ]),
+    Construct('Objective-C protocol lists', r'@(interface|protocol)\b|\bid\s*<', [
+        'ObjCSpaceBeforeProtocolList',
+    ]),
+    Construct('blocks', r'\^', [
+        'ObjCBlockIndentWidth',
+    ]),
+    Construct('#include and #import lines', r'^\s*#\s*(include|import)\b', [
+        'IncludeCategories',
+        'IncludeIsMainRegex',
+        'SortIncludes',
+    ], re.MULTILINE),
+    Construct('namespaces', r'\bnamespace\b', [
+        'NamespaceIndentation',
+    ]),
+    Construct('constructor initializers', r'\)\s*(noexcept\b[^:;{}]*)?:(?!:)', [
+        'BreakConstructorInitializersBeforeComma',
+        'ConstructorInitializerAllOnOneLineOrOnePerLine',
+        'ConstructorInitializerIndentWidth',
+    ]),
+    Construct('casts', r'\(\s*[A-Za-z_][\w:<>,\s]*[\s\*&]*\)\s*[\w(&*~!+-]', [
+        'SpaceAfterCStyleCast',
+        'SpacesInCStyleCastParentheses',
+    ]),
+    Construct('empty parentheses', r'\(\s*\)', [
+        'SpaceInEmptyParentheses',
+    ]),
+    Construct('square brackets', r'\[', [
+        'SpacesInSquareBrackets',
+    ]),
+    Construct('escaped newlines', r'\\[ \t]*$', [
+        'AlignEscapedNewlinesLeft',
+    ], re.MULTILINE),
+    Construct('if statements', r'\bif\b', [
+        'AllowShortIfStatementsOnASingleLine',
+    ]),
+    Construct('loops', r'\b(for|while)\b', [
+        'AllowShortLoopsOnASingleLine',
+    ]),
+    Construct('stream operators', r'<<', [
+        'PenaltyBreakFirstLessLess',
+    ]),
+    Construct('ternary operators', r'\?', [
+        'BreakBeforeTernaryOperators',
+    ]),
+    Construct('comments', r'//|/\*', [
+        'AlignTrailingComments',
+        'PenaltyBreakComment',
+        'ReflowComments',
+        'SpacesBeforeTrailingComments',
+    ]),
+    Construct('string literals', r'"', [
+        'AlwaysBreakBeforeMultilineStrings',
+        'BreakStringLiterals',
+        'PenaltyBreakString',
+    ]),
+    Construct('blank lines at the start of a block', r'\{[ \t]*\r?\n[ \t]*\r?\n', [
+        'KeepEmptyLinesAtTheStartOfBlocks',
+    ]),
+    Construct('blank lines', r'\n[ \t]*\r?\n', [
+        'MaxEmptyLinesToKeep',
+    ]),
+]
+
+def count_constructs(path, files):
+    """Returns a list of (construct, count) with the number of times each construct appears in the files."""
+    counts = [0] * len(CONSTRUCTS)
+    for filename in files:
+        with open(os.path.join(path, filename), 'rb') as f:
+            text = f.read()
+        for index, construct in enumerate(CONSTRUCTS):
+            counts[index] += sum(1 for _ in construct.regex.finditer(text))
+    return zip(CONSTRUCTS, counts)
+
+def find_inapplicable_keys(construct_counts):
+    """Returns {key: description} for the keys whose constructs never appear."""
+    found = {}
+    for construct, count in construct_counts:
+        for key in construct.keys:
+            found[key] = found.get(key, 0) + count
+
+    descriptions = dict((key, construct.description) for construct, _ in construct_counts for key in construct.keys)
+    return dict((key, descriptions[key]) for key, count in found.iteritems() if count == 0)
@@ -0,0 +1,154 @@
+import os
+import Queue
+import shutil
+import tempfile
+
+import memory
+import tracing
+import util
+
+def default_scratch_dir():
+    """/dev/shm is a tmpfs on most Linux systems, so the scratch trees there never touch a disk."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+# A model of a project whose files are copied into scratch trees outside of the repo, where each
+# candidate style formats them in place. Each tree has the originals in one directory and the copy
+# that gets formatted in another, so 'git diff --no-index' compares just those files. After each
+# candidate, the files that clang-format rewrote are put back from the originals in memory, so the
+# repo is never reset or even looked at; only the final apply_style writes to it.
+class ScratchProject(object):
+    def __init__(self, git_project, context, scratch_dir):
+        self.path = git_project.path
+        self.context = context
+        self.git_project = git_project
+        self.scratch_dir = scratch_dir
+        self.originals = None
+
+        # The trees that are free to have a temporary style applied; there's one for each worker.
+        self.idle_trees = Queue.Queue()
+        self.scratch_root = None
+
+    # API
+
+    def apply_style(self, style):
+        self.git_project.apply_style(style)
+
+    def apply_temporary_style(self, style):
+        if self.scratch_root is None:
+            self.prepare_workers(1)
+        return self.create_styled_tree_context(style)
+
+    def score_style(self, style, style_hash, differ, ignore_spaces=False):
+        with self.apply_temporary_style(style) as styled_tree:
+            return differ.calculate_diff(styled_tree, ignore_spaces=ignore_spaces)
+
+    def prepare_workers(self, count):
+        """Set up a scratch tree for each of the 'count' temporary styles that can be applied at the same time."""
+        if self.scratch_root:
+            return
+        if self.originals is None:
+            self.load()
+
+        self.scratch_root = tempfile.mkdtemp(prefix='fit-clang-format-scratch-', dir=self.scratch_dir)
+        first = None
+        for index in range(max(1, count)):
+            path = os.path.join(self.scratch_root, str(index))
+            for filename, text in self.originals.iteritems():
+                # The originals never change, so the trees can share them.
+                self.write_file(os.path.join(path, memory.ORIGINAL_DIR, filename), text,
+                    link_from=first and os.path.join(first, memory.ORIGINAL_DIR, filename))
+                self.write_file(os.path.join(path, memory.FORMATTED_DIR, filename), text)
+            first = first or path
+            self.idle_trees.put(path)
+
+    def remove_workers(self):
+        if not self.scratch_root:
+            return
+
+        shutil.rmtree(self.scratch_root, ignore_errors=True)
+        self.scratch_root = None
+        self.idle_trees = Queue.Queue()
+
+    def get_files(self, extensions, cache=None):
+        return self.git_project.get_files(extensions, cache=cache)
+
+    def get_content_hash(self):
+        if self.originals is None:
+            self.load()
+        return util.hash_file_contents(self.originals)
+
+    def check(self):
+        self.git_project.check()
+
+    def load(self):
+        self.originals = {}
+        for filename in self.context['files_to_format']:
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                self.originals[filename] = f.read()
+            tracing.count('bytes read', len(self.originals[filename]))
+
+    # Helpers
+
+    def write_file(self, path, text, link_from=None):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if link_from:
+            try:
+                os.link(link_from, path)
+                return
+            except OSError:
+                pass
+        with open(path, 'wb') as f:
+            f.write(text)
+        tracing.count('bytes written', len(text))
+
+    def format_tree(self, path, style):
+        # Like GitRepo.apply_style, but the style is passed inline so that there's no style file to diff.
+        command = [self.context['clang-format'], '-style=' + memory.inline_style(style), '-i']
+        files = self.context['files_to_format']
+        sizes = dict((f, len(self.originals[f])) for f in files)
+        shards = util.split_into_shards(files, sizes, count=self.context['format_jobs'], base_command=command)
+        with tracing.span('format', files=len(files)):
+            util.map_on_pool(self.context['format_pool'], lambda shard: util.run(command + shard, cwd=os.path.join(path, memory.FORMATTED_DIR)), shards)
+
+    def restore_tree(self, path):
+        """Put back the files that were formatted; the rest are left alone."""
+        with tracing.span('restore'):
+            for filename, text in self.originals.iteritems():
+                formatted_path = os.path.join(path, memory.FORMATTED_DIR, filename)
+                with open(formatted_path, 'rb') as f:
+                    formatted = f.read()
+                tracing.count('bytes read', len(formatted))
+                if formatted != text:
+                    self.write_file(formatted_path, text)
+
+    def create_styled_tree_context(self, style):
+        class StyledTree(object):
+            def __init__(self, project, style):
+                self.project = project
+                self.style = style
+                self.path = None
+
+            def __enter__(self):
+                # Borrow a tree that no other worker is using.
+                self.path = self.project.idle_trees.get()
+                try:
+                    self.project.format_tree(self.path, self.style)
+                except:
+                    self.__exit__(None, None, None)
+                    raise
+                return self
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                try:
+                    self.project.restore_tree(self.path)
+                finally:
+                    self.project.idle_trees.put(self.path)
+                    self.path = None
+
+            def diff(self, options):
+                return memory.no_index_diff(self.path, options)
+
+        return StyledTree(self, style)
@@ -6,6 +6,16 @@ class StyleOption(object):
 		self.name = name
 		self.options = options
 
+# An integer key whose values span [low, high]. Its options are a few seed values; the search
+# scores those, then narrows in on the best value between them, 'resolution' apart at the least.
+# Seeds outside of the range (eg, a ColumnLimit of 0, for no limit) are only ever tried as they are.
+class StyleRange(StyleOption):
+    def __init__(self, name, low, high, seeds, resolution=1):
+        super(StyleRange, self).__init__(name, [{name: seed} for seed in seeds])
+        self.low = low
+        self.high = high
+        self.resolution = resolution
+
 class Style(object):
     def __init__(self, base=None, style=None, hidden_base_style=None):
         if style is None:
@@ -14,7 +24,7 @@ class Style(object):
             elif style is None:
                 style = {}
         elif base is None:
-            base = style['BasedOnStyle']
+            base = style.get('BasedOnStyle')
 
         self.base = base
         self.style_dict = style
@@ -129,7 +139,7 @@ STYLE_OPTIONS.update({
     	{key:option} for option in options
     ])
     for key,options in {
-        'AccessModifierOffset': [-4, -2, -1, 0, 1, 2, 4],
+        'AccessModifierOffset': [-4, -2, 0, 2, 4],
         'AlignAfterOpenBracket': ['Align', 'DontAlign', 'AlwaysBreak'],
         'AllowShortFunctionsOnASingleLine': ['All', 'Inline', 'None', 'Empty'],
         'AlwaysBreakAfterDefinitionReturnType': ['TopLevel', 'None'],
@@ -137,21 +147,21 @@ STYLE_OPTIONS.update({
         'BasedOnStyle': ['WebKit', 'Mozilla', 'Chromium', 'LLVM', 'Google'],
         'BreakBeforeBinaryOperators': ['None', 'NonAssignment', 'All'],
         'BreakBeforeBraces': ['GNU', 'Allman', 'Mozilla', 'Attach', 'Stroustrup', 'Linux', 'WebKit'],
-        'ColumnLimit': [0, 80, 90, 100, 110, 120],
-        'ConstructorInitializerIndentWidth': [0, 2, 4],
-        'ContinuationIndentWidth': [0, 2, 4],
+        'ColumnLimit': [0, 80, 100, 120, 160],
+        'ConstructorInitializerIndentWidth': [0, 2, 4, 8],
+        'ContinuationIndentWidth': [0, 2, 4, 8],
         'IncludeCategories': [[{'Regex': '^"(llvm|llvm-c|clang|clang-c)/', 'Priority': 2}, {'Regex': '^(<|"(gtest|isl|json)/)', 'Priority': 3}, {'Regex': '.*', 'Priority': 1}], [{'Regex': '^<.*\\.h>', 'Priority': 1}, {'Regex': '^<.*', 'Priority': 2}, {'Regex': '.*', 'Priority': 3}]],
         'IncludeIsMainRegex': ['$', '([-_](test|unittest))?$'],
         'IndentWidth': [2, 3, 4, 8],
         "MaxEmptyLinesToKeep": [0, 1, 2, 3, 4],
         'NamespaceIndentation': ['All', 'None', 'Inner'],
-        'ObjCBlockIndentWidth': [0, 2, 4],
-        'PenaltyBreakBeforeFirstCallParameter': [1, 19],
-        'PenaltyBreakComment': [300, 150],
-        'PenaltyBreakFirstLessLess': [120, 60],
-        'PenaltyBreakString': [1000, 500],
-        'PenaltyExcessCharacter': [1000000, 500000],
-        'PenaltyReturnTypeOnItsOwnLine': [200, 60],
+        'ObjCBlockIndentWidth': [0, 2, 4, 8],
+        'PenaltyBreakBeforeFirstCallParameter': [1, 19, 100],
+        'PenaltyBreakComment': [60, 150, 300, 600],
+        'PenaltyBreakFirstLessLess': [60, 120, 300],
+        'PenaltyBreakString': [500, 1000, 1500],
+        'PenaltyExcessCharacter': [100000, 500000, 1000000],
+        'PenaltyReturnTypeOnItsOwnLine': [60, 200, 400],
         'PointerAlignment': ['Middle', 'Right', 'Left'],
         'SpaceBeforeParens': ['Always', 'Never', 'ControlStatements'],
         'SpacesBeforeTrailingComments': [1, 2],
@@ -160,6 +170,26 @@ STYLE_OPTIONS.update({
     }.iteritems()
 })
 
+# The integer stylings are searched over a range, starting from the values above:
+# {key: (low, high, resolution)}. The penalties only matter relative to each other, so they're only
+# narrowed down to a few percent of their range.
+INTEGER_RANGES = {
+    'AccessModifierOffset': (-8, 8, 1),
+    'ColumnLimit': (40, 200, 1),
+    'ConstructorInitializerIndentWidth': (0, 16, 1),
+    'ContinuationIndentWidth': (0, 16, 1),
+    'ObjCBlockIndentWidth': (0, 16, 1),
+    'PenaltyBreakBeforeFirstCallParameter': (0, 200, 5),
+    'PenaltyBreakComment': (0, 1000, 25),
+    'PenaltyBreakFirstLessLess': (0, 1000, 25),
+    'PenaltyBreakString': (0, 2000, 50),
+    'PenaltyExcessCharacter': (10000, 1000000, 25000),
+    'PenaltyReturnTypeOnItsOwnLine': (0, 1000, 25),
+}
+for key, (low, high, resolution) in INTEGER_RANGES.iteritems():
+    seeds = [option[key] for option in STYLE_OPTIONS[key].options]
+    STYLE_OPTIONS[key] = StyleRange(key, low, high, seeds, resolution)
+
 # The UseTab & TabWidth are coupled.
 STYLE_OPTIONS['UseTab'] = StyleOption('UseTab', [
     {'UseTab': 'Never', 'TabWidth': 8},
@@ -0,0 +1,290 @@
+import os
+
+import memory
+import styles
+import util
+
+# Synthetic corpora for benchmark.py: made-up C, C++ and Objective-C code, formatted with a known
+# style, so that a fit of it can be checked against the style that made it.
+
+# The styles that a corpus can be made with. Every value is one that the search can pick (see
+# styles.STYLE_OPTIONS), so a perfect fit is possible.
+STYLES = {
+    'llvm': {'BasedOnStyle': 'LLVM'},
+    'google-wide': {'BasedOnStyle': 'Google', 'IndentWidth': 4, 'ColumnLimit': 100, 'DerivePointerAlignment': False, 'PointerAlignment': 'Right'},
+    'linux': {'BasedOnStyle': 'LLVM', 'IndentWidth': 8, 'UseTab': 'Always', 'TabWidth': 8, 'BreakBeforeBraces': 'Linux',
+              'AllowShortIfStatementsOnASingleLine': False, 'IndentCaseLabels': False},
+    'webkit': {'BasedOnStyle': 'WebKit'},
+    'mozilla': {'BasedOnStyle': 'Mozilla', 'SpaceBeforeParens': 'Never'},
+}
+
+NAMES = ['count', 'total', 'index', 'limit', 'offset', 'value', 'result', 'flags', 'width', 'height', 'size', 'state']
+TYPES = ['int', 'long', 'unsigned', 'double', 'size_t', 'char']
+FUNCTIONS = ['process', 'update', 'compute', 'reset', 'lookup', 'emit', 'merge', 'apply']
+
+# Writes the code of a file a line at a time, indenting by how deep the braces are. The layout
+# doesn't matter much, since clang-format redoes it with the corpus's style.
+class Writer(object):
+    def __init__(self, rng):
+        self.rng = rng
+        self.lines = []
+        self.depth = 0
+
+    def line(self, text=''):
+        if text.startswith('}'):
+            self.depth = max(0, self.depth - 1)
+        self.lines.append(('  ' * self.depth + text) if text else '')
+        if text.endswith('{'):
+            self.depth += 1
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+    def name(self):
+        return self.rng.choice(NAMES)
+
+    def expression(self, depth=0):
+        choice = self.rng.randrange(6 if depth < 2 else 3)
+        if choice == 0:
+            return str(self.rng.randrange(1, 1000))
+        if choice in (1, 2):
+            return self.name()
+        if choice == 3:
+            return '(%s %s %s)' % (self.expression(depth + 1), self.rng.choice(['+', '-', '*', '/', '%']), self.expression(depth + 1))
+        if choice == 4:
+            return '%s_%s(%s)' % (self.rng.choice(FUNCTIONS), self.name(), ', '.join(self.expression(depth + 1) for _ in range(self.rng.randrange(4))))
+        return '(%s)%s' % (self.rng.choice(TYPES), self.name())
+
+    def condition(self):
+        return '%s %s %s' % (self.name(), self.rng.choice(['<', '>', '==', '!=', '<=']), self.expression(1))
+
+    def statement(self, depth=0):
+        choice = self.rng.randrange(9 if depth < 2 else 4)
+        if choice == 0:
+            self.line('%s = %s;' % (self.name(), self.expression()))
+        elif choice == 1:
+            self.line('%s += %s;  // %s' % (self.name(), self.expression(), self.rng.choice(['keep it small', 'see above', 'TODO: check the bounds'])))
+        elif choice == 2:
+            # A long call, to give the column limit and the argument packing something to do.
+            args = ', '.join('%s_%s' % (self.name(), self.name()) for _ in range(self.rng.randrange(4, 9)))
+            self.line('%s_%s(%s);' % (self.rng.choice(FUNCTIONS), self.name(), args))
+        elif choice == 3:
+            self.line('if (%s) return %s;' % (self.condition(), self.expression()))
+        elif choice == 4:
+            self.line('if (%s) {' % self.condition())
+            self.block(depth + 1)
+            if self.rng.random() < 0.5:
+                self.line('} else {')
+                self.block(depth + 1)
+            self.line('}')
+        elif choice == 5:
+            self.line('for (int i = 0; i < %s; i++) {' % self.name())
+            self.block(depth + 1)
+            self.line('}')
+        elif choice == 6:
+            self.line('while (%s) {' % self.condition())
+            self.block(depth + 1)
+            self.line('}')
+        elif choice == 7:
+            self.line('switch (%s) {' % self.name())
+            for value in range(self.rng.randrange(1, 4)):
+                self.line('case %d:' % value)
+                self.line('%s = %s;' % (self.name(), self.expression()))
+                self.line('break;')
+            self.line('default:')
+            self.line('break;')
+            self.line('}')
+        else:
+            self.line('%s *%s_ptr = &%s;' % (self.rng.choice(TYPES), self.name(), self.name()))
+
+    def block(self, depth):
+        for _ in range(self.rng.randrange(1, 4)):
+            self.statement(depth)
+
+    def function_body(self):
+        for name in NAMES[:4]:
+            self.line('%s %s = %d;' % (self.rng.choice(TYPES[:3]), name, self.rng.randrange(10)))
+        for name in NAMES[4:]:
+            self.line('%s %s = 0;' % (self.rng.choice(TYPES[:3]), name))
+        self.block(0)
+        self.block(0)
+        self.line('return %s;' % self.expression())
+
+    def parameters(self):
+        return ', '.join('%s %s_arg%d' % (self.rng.choice(TYPES), self.name(), index) for index in range(self.rng.randrange(1, 6)))
+
+def c_source(rng, index, header):
+    w = Writer(rng)
+    w.line('/* Module %d: generated for benchmarking. */' % index)
+    if header:
+        w.line('#ifndef MODULE_%d_H' % index)
+        w.line('#define MODULE_%d_H' % index)
+        w.line()
+        w.line('#include <stddef.h>')
+        w.line()
+        w.line('#define MODULE_%d_LIMIT (%d * 4)' % (index, rng.randrange(100)))
+        w.line()
+        w.line('struct module_%d {' % index)
+        for name in rng.sample(NAMES, 4):
+            w.line('%s %s;' % (rng.choice(TYPES), name))
+        w.line('const char *label;')
+        w.line('};')
+        w.line()
+        w.line('enum module_%d_state { MODULE_%d_IDLE, MODULE_%d_RUNNING, MODULE_%d_DONE };' % ((index,) * 4))
+        w.line()
+        for function in rng.sample(FUNCTIONS, 3):
+            w.line('int %s_%d(struct module_%d *module, %s);' % (function, index, index, w.parameters()))
+        w.line()
+        w.line('#endif')
+        return w.text()
+
+    w.line('#include <stdio.h>')
+    w.line('#include <stdlib.h>')
+    w.line('#include "module_%d.h"' % index)
+    w.line()
+    for function in rng.sample(FUNCTIONS, rng.randrange(2, 5)):
+        w.line('static int %s_%d(struct module_%d *module, %s) {' % (function, index, index, w.parameters()))
+        w.function_body()
+        w.line('}')
+        w.line()
+    return w.text()
+
+def cpp_source(rng, index, header):
+    w = Writer(rng)
+    w.line('// Module %d: generated for benchmarking.' % index)
+    if header:
+        w.line('#pragma once')
+        w.line()
+        w.line('#include <map>')
+        w.line('#include <string>')
+        w.line('#include <vector>')
+        w.line()
+        w.line('namespace bench {')
+        w.line('namespace module%d {' % index)
+        w.line()
+        w.line('template <typename T> T clamp%d(T value, T low, T high) { return value < low ? low : (value > high ? high : value); }' % index)
+        w.line()
+        w.line('class Widget%d : public Base {' % index)
+        w.line('public:')
+        w.line('Widget%d(int width, const std::string &name) : width_(width), name_(name), items_() {}' % index)
+        w.line('virtual ~Widget%d() {}' % index)
+        for function in rng.sample(FUNCTIONS, 3):
+            w.line('int %s(%s) const;' % (function, w.parameters()))
+        w.line('const std::string &name() const { return name_; }')
+        w.line('private:')
+        w.line('int width_;')
+        w.line('std::string name_;')
+        w.line('std::vector<std::pair<int, std::vector<int>>> items_;')
+        w.line('};')
+        w.line()
+        w.line('}  // namespace module%d' % index)
+        w.line('}  // namespace bench')
+        return w.text()
+
+    w.line('#include "module_%d.hpp"' % index)
+    w.line()
+    w.line('#include <algorithm>')
+    w.line()
+    w.line('namespace bench {')
+    w.line('namespace module%d {' % index)
+    w.line()
+    for function in rng.sample(FUNCTIONS, rng.randrange(2, 5)):
+        w.line('int Widget%d::%s(%s) const {' % (index, function, w.parameters()))
+        w.line('std::map<std::string, int> seen;')
+        w.line('auto check = [&](int value) -> bool { return value > width_; };')
+        w.line('for (const auto &item : items_) {')
+        w.line('if (check(item.first)) seen[name_] += static_cast<int>(item.second.size());')
+        w.line('}')
+        w.function_body()
+        w.line('}')
+        w.line()
+    w.line('}  // namespace module%d' % index)
+    w.line('}  // namespace bench')
+    return w.text()
+
+def objc_source(rng, index, header):
+    w = Writer(rng)
+    w.line('// Module %d: generated for benchmarking.' % index)
+    if header:
+        w.line('#import <Foundation/Foundation.h>')
+        w.line()
+        w.line('@protocol Module%dDelegate <NSObject>' % index)
+        w.line('- (void)module:(id)module didChangeCount:(NSInteger)count;')
+        w.line('@end')
+        w.line()
+        w.line('@interface Module%d : NSObject <NSCopying>' % index)
+        w.line('@property (nonatomic, strong) NSString *name;')
+        w.line('@property (nonatomic, assign) NSInteger count;')
+        w.line('@property (nonatomic, weak) id<Module%dDelegate> delegate;' % index)
+        for function in rng.sample(FUNCTIONS, 3):
+            w.line('- (NSInteger)%sWithValue:(NSInteger)value label:(NSString *)label;' % function)
+        w.line('@end')
+        return w.text()
+
+    w.line('#import "Module%d.h"' % index)
+    w.line()
+    w.line('@implementation Module%d' % index)
+    w.line()
+    w.line('- (id)copyWithZone:(NSZone *)zone {')
+    w.line('Module%d *copy = [[[self class] allocWithZone:zone] init];' % index)
+    w.line('copy.name = [self.name copy];')
+    w.line('return copy;')
+    w.line('}')
+    w.line()
+    for function in rng.sample(FUNCTIONS, rng.randrange(2, 4)):
+        w.line('- (NSInteger)%sWithValue:(NSInteger)value label:(NSString *)label {' % function)
+        w.line('NSArray *values = @[ @1, @2, @(value) ];')
+        w.line('NSDictionary *names = @{ @"label" : label, @"name" : self.name };')
+        w.line('[values enumerateObjectsUsingBlock:^(id obj, NSUInteger idx, BOOL *stop) {')
+        w.line('self.count += [obj integerValue] + idx;')
+        w.line('}];')
+        w.line('[self.delegate module:self didChangeCount:self.count];')
+        w.line('if (names.count > %d) return value;' % rng.randrange(5))
+        w.function_body()
+        w.line('}')
+        w.line()
+    w.line('@end')
+    return w.text()
+
+# For each language: how to write a file, and the extensions of its sources and headers.
+class Language(object):
+    def __init__(self, generate, source_extension, header_extension, filename):
+        self.generate = generate
+        self.source_extension = source_extension
+        self.header_extension = header_extension
+        self.filename = filename
+
+LANGUAGES = {
+    'c': Language(c_source, 'c', 'h', 'module_%d'),
+    'cpp': Language(cpp_source, 'cc', 'hpp', 'module_%d'),
+    'objc': Language(objc_source, 'm', 'h', 'Module%d'),
+}
+
+def generate_corpus(path, language, style, file_count, clang_format, rng):
+    """Write a git repo at 'path' with about 'file_count' files of made-up code in the language,
+    formatted with the style (one of STYLES), and commit them. Returns the files' contents."""
+    language = LANGUAGES[language]
+    sources = {}
+    for index in range(max(1, file_count // 2)):
+        # Split over a few top-level directories, like a real project.
+        directory = 'lib%d' % (index % 3)
+        name = language.filename % index
+        sources['include/%s.%s' % (name, language.header_extension)] = language.generate(rng, index, True)
+        sources['%s/%s.%s' % (directory, name, language.source_extension)] = language.generate(rng, index, False)
+
+    # Format each file like the whole corpus had always used the style.
+    style_string = memory.inline_style(styles.Style(style=STYLES[style]))
+    contents = {}
+    for filename, text in sorted(sources.iteritems()):
+        contents[filename] = util.run([clang_format, '-style=' + style_string, '-assume-filename=' + filename], input=text)
+        full_path = os.path.join(path, filename)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as f:
+            f.write(contents[filename])
+
+    git = ['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', '-c', 'commit.gpgsign=false']
+    util.run(git + ['init', '-q'], cwd=path)
+    util.run(git + ['add', '--'] + sorted(contents), cwd=path)
+    util.run(git + ['commit', '-q', '-m', 'Synthetic %s corpus in the %r style' % (language.source_extension, style)], cwd=path)
+    return contents
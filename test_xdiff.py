@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+
+# Checks that '--diff-engine native' (xdiff.py) gives the same stats as 'git diff' for every differ,
+# on clang-format's own output and on random edits. Needs git; the clang-format part is skipped if
+# clang-format isn't in the path (or in $CLANG_FORMAT).
+#     $ python -m unittest test_xdiff
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import git
+import memory
+import styles
+import synthetic
+import util
+import xdiff
+
+def find_clang_format():
+    path = os.environ.get('CLANG_FORMAT')
+    if path:
+        return path
+    try:
+        return util.run(['which', 'clang-format']).strip() or None
+    except (ValueError, OSError):
+        return None
+
+CLANG_FORMAT = find_clang_format()
+
+# A git config with every setting that the native engine doesn't follow, which memory.no_index_diff
+# has to override (see git.DIFF_CONFIG).
+GIT_CONFIG = '''
+[diff]
+    algorithm = histogram
+    indentHeuristic = false
+    noprefix = true
+    mnemonicPrefix = true
+[core]
+    quotePath = true
+'''
+
+def git_diff(files, options, env=None):
+    """The lines of 'git diff --no-index' of the (filename, original, formatted) files, run just like memory.py runs it."""
+    scratch = tempfile.mkdtemp(prefix='fit-clang-format-test-')
+    try:
+        for filename, original, formatted in files:
+            for subdir, text in ((memory.ORIGINAL_DIR, original), (memory.FORMATTED_DIR, formatted)):
+                path = os.path.join(scratch, subdir, filename)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(text)
+        return list(memory.no_index_diff(scratch, options, env=env))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def native_diff(files, options):
+    return list(xdiff.diff_lines(files, options))
+
+# The pieces that random files are made of: code-like lines with runs of blank lines, repeated
+# lines (which the pre-pass of xdiff treats specially) and lines that only differ in whitespace.
+LINES = [
+    'int x = 0;', 'int y = 1;', 'return x;', 'return y;', '}', '{', 'if (x) {', '} else {',
+    '    foo(a, b);', '\tfoo(a, b);', 'foo(a,b);', '// comment', '/* block */', '#include <a.h>',
+    'for (i = 0; i < n; ++i)', 'x += y * z;', 'x+=y*z;', 'case 1:', 'break;', '  ', '\t', '',
+]
+
+def random_line(rng):
+    line = rng.choice(LINES)
+    if rng.random() < 0.3:
+        line = ' ' * rng.choice([0, 2, 4, 8]) + line.strip()
+    return line
+
+def random_text(rng, count):
+    lines = []
+    while len(lines) < count:
+        if rng.random() < 0.1:
+            lines.extend([''] * rng.randint(2, 5))
+        else:
+            lines.append(random_line(rng))
+    return lines
+
+def join_lines(rng, lines, eol=None, final_newline=None):
+    eol = eol or rng.choice(['\n', '\n', '\r\n'])
+    text = eol.join(lines)
+    if final_newline if final_newline is not None else rng.random() < 0.8:
+        text += eol
+    return text
+
+def random_edit(rng, lines):
+    """Edit a copy of the lines the way a formatter might: move whitespace around, split and join
+    lines, and add or remove blank lines."""
+    lines = list(lines)
+    for _ in range(rng.randint(0, 8)):
+        if not lines:
+            lines.append(random_line(rng))
+            continue
+        i = rng.randrange(len(lines))
+        kind = rng.randrange(7)
+        if kind == 0:
+            lines[i] = lines[i] + rng.choice([' ', '\t', '  '])             # trailing whitespace
+        elif kind == 1:
+            lines[i] = rng.choice(['', ' ', '\t', '    ']) + lines[i].strip()  # indentation
+        elif kind == 2:
+            lines.insert(i, '')                                              # blank lines
+            if rng.random() < 0.5:
+                lines.insert(i, '')
+        elif kind == 3:
+            del lines[i]
+        elif kind == 4:
+            lines.insert(i, random_line(rng))
+        elif kind == 5 and i + 1 < len(lines):
+            lines[i:i + 2] = [lines[i] + ' ' + lines[i + 1].strip()]         # join
+        else:
+            lines[i] = lines[i].replace(' ', '', 1) or random_line(rng)      # a small change
+    return lines
+
+class DiffParityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.home = tempfile.mkdtemp(prefix='fit-clang-format-test-home-')
+        with open(os.path.join(cls.home, '.gitconfig'), 'wb') as f:
+            f.write(GIT_CONFIG)
+        cls.git_env = dict(os.environ, HOME=cls.home, XDG_CONFIG_HOME=cls.home, GIT_CONFIG_NOSYSTEM='1')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.home, ignore_errors=True)
+
+    def git_diff(self, files):
+        return lambda options: git_diff(files, options, env=self.git_env)
+
+    def assert_same_stats(self, files):
+        for name, differ_class in sorted(git.diff_options.iteritems()):
+            for ignore_spaces in (False, True):
+                differ = differ_class()
+                expected = differ.diff_file_stats(self.git_diff(files), ignore_spaces)
+                actual = differ.diff_file_stats(lambda options: native_diff(files, options), ignore_spaces)
+                for filename in sorted(set(expected) | set(actual)):
+                    self.assertEqual(expected.get(filename), actual.get(filename),
+                        "%s (ignore_spaces=%s) differs for %r: git has %r, native has %r" % (
+                            name, ignore_spaces, filename, expected.get(filename), actual.get(filename)))
+
+        # The counts that --save-matrix keeps, which are put together from both kinds of diff.
+        counts = git.GitRepoDifferCounts(git.GitRepoDifferWordsLog())
+        self.assertEqual(
+            counts.diff_file_stats(self.git_diff(files), True),
+            counts.diff_file_stats(lambda options: native_diff(files, options), True))
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        for batch in range(15):
+            files = []
+            for index in range(50):
+                lines = random_text(rng, rng.randint(0, 60))
+                eol = rng.choice(['\n', '\n', '\r\n'])
+                original = join_lines(rng, lines, eol)
+                # Now and then the edit also changes the line endings or the last newline.
+                formatted = join_lines(rng, random_edit(rng, lines), eol if rng.random() < 0.9 else None)
+                files.append(('batch%d/file%d.cc' % (batch, index), original, formatted))
+            self.assert_same_stats(files)
+
+    def test_edge_cases(self):
+        self.assert_same_stats([
+            ('empty-to-text.cc', '', 'int x;\n'),
+            ('text-to-empty.cc', 'int x;\n', ''),
+            ('no-final-newline.cc', 'int x;\nint y;', 'int x;\nint y;\n'),
+            ('crlf.cc', 'int x;\r\nint y;\r\n', 'int x;\nint y;\n'),
+            ('trailing-space.cc', 'int x;  \nint y;\n', 'int x;\nint y;\n'),
+            ('blank-runs.cc', 'a\n\n\n\nb\n', 'a\nb\n\n\n\n\nc\n'),
+            ('only-blanks.cc', '\n\n\n', '\n'),
+            ('whitespace-only.cc', 'if (x) {\n  y;\n}\n', 'if (x) {\n    y;\n}\n'),
+        ])
+
+    def test_quoted_paths(self):
+        # git quotes some of these names and not others; either way, each one has to be read back.
+        filenames = ['\xc3\xa9.cc', 'l\xe9.cc', 'tab\there.cc', 'quote"d.cc', 'back\\slash.cc', 'with space.cc', 'dir \xc3\xa9/x.cc']
+        files = [(filename, 'int x;\nint y;\n', 'int  x;\nint y;\n') for filename in filenames]
+        self.assert_same_stats(files)
+        for name, differ_class in sorted(git.diff_options.iteritems()):
+            self.assertEqual(sorted(differ_class().diff_file_stats(self.git_diff(files))), sorted(filenames), name)
+
+    @unittest.skipUnless(CLANG_FORMAT, "clang-format isn't in the path")
+    def test_clang_format_outputs(self):
+        # Made-up code that was formatted with one style, then reformatted with each of the others,
+        # like the candidate styles of a search.
+        rng = random.Random(0)
+        names = sorted(synthetic.STYLES)
+        files = []
+        for language_name, language in sorted(synthetic.LANGUAGES.iteritems()):
+            for index in range(4):
+                header = index % 2 == 0
+                filename = (language.filename % index) + '.' + (language.header_extension if header else language.source_extension)
+                source = language.generate(rng, index, header)
+                written = rng.choice(names)
+                original = self.format(source, written, filename)
+                for style in names:
+                    if style != written:
+                        files.append(('%s/%s/%s' % (language_name, style, filename), original, self.format(original, style, filename)))
+        self.assert_same_stats(files)
+
+    def format(self, text, style, filename):
+        style_string = memory.inline_style(styles.Style(style=synthetic.STYLES[style]))
+        return util.run([CLANG_FORMAT, '-style=' + style_string, '-assume-filename=' + filename], input=text)
+
+if __name__ == '__main__':
+    unittest.main()
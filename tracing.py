@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+
+# The profiler for --profile, or None if it's off. Everything here costs next to nothing while it's off.
+profiler = None
+
+def enable():
+    global profiler
+    profiler = Profiler()
+
+def cpu_time():
+    """The CPU time of this process and of the subprocesses that it has waited on (eg, clang-format and git)."""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+# Records a span of time for each stage (see 'span'), along with what was counted while it was open
+# (see 'count'), and puts them together into a Chrome trace and a summary.
+# The CPU times are for the whole process, so they overlap when several candidates run at once.
+class Profiler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.time()
+        self.events = []
+        self.thread_ids = {}
+
+        # {name: [calls, wall time, cpu time, {counter: value}]} for each kind of span.
+        self.totals = {}
+        # {counter: value} for the whole run.
+        self.counters = {}
+
+    def get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self.get_stack()
+        return stack[-1] if stack else None
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            span = self.current()
+            while span is not None:
+                span.counters[name] = span.counters.get(name, 0) + value
+                span = span.parent
+
+    def record(self, span, wall, cpu):
+        with self.lock:
+            thread_id = self.thread_ids.setdefault(threading.current_thread().ident, len(self.thread_ids) + 1)
+            args = dict(span.args)
+            args['cpu_ms'] = round(cpu * 1000, 3)
+            args.update(span.counters)
+            self.events.append({
+                'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread_id,
+                'ts': round((span.wall - self.start) * 1e6), 'dur': round(wall * 1e6), 'args': args,
+            })
+
+            totals = self.totals.setdefault(span.name, [0, 0.0, 0.0, {}])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            for name, value in span.counters.iteritems():
+                totals[3][name] = totals[3].get(name, 0) + value
+
+    def write_trace(self, path):
+        """Write the spans as Chrome trace events; load them in chrome://tracing or https://ui.perfetto.dev."""
+        with self.lock:
+            with open(path, 'wb') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': {'counters': self.counters}}, f)
+
+    def get_summary(self):
+        """Returns the lines of a table of the time and counts for each kind of span, and the cache hit rates."""
+        with self.lock:
+            columns = ['subprocesses', 'bytes to subprocesses', 'bytes from subprocesses', 'bytes read', 'bytes written']
+            lines = ['%-22s %7s %10s %10s %10s %8s %10s %10s %10s %10s' % (
+                'stage', 'calls', 'wall (s)', 'avg (ms)', 'cpu (s)', 'procs', 'to procs', 'from procs', 'read', 'written')]
+            for name, (calls, wall, cpu, counters) in sorted(self.totals.iteritems(), key=lambda item: -item[1][1]):
+                sizes = tuple(format_bytes(counters.get(column, 0)) for column in columns[1:])
+                lines.append('%-22s %7d %10.2f %10.2f %10.2f %8d %10s %10s %10s %10s' % (
+                    (name, calls, wall, wall * 1000 / calls, cpu, counters.get(columns[0], 0)) + sizes))
+
+            for name in sorted(self.counters):
+                if name.endswith(' hits'):
+                    cache = name[:-len(' hits')]
+                    hits, misses = self.counters[name], self.counters.get(cache + ' misses', 0)
+                    lines.append('%s: %d of %d lookups hit (%.1f%%)' % (cache, hits, hits + misses, 100.0 * hits / max(1, hits + misses)))
+            return lines
+
+def format_bytes(size):
+    for suffix, scale in (('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)):
+        if size >= scale:
+            return '%.1f%s' % (float(size) / scale, suffix)
+    return '%d' % size
+
+# A stage of the run, to use with 'with'. Spans can be nested, and what's counted while one is open
+# counts for it and for the spans that it's in.
+class Span(object):
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = None
+        self.counters = {}
+        self.wall = None
+
+    def __enter__(self):
+        if profiler is None:
+            return self
+        stack = profiler.get_stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if profiler is None or self.wall is None:
+            return
+        wall, cpu = time.time() - self.wall, cpu_time() - self.cpu
+        profiler.get_stack().pop()
+        profiler.record(self, wall, cpu)
+
+def span(name, category='stage', **args):
+    return Span(name, category, args)
+
+def count(name, value=1):
+    if profiler is not None:
+        profiler.count(name, value)
+
+def carry(function):
+    """Wrap a function that will run on another thread, so that what it counts goes to the span that's open now."""
+    if profiler is None:
+        return function
+    parent = profiler.current()
+    if parent is None:
+        return function
+
+    def carried(*args):
+        stack = profiler.get_stack()
+        stack.append(parent)
+        try:
+            return function(*args)
+        finally:
+            stack.pop()
+    return carried
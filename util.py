@@ -1,19 +1,28 @@
+import hashlib
+import os
 import subprocess
 import types
 
+import tracing
+
 # Run a command and return the stdout by default
 # Set include_stderr if you want the stderr too (will return the pair).
-def run(command, include_stdout=True, include_stderr=False, check=True, **kwargs):
+# Set input to feed a string to the command's stdin.
+# Set allowed_returncodes for commands that use a nonzero code to report success (eg, 'git diff --no-index').
+def run(command, include_stdout=True, include_stderr=False, check=True, input=None, allowed_returncodes=(0,), **kwargs):
     #print " $$ ", ' '.join(command)
     if include_stdout:
         kwargs['stdout'] = subprocess.PIPE
     if include_stderr:
         kwargs['stderr'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
 
     p = subprocess.Popen(command, **kwargs)
-    stdout, stderr = p.communicate()
+    stdout, stderr = p.communicate(input)
+    count_run(len(input or ''), len(stdout or ''))
 
-    if check and p.returncode:
+    if check and p.returncode not in allowed_returncodes:
         raise ValueError("git command returned code %s" % p.returncode)
 
     if include_stdout and include_stderr:
@@ -25,6 +34,49 @@ def run(command, include_stdout=True, include_stderr=False, check=True, **kwargs
     else:
         return None
 
+# The size of the reads from a command's stdout in run_lines.
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# Run a command and yield the lines of its stdout as they come, without their line endings.
+# Only a chunk of the output is held at a time, so this works for commands with a lot of output.
+# The command is checked like in 'run' once all of its output has been read. If the caller stops
+# early, the pipe is closed, and the command is waited for but not checked.
+def run_lines(command, check=True, allowed_returncodes=(0,), **kwargs):
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, **kwargs)
+    output_size = [0]
+    def read_chunk():
+        chunk = p.stdout.read(PIPE_CHUNK_SIZE)
+        output_size[0] += len(chunk)
+        return chunk
+    try:
+        for line in split_lines(iter(read_chunk, '')):
+            yield line
+    finally:
+        p.stdout.close()
+        p.wait()
+        count_run(0, output_size[0])
+
+    if check and p.returncode not in allowed_returncodes:
+        raise ValueError("git command returned code %s" % p.returncode)
+
+# Count a command that was run, and the bytes that went to it and came from it, for --profile.
+def count_run(input_size, output_size):
+    tracing.count('subprocesses')
+    tracing.count('bytes to subprocesses', input_size)
+    tracing.count('bytes from subprocesses', output_size)
+
+# Split chunks of text into lines, just like 'splitlines()' would split all of the text at once.
+def split_lines(chunks):
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(True)
+        # The last line might not be done yet (even if it ends in a '\r', a '\n' could follow).
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+        for line in lines:
+            yield line.rstrip('\r\n')
+    for line in pending.splitlines():
+        yield line
+
 def check(command, **kwargs):
     try:
         run(command, **kwargs)
@@ -48,6 +100,62 @@ def get_files_with_extensions(path, extensions):
     files = sorted(f[2:] for f in run(cmd, cwd=path).split('\0') if f)
     return files
 
+# The number of bytes that can be used for a command's arguments.
+# This leaves room for the environment (which shares the same limit) and some slack.
+def command_line_limit():
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 32768
+    environment = sum(len(k) + len(v) + 2 + 8 for k, v in os.environ.iteritems())
+    return max(4096, arg_max - environment - 4096)
+
+# Split files into 'count' shards whose total sizes are about the same, by always adding the next
+# largest file to the smallest shard. Shards are then split again so that no command built from
+# 'base_command' plus a shard is too long to run.
+def split_into_shards(files, sizes, count, base_command=()):
+    shards = [[] for _ in range(max(1, count))]
+    totals = [0] * len(shards)
+    for f in sorted(files, key=lambda f: sizes[f], reverse=True):
+        index = totals.index(min(totals))
+        shards[index].append(f)
+        totals[index] += sizes[f]
+
+    # Each argument costs its bytes, a terminating NUL, and a pointer.
+    limit = command_line_limit() - sum(len(arg) + 1 + 8 for arg in base_command)
+    result = []
+    for shard in shards:
+        current, current_length = [], 0
+        for f in shard:
+            length = len(f) + 1 + 8
+            if current and current_length + length > limit:
+                result.append(current)
+                current, current_length = [], 0
+            current.append(f)
+            current_length += length
+        if current:
+            result.append(current)
+    return result
+
+# Like 'map', but runs on the thread pool if there is one.
+def map_on_pool(pool, function, items):
+    if pool is None:
+        return [function(item) for item in items]
+    return pool.map(tracing.carry(function), items)
+
+# A hash of a {filename: contents} dict that changes if any name or contents does.
+def hash_file_contents(contents):
+    hasher = hashlib.sha1()
+    for filename in sorted(contents):
+        hasher.update(filename + '\0' + hashlib.sha1(contents[filename]).hexdigest() + '\0')
+    return hasher.hexdigest()
+
+# The hash git gives a blob with these contents (ie, what 'git hash-object' prints).
+def git_blob_hash(contents):
+    return hashlib.sha1('blob %d\0' % len(contents) + contents).hexdigest()
+
 # A class that makes a sentinel type with a good repr.
 # This is really useful with defaults in argparse, where you want the value to have something
 # nice to show to user, but still be a sentinel we can test against.
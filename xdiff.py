@@ -0,0 +1,755 @@
+# A port of the parts of git's xdiff library that the differs use, so that the stats of a file can
+# be found in-process instead of by running 'git diff' on scratch files.
+#
+# The goal is to give exactly the same output as git (2.39) for the options in the differs'
+# diff_format (plus the ignore-spaces options). That means more than a minimal diff: which of the
+# equally-short diffs git picks changes how the changes group into hunks and word runs, and the
+# scores depend on that. So this follows xdiff closely: the Myers search with its heuristics, the
+# pre-pass that discards lines with no match, the sliding of change groups (with the indent
+# heuristic for lines), and the way hunks are put together. The names follow xdiff's, to make the
+# two easier to compare.
+#
+# It assumes git's default settings (the Myers algorithm, and the indent heuristic turned on), which
+# git.DIFF_CONFIG pins for the diffs that git runs.
+
+import git
+
+WHITESPACE = ' \t\n\v\f\r'
+
+# xdiffi.c
+XDL_MAX_COST_MIN = 256
+XDL_HEUR_MIN_COST = 256
+XDL_LINE_MAX = (1 << 63) - 1
+XDL_SNAKE_CNT = 20
+XDL_K_HEUR = 4
+
+# xprepare.c
+XDL_KPDIS_RUN = 4
+XDL_MAX_EQLIMIT = 1024
+XDL_SIMSCAN_WINDOW = 100
+
+# The indent heuristic.
+MAX_INDENT = 200
+MAX_BLANKS = 20
+START_OF_FILE_PENALTY = 1
+END_OF_FILE_PENALTY = 21
+TOTAL_BLANK_WEIGHT = -30
+POST_BLANK_WEIGHT = 6
+RELATIVE_INDENT_PENALTY = -4
+RELATIVE_INDENT_WITH_BLANK_PENALTY = 10
+RELATIVE_OUTDENT_PENALTY = 24
+RELATIVE_OUTDENT_WITH_BLANK_PENALTY = 17
+RELATIVE_DEDENT_PENALTY = 23
+RELATIVE_DEDENT_WITH_BLANK_PENALTY = 17
+INDENT_WEIGHT = 60
+INDENT_HEURISTIC_MAX_SLIDING = 100
+
+# The context that 'git diff --numstat' counts changes with; it only matters for the blank lines
+# that --ignore-blank-lines keeps when they're close to other changes.
+NUMSTAT_CONTEXT = 3
+
+# The options in the differs' diff_format, and the ones that ignore_spaces adds.
+SUPPORTED_OPTIONS = set([
+    '--numstat',
+    '--word-diff=porcelain', '-U0', '--word-diff-regex=.',
+    '--ignore-blank-lines', '--ignore-space-at-eol',
+])
+
+class Change(object):
+    def __init__(self, i1, i2, chg1, chg2):
+        self.i1 = i1
+        self.i2 = i2
+        self.chg1 = chg1
+        self.chg2 = chg2
+        self.ignore = False
+
+class XdFile(object):
+    def __init__(self, recs, ha):
+        self.recs = recs
+        self.ha = ha
+        self.nrec = len(recs)
+        # There's an extra unchanged record at the end, which is also rchg[-1].
+        self.rchg = [0] * (self.nrec + 1)
+        self.dstart = 0
+        self.dend = self.nrec - 1
+        # The records that take part in the Myers search, by index and class.
+        self.rindex = []
+        self.reff_ha = []
+
+def split_records(text):
+    """Split the text into xdiff's records: each line with its '\\n' (the last one might not have one)."""
+    lines = text.split('\n')
+    records = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        records.append(lines[-1])
+    return records
+
+def bogosqrt(n):
+    i = 1
+    while n > 0:
+        n >>= 2
+        i <<= 1
+    return i
+
+def trim_common_tail(a, b):
+    """Drop the common tail of the texts, in blocks, like git does before a diff with no context."""
+    blk = 1024
+    trimmed = 0
+    smaller = min(len(a), len(b))
+    while blk + trimmed <= smaller and a[len(a) - trimmed - blk:len(a) - trimmed] == b[len(b) - trimmed - blk:len(b) - trimmed]:
+        trimmed += blk
+
+    recovered = 0
+    start = len(a) - trimmed
+    while recovered < trimmed:
+        recovered += 1
+        if a[start + recovered - 1] == '\n':
+            break
+    return a[:len(a) - trimmed + recovered], b[:len(b) - trimmed + recovered]
+
+# xprepare.c
+
+def prepare(recs1, recs2, ignore_space_at_eol):
+    classes = {}
+    len1 = []
+    len2 = []
+
+    def classify(recs, counts):
+        ha = []
+        for rec in recs:
+            key = rec.rstrip(WHITESPACE) if ignore_space_at_eol else rec
+            index = classes.get(key)
+            if index is None:
+                index = classes[key] = len(classes)
+                len1.append(0)
+                len2.append(0)
+            counts[index] += 1
+            ha.append(index)
+        return ha
+
+    xdf1 = XdFile(recs1, classify(recs1, len1))
+    xdf2 = XdFile(recs2, classify(recs2, len2))
+    trim_ends(xdf1, xdf2)
+    cleanup_records(len1, len2, xdf1, xdf2)
+    return xdf1, xdf2
+
+def trim_ends(xdf1, xdf2):
+    ha1, ha2 = xdf1.ha, xdf2.ha
+    lim = min(xdf1.nrec, xdf2.nrec)
+    i = 0
+    while i < lim and ha1[i] == ha2[i]:
+        i += 1
+    xdf1.dstart = xdf2.dstart = i
+
+    lim -= i
+    i = 0
+    while i < lim and ha1[xdf1.nrec - 1 - i] == ha2[xdf2.nrec - 1 - i]:
+        i += 1
+    xdf1.dend = xdf1.nrec - i - 1
+    xdf2.dend = xdf2.nrec - i - 1
+
+def clean_mmatch(dis, i, s, e):
+    if i - s > XDL_SIMSCAN_WINDOW:
+        s = i - XDL_SIMSCAN_WINDOW
+    if e - i > XDL_SIMSCAN_WINDOW:
+        e = i + XDL_SIMSCAN_WINDOW
+
+    r, rdis0, rpdis0 = 1, 0, 1
+    while i - r >= s:
+        if not dis[i - r]:
+            rdis0 += 1
+        elif dis[i - r] == 2:
+            rpdis0 += 1
+        else:
+            break
+        r += 1
+    if rdis0 == 0:
+        return False
+
+    r, rdis1, rpdis1 = 1, 0, 1
+    while i + r <= e:
+        if not dis[i + r]:
+            rdis1 += 1
+        elif dis[i + r] == 2:
+            rpdis1 += 1
+        else:
+            break
+        r += 1
+    if rdis1 == 0:
+        return False
+
+    rdis1 += rdis0
+    rpdis1 += rpdis0
+    return rpdis1 * XDL_KPDIS_RUN < rpdis1 + rdis1
+
+def cleanup_records(len1, len2, xdf1, xdf2):
+    """Leave the records with no match in the other file out of the search; they're sure to be changed."""
+    for xdf, matches in ((xdf1, len2), (xdf2, len1)):
+        mlim = min(bogosqrt(xdf.nrec), XDL_MAX_EQLIMIT)
+        dis = [0] * (xdf.nrec + 1)
+        for i in range(xdf.dstart, xdf.dend + 1):
+            nm = matches[xdf.ha[i]]
+            dis[i] = 0 if nm == 0 else 2 if nm >= mlim else 1
+        xdf.dis = dis
+
+    for xdf in (xdf1, xdf2):
+        dis = xdf.dis
+        for i in range(xdf.dstart, xdf.dend + 1):
+            if dis[i] == 1 or (dis[i] == 2 and not clean_mmatch(dis, i, xdf.dstart, xdf.dend)):
+                xdf.rindex.append(i)
+                xdf.reff_ha.append(xdf.ha[i])
+            else:
+                xdf.rchg[i] = 1
+        del xdf.dis
+
+# xdiffi.c
+
+def split(ha1, off1, lim1, ha2, off2, lim2, kvdf, kvdb, koff, need_min, mxcost):
+    """Find the middle of the diff of the ranges. Returns (i1, i2, min_lo, min_hi)."""
+    dmin, dmax = off1 - lim2, lim1 - off2
+    fmid, bmid = off1 - off2, lim1 - lim2
+    odd = (fmid - bmid) & 1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+
+    kvdf[koff + fmid] = off1
+    kvdb[koff + bmid] = lim1
+
+    ec = 0
+    while True:
+        ec += 1
+        got_snake = False
+
+        if fmin > dmin:
+            fmin -= 1
+            kvdf[koff + fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            kvdf[koff + fmax + 1] = -1
+        else:
+            fmax -= 1
+
+        for d in xrange(fmax, fmin - 1, -2):
+            k = koff + d
+            lo, hi = kvdf[k - 1], kvdf[k + 1]
+            i1 = lo + 1 if lo >= hi else hi
+            prev1 = i1
+            i2 = i1 - d
+            while i1 < lim1 and i2 < lim2 and ha1[i1] == ha2[i2]:
+                i1 += 1
+                i2 += 1
+            if i1 - prev1 > XDL_SNAKE_CNT:
+                got_snake = True
+            kvdf[k] = i1
+            if odd and bmin <= d <= bmax and kvdb[k] <= i1:
+                return i1, i2, True, True
+
+        if bmin > dmin:
+            bmin -= 1
+            kvdb[koff + bmin - 1] = XDL_LINE_MAX
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            kvdb[koff + bmax + 1] = XDL_LINE_MAX
+        else:
+            bmax -= 1
+
+        for d in xrange(bmax, bmin - 1, -2):
+            k = koff + d
+            lo, hi = kvdb[k - 1], kvdb[k + 1]
+            i1 = lo if lo < hi else hi - 1
+            prev1 = i1
+            i2 = i1 - d
+            while i1 > off1 and i2 > off2 and ha1[i1 - 1] == ha2[i2 - 1]:
+                i1 -= 1
+                i2 -= 1
+            if prev1 - i1 > XDL_SNAKE_CNT:
+                got_snake = True
+            kvdb[k] = i1
+            if not odd and fmin <= d <= fmax and i1 <= kvdf[k]:
+                return i1, i2, True, True
+
+        if need_min:
+            continue
+
+        # The heuristics for diffs that are getting expensive.
+        if got_snake and ec > XDL_HEUR_MIN_COST:
+            best = 0
+            for d in xrange(fmax, fmin - 1, -2):
+                dd = d - fmid if d > fmid else fmid - d
+                i1 = kvdf[koff + d]
+                i2 = i1 - d
+                v = (i1 - off1) + (i2 - off2) - dd
+                if (v > XDL_K_HEUR * ec and v > best and
+                        off1 + XDL_SNAKE_CNT <= i1 < lim1 and off2 + XDL_SNAKE_CNT <= i2 < lim2):
+                    k = 1
+                    while ha1[i1 - k] == ha2[i2 - k]:
+                        if k == XDL_SNAKE_CNT:
+                            best = v
+                            best_split = (i1, i2)
+                            break
+                        k += 1
+            if best > 0:
+                return best_split[0], best_split[1], True, False
+
+            best = 0
+            for d in xrange(bmax, bmin - 1, -2):
+                dd = d - bmid if d > bmid else bmid - d
+                i1 = kvdb[koff + d]
+                i2 = i1 - d
+                v = (lim1 - i1) + (lim2 - i2) - dd
+                if (v > XDL_K_HEUR * ec and v > best and
+                        off1 < i1 <= lim1 - XDL_SNAKE_CNT and off2 < i2 <= lim2 - XDL_SNAKE_CNT):
+                    k = 0
+                    while ha1[i1 + k] == ha2[i2 + k]:
+                        if k == XDL_SNAKE_CNT - 1:
+                            best = v
+                            best_split = (i1, i2)
+                            break
+                        k += 1
+            if best > 0:
+                return best_split[0], best_split[1], False, True
+
+        # Enough is enough; take the furthest reaching path.
+        if ec >= mxcost:
+            fbest = fbest1 = -1
+            for d in xrange(fmax, fmin - 1, -2):
+                i1 = min(kvdf[koff + d], lim1)
+                i2 = i1 - d
+                if lim2 < i2:
+                    i1, i2 = lim2 + d, lim2
+                if fbest < i1 + i2:
+                    fbest = i1 + i2
+                    fbest1 = i1
+
+            bbest = bbest1 = XDL_LINE_MAX
+            for d in xrange(bmax, bmin - 1, -2):
+                i1 = max(off1, kvdb[koff + d])
+                i2 = i1 - d
+                if i2 < off2:
+                    i1, i2 = off2 + d, off2
+                if i1 + i2 < bbest:
+                    bbest = i1 + i2
+                    bbest1 = i1
+
+            if (lim1 + lim2) - bbest < fbest - (off1 + off2):
+                return fbest1, fbest - fbest1, True, False
+            else:
+                return bbest1, bbest - bbest1, False, True
+
+def recs_cmp(xdf1, xdf2):
+    """Mark the changed records of both files."""
+    ha1, ha2 = xdf1.reff_ha, xdf2.reff_ha
+    ndiags = len(ha1) + len(ha2) + 3
+    kvdf = [0] * ndiags
+    kvdb = [0] * ndiags
+    koff = len(ha2) + 1
+    mxcost = max(bogosqrt(ndiags), XDL_MAX_COST_MIN)
+
+    # xdiff recurses, but the halves don't depend on each other, so a stack does the same.
+    stack = [(0, len(ha1), 0, len(ha2), False)]
+    while stack:
+        off1, lim1, off2, lim2, need_min = stack.pop()
+
+        while off1 < lim1 and off2 < lim2 and ha1[off1] == ha2[off2]:
+            off1 += 1
+            off2 += 1
+        while off1 < lim1 and off2 < lim2 and ha1[lim1 - 1] == ha2[lim2 - 1]:
+            lim1 -= 1
+            lim2 -= 1
+
+        if off1 == lim1:
+            for i in xrange(off2, lim2):
+                xdf2.rchg[xdf2.rindex[i]] = 1
+        elif off2 == lim2:
+            for i in xrange(off1, lim1):
+                xdf1.rchg[xdf1.rindex[i]] = 1
+        else:
+            i1, i2, min_lo, min_hi = split(ha1, off1, lim1, ha2, off2, lim2, kvdf, kvdb, koff, need_min, mxcost)
+            stack.append((i1, lim1, i2, lim2, min_hi))
+            stack.append((off1, i1, off2, i2, min_lo))
+
+def get_indent(rec):
+    ret = 0
+    for c in rec:
+        if c not in WHITESPACE:
+            return ret
+        elif c == ' ':
+            ret += 1
+        elif c == '\t':
+            ret += 8 - ret % 8
+        if ret >= MAX_INDENT:
+            return MAX_INDENT
+    # The line is all whitespace.
+    return -1
+
+def measure_split(xdf, split):
+    """Returns (end_of_file, indent, pre_blank, pre_indent, post_blank, post_indent)."""
+    if split >= xdf.nrec:
+        end_of_file, indent = True, -1
+    else:
+        end_of_file, indent = False, get_indent(xdf.recs[split])
+
+    pre_blank, pre_indent = 0, -1
+    for i in xrange(split - 1, -1, -1):
+        pre_indent = get_indent(xdf.recs[i])
+        if pre_indent != -1:
+            break
+        pre_blank += 1
+        if pre_blank == MAX_BLANKS:
+            pre_indent = 0
+            break
+
+    post_blank, post_indent = 0, -1
+    for i in xrange(split + 1, xdf.nrec):
+        post_indent = get_indent(xdf.recs[i])
+        if post_indent != -1:
+            break
+        post_blank += 1
+        if post_blank == MAX_BLANKS:
+            post_indent = 0
+            break
+
+    return end_of_file, indent, pre_blank, pre_indent, post_blank, post_indent
+
+def score_add_split(measurement, score):
+    end_of_file, indent, pre_blank, pre_indent, post_blank, post_indent = measurement
+    effective_indent, penalty = score
+
+    if pre_indent == -1 and pre_blank == 0:
+        penalty += START_OF_FILE_PENALTY
+    if end_of_file:
+        penalty += END_OF_FILE_PENALTY
+
+    blank_after = 1 + post_blank if indent == -1 else 0
+    total_blank = pre_blank + blank_after
+    penalty += TOTAL_BLANK_WEIGHT * total_blank
+    penalty += POST_BLANK_WEIGHT * blank_after
+
+    if indent == -1:
+        indent = post_indent
+    any_blanks = total_blank != 0
+    effective_indent += indent
+
+    if indent == -1 or pre_indent == -1:
+        pass
+    elif indent > pre_indent:
+        penalty += RELATIVE_INDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_INDENT_PENALTY
+    elif indent == pre_indent:
+        pass
+    elif post_indent != -1 and post_indent > indent:
+        penalty += RELATIVE_OUTDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_OUTDENT_PENALTY
+    else:
+        penalty += RELATIVE_DEDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_DEDENT_PENALTY
+
+    return effective_indent, penalty
+
+def score_cmp(s1, s2):
+    cmp_indents = (s1[0] > s2[0]) - (s1[0] < s2[0])
+    return INDENT_WEIGHT * cmp_indents + (s1[1] - s2[1])
+
+# A group of changed records: [start, end). An empty group sits just above record 'start'.
+class Group(object):
+    def __init__(self, xdf):
+        self.xdf = xdf
+        self.start = self.end = 0
+        while xdf.rchg[self.end]:
+            self.end += 1
+
+    def next(self):
+        xdf = self.xdf
+        if self.end == xdf.nrec:
+            return False
+        self.start = self.end + 1
+        self.end = self.start
+        while xdf.rchg[self.end]:
+            self.end += 1
+        return True
+
+    def previous(self):
+        xdf = self.xdf
+        if self.start == 0:
+            return False
+        self.end = self.start - 1
+        self.start = self.end
+        while xdf.rchg[self.start - 1]:
+            self.start -= 1
+        return True
+
+    def slide_down(self):
+        xdf = self.xdf
+        if self.end < xdf.nrec and xdf.ha[self.start] == xdf.ha[self.end]:
+            xdf.rchg[self.start] = 0
+            xdf.rchg[self.end] = 1
+            self.start += 1
+            self.end += 1
+            while xdf.rchg[self.end]:
+                self.end += 1
+            return True
+        return False
+
+    def slide_up(self):
+        xdf = self.xdf
+        if self.start > 0 and xdf.ha[self.start - 1] == xdf.ha[self.end - 1]:
+            self.start -= 1
+            self.end -= 1
+            xdf.rchg[self.start] = 1
+            xdf.rchg[self.end] = 0
+            while xdf.rchg[self.start - 1]:
+                self.start -= 1
+            return True
+        return False
+
+def change_compact(xdf, xdfo, indent_heuristic):
+    """Slide each group of changes as far as it goes, merging the ones it bumps into, and then
+    back up to line up with a change in the other file or to the nicest spot for the indents."""
+    g = Group(xdf)
+    go = Group(xdfo)
+
+    while True:
+        if g.end != g.start:
+            while True:
+                groupsize = g.end - g.start
+                end_matching_other = -1
+
+                while g.slide_up():
+                    go.previous()
+                earliest_end = g.end
+                if go.end > go.start:
+                    end_matching_other = g.end
+
+                while g.slide_down():
+                    go.next()
+                    if go.end > go.start:
+                        end_matching_other = g.end
+
+                if groupsize == g.end - g.start:
+                    break
+
+            if g.end == earliest_end:
+                pass
+            elif end_matching_other != -1:
+                while go.end == go.start:
+                    g.slide_up()
+                    go.previous()
+            elif indent_heuristic:
+                best_shift = -1
+                best_score = None
+                shift = max(earliest_end, g.end - groupsize - 1, g.end - INDENT_HEURISTIC_MAX_SLIDING)
+                while shift <= g.end:
+                    score = score_add_split(measure_split(xdf, shift), (0, 0))
+                    score = score_add_split(measure_split(xdf, shift - groupsize), score)
+                    if best_shift == -1 or score_cmp(score, best_score) <= 0:
+                        best_score = score
+                        best_shift = shift
+                    shift += 1
+
+                while g.end > best_shift:
+                    g.slide_up()
+                    go.previous()
+
+        if not g.next():
+            break
+        go.next()
+
+def build_script(xdf1, xdf2):
+    changes = []
+    rchg1, rchg2 = xdf1.rchg, xdf2.rchg
+    i1, i2 = xdf1.nrec, xdf2.nrec
+    while i1 >= 0 or i2 >= 0:
+        if rchg1[i1 - 1] or rchg2[i2 - 1]:
+            l1, l2 = i1, i2
+            while rchg1[i1 - 1]:
+                i1 -= 1
+            while rchg2[i2 - 1]:
+                i2 -= 1
+            changes.append(Change(i1, i2, l1 - i1, l2 - i2))
+        i1 -= 1
+        i2 -= 1
+    changes.reverse()
+    return changes
+
+def is_blank_line(rec, ignore_whitespace):
+    if not ignore_whitespace:
+        return len(rec) <= 1
+    return not rec.strip(WHITESPACE)
+
+def diff(recs1, recs2, ignore_space_at_eol=False, ignore_blank_lines=False, indent_heuristic=False):
+    """Returns the list of Change between two lists of records."""
+    xdf1, xdf2 = prepare(recs1, recs2, ignore_space_at_eol)
+    recs_cmp(xdf1, xdf2)
+    change_compact(xdf1, xdf2, indent_heuristic)
+    change_compact(xdf2, xdf1, indent_heuristic)
+    changes = build_script(xdf1, xdf2)
+
+    if ignore_blank_lines:
+        for change in changes:
+            change.ignore = (
+                all(is_blank_line(rec, ignore_space_at_eol) for rec in recs1[change.i1:change.i1 + change.chg1]) and
+                all(is_blank_line(rec, ignore_space_at_eol) for rec in recs2[change.i2:change.i2 + change.chg2])
+            )
+    return changes
+
+def get_hunks(changes, context):
+    """Group the changes into hunks like xdl_get_hunk. Returns a list of (first, last) indexes."""
+    max_common = 2 * context
+    max_ignorable = context
+    hunks = []
+    start = 0
+    count = len(changes)
+    while start < count:
+        # Drop the ignorable changes that are too far from the next change.
+        index = start
+        while index < count and changes[index].ignore:
+            if index + 1 == count or changes[index + 1].i1 - (changes[index].i1 + changes[index].chg1) >= max_ignorable:
+                start = index + 1
+            index += 1
+        if start == count:
+            break
+
+        last = start
+        ignored = 0
+        for index in xrange(start + 1, count):
+            previous, change = changes[index - 1], changes[index]
+            distance = change.i1 - (previous.i1 + previous.chg1)
+            if distance > max_common:
+                break
+            if distance < max_ignorable and (not change.ignore or last == index - 1):
+                last = index
+                ignored = 0
+            elif distance < max_ignorable and change.ignore:
+                ignored += change.chg2
+            elif last != index - 1 and change.i1 + ignored - (changes[last].i1 + changes[last].chg1) > max_common:
+                break
+            elif not change.ignore:
+                last = index
+                ignored = 0
+            else:
+                ignored += change.chg2
+
+        hunks.append((start, last))
+        start = last + 1
+    return hunks
+
+# diff.c
+
+def numstat(original, formatted, ignore_space_at_eol=False, ignore_blank_lines=False):
+    """Returns (insertions, deletions) like 'git diff --numstat'."""
+    changes = diff(split_records(original), split_records(formatted),
+        ignore_space_at_eol=ignore_space_at_eol, ignore_blank_lines=ignore_blank_lines, indent_heuristic=True)
+    insertions = deletions = 0
+    for first, last in get_hunks(changes, NUMSTAT_CONTEXT):
+        for change in changes[first:last + 1]:
+            insertions += change.chg2
+            deletions += change.chg1
+    return insertions, deletions
+
+def word_diff(original, formatted, ignore_space_at_eol=False, ignore_blank_lines=False):
+    """Returns the '-' and '+' lines of 'git diff --word-diff=porcelain -U0 --word-diff-regex=.',
+    or None if git wouldn't show the file at all (which isn't the same as showing no lines)."""
+    original, formatted = trim_common_tail(original, formatted)
+    recs1, recs2 = split_records(original), split_records(formatted)
+    changes = diff(recs1, recs2,
+        ignore_space_at_eol=ignore_space_at_eol, ignore_blank_lines=ignore_blank_lines, indent_heuristic=True)
+
+    # With no context, each hunk is one change.
+    hunks = get_hunks(changes, 0)
+    if not hunks:
+        return None
+    lines = []
+    for first, last in hunks:
+        change = changes[first]
+        minus = ''.join(recs1[change.i1:change.i1 + change.chg1])
+        plus = ''.join(recs2[change.i2:change.i2 + change.chg2])
+        lines.extend(word_diff_hunk(minus, plus))
+    return lines
+
+# The word diff of a hunk only depends on its text, and most styles leave most hunks the same as
+# some other style did, so the lines for each hunk are kept. They're all dropped when the hunks
+# add up to too many bytes.
+class HunkMemo(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lines = {}
+        self.size = 0
+
+    def get(self, minus, plus):
+        key = (minus, plus)
+        lines = self.lines.get(key)
+        if lines is None:
+            if self.size >= self.max_bytes:
+                self.lines = {}
+                self.size = 0
+            lines = self.lines[key] = list(diff_words(minus, plus))
+            self.size += len(minus) + len(plus)
+        return lines
+
+hunk_memo = HunkMemo(max_bytes=64 * 1024 * 1024)
+
+def word_diff_hunk(minus, plus):
+    return hunk_memo.get(minus, plus)
+
+def diff_words(minus, plus):
+    if not plus:
+        for line in write_words('-', minus):
+            yield line
+        return
+
+    # Every character but a newline is a word, and each word is a record of its own.
+    minus_words = [i for i, c in enumerate(minus) if c != '\n']
+    plus_words = [i for i, c in enumerate(plus) if c != '\n']
+    minus_text, plus_text = trim_common_tail(
+        ''.join(minus[i] + '\n' for i in minus_words),
+        ''.join(plus[i] + '\n' for i in plus_words),
+    )
+    for change in diff(split_records(minus_text), split_records(plus_text)):
+        if change.chg1:
+            begin, end = minus_words[change.i1], minus_words[change.i1 + change.chg1 - 1] + 1
+            for line in write_words('-', minus[begin:end]):
+                yield line
+        if change.chg2:
+            begin, end = plus_words[change.i2], plus_words[change.i2 + change.chg2 - 1] + 1
+            for line in write_words('+', plus[begin:end]):
+                yield line
+
+def write_words(prefix, text):
+    # Porcelain puts each line of a run of words on its own line.
+    for piece in text.split('\n'):
+        if piece:
+            yield prefix + piece
+
+def diff_lines(files, options):
+    """Yield the lines that 'git diff' with the options would print for the (filename, original, formatted)
+    files; or at least, the lines that the differs read."""
+    options = set(options)
+    unsupported = options - SUPPORTED_OPTIONS
+    if unsupported:
+        raise ValueError("The native diff engine doesn't support %s" % ' '.join(sorted(unsupported)))
+    ignore = {
+        'ignore_space_at_eol': '--ignore-space-at-eol' in options,
+        'ignore_blank_lines': '--ignore-blank-lines' in options,
+    }
+
+    for filename, original, formatted in files:
+        if '--numstat' in options:
+            insertions, deletions = numstat(original, formatted, **ignore)
+            if insertions or deletions:
+                yield '%d\t%d\t%s' % (insertions, deletions, filename)
+        elif '--word-diff=porcelain' in options:
+            lines = word_diff(original, formatted, **ignore)
+            if lines is not None:
+                # The differs read the '---' and '+++' lines of the header like any other. Like git,
+                # they end with a tab if the name has a space in it.
+                original_name, formatted_name = git.quote_path('a/' + filename), git.quote_path('b/' + filename)
+                tab = '\t' if ' ' in filename else ''
+                yield 'diff --git %s %s' % (original_name, formatted_name)
+                yield '--- %s%s' % (original_name, tab)
+                yield '+++ %s%s' % (formatted_name, tab)
+                # git's output is split with splitlines() (see util.split_lines), which also breaks
+                # lines at a '\r' (eg, the end of a CRLF line in a run of words), so split the same way.
+                for line in lines:
+                    for piece in (line + '\n').splitlines():
+                        yield piece